@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Local cache of the arrays of ArrayData outputs, for repeated post-processing of large arrays (restart, coord,
+moment, ...).
+
+get_array of ArrayData reads (and decompresses) the whole array from the AiiDA repository on every call. With the
+cache the .npy file of an array is copied once into a local folder and every later access is a read-only memory map of
+the local copy, so only the parts of the array that are used are read from disk:
+
+from aiida_uppasd2.UppASD_ArrayCache import get_cached_array
+moments = get_cached_array(node.outputs.output_array, "moment")
+
+The copies are keyed by the uuid of the node, the name of the array and the modification time of the node, a copy
+made before the node was modified is replaced on the next access. The folder is ~/.cache/aiida-uppasd2/arrays (or the environment variable AIIDA_UPPASD2_ARRAY_CACHE) and its
+size is capped at 10 GB (or AIIDA_UPPASD2_ARRAY_CACHE_SIZE in GB), the least recently used arrays are removed first.
+Unstored nodes are not cached. 'verdi data asd retrieve_restart_file --cache' reads the restart array through the cache.
+
+Arrays that are read once from start to end (the export of restart files, the stitching of the restarts in the base
+workflow) are better read block by block from the repository with iter_array_blocks, without a local copy:
+
+for block in iter_array_blocks(node.outputs.output_array, "moment", 100000):
+    ...
+"""
+import os
+import shutil
+import tempfile
+import numpy as np
+
+_default_cache_dir = os.path.join("~", ".cache", "aiida-uppasd2", "arrays")
+_default_max_size = 10.0  # GB
+
+
+class ArrayCache:
+    def __init__(self, cache_dir=None, max_size=None):
+        # max_size in GB
+        if cache_dir is None:
+            cache_dir = os.environ.get("AIIDA_UPPASD2_ARRAY_CACHE", _default_cache_dir)
+        if max_size is None:
+            max_size = float(
+                os.environ.get("AIIDA_UPPASD2_ARRAY_CACHE_SIZE", _default_max_size)
+            )
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_bytes = int(max_size * 1024**3)
+
+    def get_path(self, node, array_name):
+        # one folder per array, the file name is the modification time of the node
+        return os.path.join(
+            self.cache_dir,
+            node.uuid,
+            array_name,
+            "{:.6f}.npy".format(node.mtime.timestamp()),
+        )
+
+    def get_array(self, node, array_name):
+        # read-only memory map of the local copy of the array, the copy is made on the first access
+        if not node.is_stored:
+            return node.get_array(array_name)
+        path = self.get_path(node, array_name)
+        try:
+            # the modification time is the last access, for the LRU eviction
+            os.utime(path)
+        except FileNotFoundError:
+            self.remove_stale(path)
+            self.add_array(node, array_name, path)
+            self.evict(keep=path)
+        return np.load(path, mmap_mode="r", allow_pickle=False)
+
+    def add_array(self, node, array_name, path):
+        # copy the .npy file from the repository as it is, without loading the array; the copy is written to a
+        # temporary file first, so other processes never see a half written array
+        filename = array_name + ".npy"
+        if filename not in node.base.repository.list_object_names():
+            raise KeyError(
+                f"Array with name `{array_name}` not found in ArrayData<{node.pk}>"
+            )
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path), suffix=".tmp", delete=False
+        ) as handle:
+            with node.base.repository.open(filename, mode="rb") as source:
+                shutil.copyfileobj(source, handle)
+        os.replace(handle.name, path)
+
+    def remove_stale(self, path):
+        # remove the copies of the array made before the node was modified
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            return
+        for filename in os.listdir(folder):
+            if filename.endswith(".npy") and os.path.join(folder, filename) != path:
+                try:
+                    os.remove(os.path.join(folder, filename))
+                except FileNotFoundError:
+                    pass
+
+    def get_entries(self):
+        # (last access, size, path) of all cached arrays
+        entries = []
+        for root, _, filenames in os.walk(self.cache_dir):
+            for filename in filenames:
+                if not filename.endswith(".npy"):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self, keep=None):
+        # remove the least recently used arrays until the cache is below max_bytes, keep is never removed
+        entries = sorted(self.get_entries())
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total_bytes <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                # an array that is memory mapped stays readable until it is closed
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            # the folders of the array and of the node, if they are empty
+            for folder in [
+                os.path.dirname(path),
+                os.path.dirname(os.path.dirname(path)),
+            ]:
+                try:
+                    os.rmdir(folder)
+                except OSError:
+                    break
+
+    def clear(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+def get_cached_array(node, array_name, cache_dir=None, max_size=None):
+    # get_array through the cache, see ArrayCache
+    return ArrayCache(cache_dir, max_size).get_array(node, array_name)
+
+
+def read_exactly(handle, size):
+    # n bytes from a binary handle with read() only, the objects of a packed repository have no readinto
+    chunks = []
+    while size > 0:
+        chunk = handle.read(size)
+        if not chunk:
+            raise ValueError("The array file ended before all rows were read")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def iter_npy_blocks(handle, block_rows):
+    # Read the rows of a .npy file block by block from an open binary handle, the whole array is never in memory
+    version = np.lib.format.read_magic(handle)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(handle)
+    elif version == (2, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(handle)
+    else:
+        raise ValueError(f"Unsupported .npy format version {version}")
+    row_size = dtype.itemsize * int(np.prod(shape[1:]))
+    if fortran_order:
+        # not written by ArrayData, read it at once
+        yield np.frombuffer(
+            read_exactly(handle, dtype.itemsize * int(np.prod(shape))), dtype=dtype
+        ).reshape(shape, order="F")
+        return
+    for start in range(0, shape[0], block_rows):
+        n_rows = min(block_rows, shape[0] - start)
+        buffer = read_exactly(handle, n_rows * row_size)
+        yield np.frombuffer(buffer, dtype=dtype).reshape((n_rows,) + tuple(shape[1:]))
+
+
+def iter_array_blocks(node, array_name, block_rows):
+    # the rows of an array of an ArrayData block by block, from the .npy file in the repository of the node
+    with node.base.repository.open(array_name + ".npy", mode="rb") as handle:
+        yield from iter_npy_blocks(handle, block_rows)
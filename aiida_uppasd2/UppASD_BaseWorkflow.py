@@ -7,9 +7,13 @@ The base restart workchain for UppASD includes three main steps:
 4. If the calculation is finished, return the results.
 
 Noticed problems (ToDo list):
-1. When the code automatically restarts from the restart file, it will lose the previous trajectory and only the last part of the trajectory will be saved.
-** This problem is mostly due to the trajectory file being super large and currently not suitable for parsing several times.
-!! The current solution is to ensure that enough walltime is given to the calculation that needs the trajectory.
+1. When the code automatically restarts from the restart file, each calculation only has its own part of the trajectory.
+** Large moment and trajectory files are parsed in a streaming mode (see parser_options), so the parser memory stays flat.
+** The time series of all parts (stitch_name_list: averages, totenergy, sknumber, cumulants, moment, trajectory by
+default) are appended into the output stitched_array, with the iterations counted from the start of the first part.
+Each part is parsed only once, by its own calculation.
+2. By default (remote_restart) the restart file is linked from the remote folder of the previous calculation, so the
+previous remote folder should not be cleaned before the workflow is finished.
 Note that the PK of the workflow can be obtained by the following command:
 
 baserestartworkflow = submit(UppASD_baseworkflow, **input_uppasd)
@@ -19,14 +23,21 @@ The pk can be used for making groups of calculations for data query and analysis
 
 Dr. Qichen Xu, Uppsala University & KTH, Sweden
 """
+import os
+import tempfile
+import numpy as np
 from aiida import orm
 from aiida.engine import (
+    calcfunction,
     while_,
     BaseRestartWorkChain,
     process_handler,
     ProcessHandlerReport,
 )
 from aiida.plugins import CalculationFactory
+from aiida_uppasd2.UppASD_Inputs import canonicalize_input_dict
+from aiida_uppasd2.UppASD_ArrayCache import iter_array_blocks
+from aiida_uppasd2.UppASD_Schemas import apply_schema, to_plain_array
 
 # get calculations
 ASDCalculation = CalculationFactory("asd_calculations")
@@ -35,6 +46,17 @@ ASDCalculation = CalculationFactory("asd_calculations")
 class UppASD_Baseworkflow(BaseRestartWorkChain):
     # base restart workflow
     _process_class = ASDCalculation
+    # time series that are stitched over the walltime restarts if stitch_name_list is not given
+    _default_stitch_name_list = [
+        "averages*",
+        "totenergy*",
+        "sknumber*",
+        "cumulants*",
+        "moment*",
+        "trajectory*",
+    ]
+    # rows of a segment that are read from the repository at a time when the segments are stitched
+    _stitch_block_rows = 100000
 
     @classmethod
     def define(cls, spec):
@@ -116,6 +138,55 @@ class UppASD_Baseworkflow(BaseRestartWorkChain):
             valid_type=orm.Str,
             required=True,
         )
+        # Restart from the restart file in the remote folder of the previous calculation (linked on the cluster),
+        # if False the restart array of the previous output_array is used, so restart* has to be retrieved.
+        spec.input(
+            "remote_restart",
+            valid_type=orm.Bool,
+            default=lambda: orm.Bool(True),
+            required=False,
+        )
+        # time series that are appended over the walltime restarts into stitched_array
+        spec.input(
+            "stitch_name_list",
+            valid_type=orm.List,
+            required=False,
+            help="names in retrieve_and_parse_name_list to stitch over the restarts, default: averages, totenergy, sknumber, cumulants, moment and trajectory",
+        )
+        # Adaptive walltime: the walltime of a restart is predicted from the steps per second of the previous attempts,
+        # and the initial walltime from the rate of finished workflows with the same system size, mode and resources.
+        # Without adaptive_walltime (or if no rate is known) init_walltime and walltime_increase are used.
+        spec.input(
+            "adaptive_walltime",
+            valid_type=orm.Bool,
+            default=lambda: orm.Bool(False),
+            required=False,
+        )
+        spec.input(
+            "walltime_safety_factor",
+            valid_type=orm.Float,
+            default=lambda: orm.Float(1.3),
+            required=False,
+            help="the predicted walltime is multiplied by this factor",
+        )
+        spec.input(
+            "max_walltime",
+            valid_type=orm.Int,
+            required=False,
+            help="upper limit of the predicted walltime in seconds",
+        )
+        spec.input(
+            "system_size",
+            valid_type=orm.Int,
+            required=False,
+            help="system size of the learned walltime rates, default: ncell times the atoms in posfile",
+        )
+        spec.input(
+            "convergence_monitor",
+            valid_type=orm.Dict,
+            required=False,
+            help="kwargs of the asd.convergence monitor (see UppASD_Monitors), the key minimum_poll_interval sets the polling interval in seconds",
+        )
         # the outline of the workflow
         spec.outline(
             # step 1 : process the input data
@@ -131,6 +202,12 @@ class UppASD_Baseworkflow(BaseRestartWorkChain):
         )
 
         spec.expose_outputs(cls._process_class)
+        spec.output(
+            "stitched_array",
+            valid_type=orm.ArrayData,
+            required=False,
+            help="the time series of all restarted calculations appended, with continuous iterations",
+        )
         # register the exit codes
         # spec.exit_code(451, "WallTimeError", message="Hit the max wall time")
 
@@ -139,7 +216,10 @@ class UppASD_Baseworkflow(BaseRestartWorkChain):
         # The wapper for the ASD calculation inputs:
         self.ctx.inputs = {
             "code": self.inputs.code,
-            "input_dict": self.inputs.input_dict,
+            # the canonical form of input_dict, so the same physics gives the same hash for caching
+            "input_dict": orm.Dict(
+                dict=canonicalize_input_dict(self.inputs.input_dict.get_dict())
+            ),
             "retrieve_and_parse_name_list": self.inputs.retrieve_and_parse_name_list,
             "metadata": {
                 "options": {
@@ -156,6 +236,160 @@ class UppASD_Baseworkflow(BaseRestartWorkChain):
                 "description": self.inputs.description.value,
             },
         }
+        # optional inputs of the ASD calculation
+        for name in [
+            "parser_options",
+            "compress_name_list",
+            "compress_format",
+            "input_files",
+            "shared_input_folder",
+            "shared_input_names",
+        ]:
+            if name in self.inputs:
+                self.ctx.inputs[name] = self.inputs[name]
+        # warm start from the restart file of another calculation (e.g. the neighbouring point of a sweep)
+        if "parent_folder" in self.inputs:
+            new_input_dict = self.ctx.inputs["input_dict"].get_dict()
+            new_input_dict["inpsd"]["Initmag"] = ["4"]
+            new_input_dict["inpsd"]["restartfile"] = ["restart"]
+            self.ctx.inputs["input_dict"] = orm.Dict(
+                dict=canonicalize_input_dict(new_input_dict)
+            )
+            self.ctx.inputs["parent_folder"] = self.inputs.parent_folder
+        if "convergence_monitor" in self.inputs:
+            monitor_kwargs = self.inputs.convergence_monitor.get_dict()
+            self.ctx.inputs["monitors"] = {
+                "convergence": orm.Dict(
+                    {
+                        "entry_point": "asd.convergence",
+                        "minimum_poll_interval": monitor_kwargs.pop(
+                            "minimum_poll_interval", 600
+                        ),
+                        "kwargs": monitor_kwargs,
+                    }
+                )
+            }
+
+        # steps (Nstep or mcNstep) that are left to run, for the adaptive walltime only. They are read from the
+        # canonical input_dict (every inpsd tag a list of tokens), not from the input as it was given.
+        self.ctx.remaining_steps = None
+        if self.inputs.adaptive_walltime.value:
+            inpsd = self.ctx.inputs["input_dict"]["inpsd"]
+            if self.inputs.autorestart_mode.value in inpsd:
+                self.ctx.remaining_steps = int(
+                    inpsd[self.inputs.autorestart_mode.value][0]
+                )
+            steps_per_second = self.get_learned_rate()
+            if steps_per_second is not None and self.ctx.remaining_steps is not None:
+                walltime = self.predict_walltime(
+                    self.ctx.remaining_steps, steps_per_second
+                )
+                self.ctx.inputs["metadata"]["options"][
+                    "max_wallclock_seconds"
+                ] = walltime
+                self.report(
+                    f"Initial walltime {walltime} s from the learned rate {steps_per_second:.3g} steps/s"
+                )
+
+    @staticmethod
+    def get_system_size(input_dict, input_files):
+        # the number of cells times the number of atoms in posfile (if it can be found)
+        inpsd = input_dict["inpsd"]
+        system_size = int(np.prod([int(i) for i in inpsd.get("ncell", ["1"])]))
+        if "posfile" in input_dict:
+            system_size = system_size * len(input_dict["posfile"])
+        elif "posfile" in input_files:
+            posfile = input_files["posfile"]
+            if isinstance(posfile, orm.ArrayData):
+                system_size = (
+                    system_size * posfile.get_shape(posfile.get_arraynames()[0])[0]
+                )
+        return system_size
+
+    def get_rate_key(self):
+        # The steps per second are learned for the same system size, mode and resources,
+        # the loop gives the system size if posfile is in the shared input files
+        input_dict = self.ctx.inputs["input_dict"].get_dict()
+        inpsd = input_dict["inpsd"]
+        if "system_size" in self.inputs:
+            system_size = self.inputs.system_size.value
+        else:
+            system_size = UppASD_Baseworkflow.get_system_size(
+                input_dict, self.inputs.get("input_files", {})
+            )
+        return {
+            "system_size": system_size,
+            "mode": " ".join(inpsd.get("mode", []))
+            + " "
+            + " ".join(inpsd.get("ip_mode", [])),
+            "autorestart_mode": self.inputs.autorestart_mode.value,
+            "num_machines": self.inputs.num_machines.value,
+            "num_mpiprocs_per_machine": self.inputs.num_mpiprocs_per_machine.value,
+        }
+
+    def get_learned_rate(self):
+        # mean steps per second of the finished workflows with the same rate key, in one query
+        filters = {
+            f"extras.walltime_rate.{key}": value
+            for key, value in self.get_rate_key().items()
+        }
+        qb = orm.QueryBuilder()
+        qb.append(
+            orm.WorkChainNode,
+            filters=filters,
+            project=["extras.walltime_rate.steps_per_second"],
+        )
+        rates = [rate for rate, in qb.iterall() if rate]
+        if not rates:
+            return None
+        return float(np.mean(rates))
+
+    def get_completed_steps(self, node):
+        # Steps done by one attempt: the iteration of its restart file if it is retrieved,
+        # otherwise the last iteration of its time series
+        if "output_array" not in node.outputs:
+            return None
+        output_array = node.outputs.output_array
+        array_names = output_array.get_arraynames()
+        if "restart" in array_names:
+            return int(output_array.get_array("restart")[0].tolist()[0])
+        last_iterations = []
+        for array_name in ["averages", "totenergy", "sknumber", "cumulants"]:
+            if array_name in array_names and output_array.get_shape(array_name)[0]:
+                last_iterations.append(
+                    int(output_array.get_array(array_name)[-1].tolist()[0])
+                )
+        if not last_iterations:
+            return None
+        return max(last_iterations)
+
+    def get_runtime(self, node):
+        # wall time used by one attempt, from the scheduler if it is known, otherwise its max_wallclock_seconds
+        job_info = node.get_last_job_info()
+        if job_info is not None and job_info.wallclock_time_seconds:
+            return job_info.wallclock_time_seconds
+        return node.get_option("max_wallclock_seconds")
+
+    def predict_walltime(self, steps, steps_per_second):
+        walltime = int(
+            np.ceil(steps / steps_per_second * self.inputs.walltime_safety_factor.value)
+        )
+        # at least one minute, and not more than max_walltime
+        walltime = max(walltime, 60)
+        if "max_walltime" in self.inputs:
+            walltime = min(walltime, self.inputs.max_walltime.value)
+        return walltime
+
+    def record_rate(self, node, steps):
+        # Store the steps per second of an attempt in the extras of this workflow, to learn the initial walltime
+        runtime = self.get_runtime(node)
+        if not steps or not runtime:
+            return None
+        steps_per_second = steps / runtime
+        walltime_rate = self.get_rate_key()
+        walltime_rate["steps_per_second"] = steps_per_second
+        self.node.base.extras.set("walltime_rate", walltime_rate)
+        return steps_per_second
 
     def results(self):
         # get the last calculation node
@@ -175,8 +409,80 @@ class UppASD_Baseworkflow(BaseRestartWorkChain):
 
         exposed_outputs = self.exposed_outputs(node, self._process_class)
         self.out_many(exposed_outputs)
+        if self.inputs.adaptive_walltime.value:
+            # a run stopped by the convergence monitor did less than the remaining steps
+            if node.base.extras.get("convergence_monitor", {}).get("converged"):
+                self.record_rate(node, self.get_completed_steps(node))
+            else:
+                self.record_rate(node, self.ctx.remaining_steps)
+        if self.ctx.iteration > 1:
+            stitched_array = self.stitch_segments()
+            if stitched_array is not None:
+                self.out("stitched_array", stitched_array)
         return None
 
+    def get_restart_iteration(self, segments, index):
+        # Iteration of the restart file that the segment after segments[index] started from, None if unknown.
+        # For the remote restart it is written by the next calculation, otherwise it is in the restart array (only its
+        # first row is read).
+        next_node = segments[index + 1]
+        file_name = self._process_class._restart_iteration_file_name
+        if "retrieved" in next_node.outputs:
+            retrieved = next_node.outputs.retrieved
+            if file_name in retrieved.base.repository.list_object_names():
+                content = retrieved.base.repository.get_object_content(file_name)
+                if content.strip():
+                    return int(content.split()[0])
+        if "output_array" not in segments[index].outputs:
+            return None
+        output_array = segments[index].outputs.output_array
+        if "restart" in output_array.get_arraynames():
+            for first_row in iter_array_blocks(output_array, "restart", 1):
+                return int(first_row[0].tolist()[0])
+        return None
+
+    def stitch_segments(self):
+        # Stitch the time series of all segments (the calculations of the walltime restarts) with the calcfunction
+        # stitch_arrays, so the stitched array has the output arrays of the segments as its inputs. None if there is
+        # nothing to stitch.
+        # The restart iteration of an attempt is found from the attempt right after it, before the failed attempts
+        # are dropped, so a dropped attempt does not shift the iterations of the ones after it.
+        children = self.ctx.children
+        restart_iterations = [
+            self.get_restart_iteration(children, index)
+            for index in range(len(children) - 1)
+        ] + [None]
+        segments = [
+            (child, restart_iteration)
+            for child, restart_iteration in zip(children, restart_iterations)
+            if "output_array" in child.outputs
+            and child.exit_status
+            in [0, self._process_class.exit_codes.WallTimeError.status]
+        ]
+
+        if "stitch_name_list" in self.inputs:
+            stitch_name_list = self.inputs.stitch_name_list
+        else:
+            stitch_name_list = orm.List(self._default_stitch_name_list)
+        array_names = {
+            name.rstrip("*").split(".")[0] for name in stitch_name_list.get_list()
+        }
+        if not any(
+            array_names.intersection(child.outputs.output_array.get_arraynames())
+            for child, _ in segments
+        ):
+            return None
+        return stitch_arrays(
+            restart_iterations=orm.List(
+                [restart_iteration for _, restart_iteration in segments]
+            ),
+            stitch_name_list=stitch_name_list,
+            **{
+                f"segment_{index}": child.outputs.output_array
+                for index, (child, _) in enumerate(segments)
+            },
+        )
+
     # Error handler
     @process_handler(
         priority=500,
@@ -193,56 +499,138 @@ class UppASD_Baseworkflow(BaseRestartWorkChain):
         # Get output_array using node pk
         previous_cal_pk = node.pk
 
-        qb = orm.QueryBuilder()
-        qb.append(orm.CalcJobNode, filters={"id": str(previous_cal_pk)}, tag="cal_node")
-        qb.append(orm.ArrayData, with_incoming="cal_node", tag="arrays")
-        all_array = qb.all()
-        for array in all_array:
-            for name in array[0].get_arraynames():
-                if name == "restart":
-                    restart_array = array[0].get_array(name)
-                    break
-        restart_list = []
-        head_of_restartfile = [
-            """################################################################################
-# File type: AiiDA-UppASD2 auto-restart file
-# Simulation type: AiiDA-UppASD2 workflow
-# Number of atoms:   According to main workflow
-# Number of ensembles:        According to main workflow
-################################################################################
-   #iterens   iatom           |Mom|             M_x             M_y             M_z"""
-        ]
-
-        restart_list.append(head_of_restartfile)
-        for i in restart_array:
-            i_list = i.tolist()
-            i_list[0] = int(i_list[0])
-            i_list[1] = int(i_list[1])
-            i_list[2] = int(i_list[2])
-            restart_list.append(i_list)
-
         # set Initmag 4 and write restartfile
         # since all stored nodes are immutable, we need to create a new dict and store it in the new input_dict
         new_input_dict = self.ctx.inputs["input_dict"].get_dict()
-        new_input_dict["inpsd"]["Initmag"] = "4"
-        new_input_dict["inpsd"]["restartfile"] = [
-            orm.Str(f"AiiDA_UppASD2_Walltime_restart_{self.ctx.iteration - 1}")
-        ]
-        new_input_dict[f"AiiDA_UppASD2_Walltime_restart_{self.ctx.iteration - 1}"] = (
-            restart_list
-        )
-        restart_steps = int(
-            new_input_dict["inpsd"][self.inputs.autorestart_mode.value][0]
-        ) - int(restart_array[0].tolist()[0])
-        new_input_dict["inpsd"][self.inputs.autorestart_mode.value] = [
-            str(restart_steps)
-        ]
-        self.ctx.inputs["input_dict"] = orm.Dict(dict=new_input_dict)
+        new_input_dict["inpsd"]["Initmag"] = ["4"]
+        new_input_dict["inpsd"]["restartfile"] = ["restart"]
 
-        self.ctx.inputs["metadata"]["options"][
-            "max_wallclock_seconds"
-        ] += self.inputs.walltime_increase.value
+        if self.inputs.remote_restart.value:
+            # The restart file is linked from the remote folder of the previous calculation and the steps that are
+            # left are computed on the cluster, nothing of the spin configuration goes through the database.
+            self.ctx.inputs["parent_folder"] = node.outputs.remote_folder
+            self.ctx.inputs["restart_step_tag"] = self.inputs.autorestart_mode
+        else:
+            # the restart file is written from the ArrayData, not linked from a parent folder of a warm start
+            self.ctx.inputs.pop("parent_folder", None)
+            qb = orm.QueryBuilder()
+            qb.append(
+                orm.CalcJobNode, filters={"id": str(previous_cal_pk)}, tag="cal_node"
+            )
+            qb.append(orm.ArrayData, with_incoming="cal_node", tag="arrays")
+            all_array = qb.all()
+            for array in all_array:
+                for name in array[0].get_arraynames():
+                    if name == "restart":
+                        restart_node = array[0]
+                        restart_array = array[0].get_array(name)
+                        break
+
+            # The restart table is not copied into the dict, the output ArrayData of the previous calculation is
+            # given as the input file 'restart' and written from its 'restart' array (with the restart header).
+            self.ctx.inputs["input_files"] = dict(
+                self.ctx.inputs.get("input_files", {})
+            )
+            self.ctx.inputs["input_files"]["restart"] = restart_node
+            restart_steps = int(
+                new_input_dict["inpsd"][self.inputs.autorestart_mode.value][0]
+            ) - int(restart_array[0].tolist()[0])
+            new_input_dict["inpsd"][self.inputs.autorestart_mode.value] = [
+                str(restart_steps)
+            ]
+        self.ctx.inputs["input_dict"] = orm.Dict(
+            dict=canonicalize_input_dict(new_input_dict)
+        )
+
+        # The walltime of the restart is predicted from the steps per second of the attempt that hit the walltime,
+        # if the steps it did are not known, walltime_increase is added.
+        completed_steps = self.get_completed_steps(node)
+        steps_per_second = None
+        if self.inputs.adaptive_walltime.value:
+            steps_per_second = self.record_rate(node, completed_steps)
+        if completed_steps is not None and self.ctx.remaining_steps is not None:
+            self.ctx.remaining_steps = max(
+                self.ctx.remaining_steps - completed_steps, 0
+            )
+        if steps_per_second and self.ctx.remaining_steps is not None:
+            self.ctx.inputs["metadata"]["options"][
+                "max_wallclock_seconds"
+            ] = self.predict_walltime(self.ctx.remaining_steps, steps_per_second)
+        else:
+            self.ctx.inputs["metadata"]["options"][
+                "max_wallclock_seconds"
+            ] += self.inputs.walltime_increase.value
         self.report(
             f"Restarting the ASD calculation with walltime {self.ctx.inputs['metadata']['options']['max_wallclock_seconds']}"
         )
         return ProcessHandlerReport(do_break=False)
+
+
+@calcfunction
+def stitch_arrays(restart_iterations, stitch_name_list, **segments):
+    # Append the time series of the segments (segment_<i>: the output_array of the i-th stitched attempt) into one
+    # ArrayData. The iterations of a segment are shifted by the iterations done before it, and the rows of a segment
+    # after its restart point (restart_iterations[i], the iteration the next segment started from, None if unknown)
+    # are dropped, since the next segment starts again from there.
+    # Every array is read once block by block from the repository and appended to an on-disk buffer, so at most one
+    # block of rows is in memory.
+    segments = [
+        (segments[f"segment_{index}"], restart_iteration)
+        for index, restart_iteration in enumerate(restart_iterations.get_list())
+    ]
+    block_rows = UppASD_Baseworkflow._stitch_block_rows
+    stitched_array = orm.ArrayData()
+    with tempfile.TemporaryDirectory() as buffer_folder:
+        for array_name in [
+            name.rstrip("*").split(".")[0] for name in stitch_name_list.get_list()
+        ]:
+            buffer_file_name = os.path.join(buffer_folder, array_name + ".raw")
+            n_rows = 0
+            offset = 0
+            dtype = None
+            with open(buffer_file_name, "wb") as buffer_file:
+                for output_array, restart_iteration in segments:
+                    last_iteration = 0
+                    if array_name not in output_array.get_arraynames():
+                        blocks = []
+                    else:
+                        blocks = iter_array_blocks(output_array, array_name, block_rows)
+                    for array in blocks:
+                        iter_name = array.dtype.names[0] if array.dtype.names else None
+                        iterations = array[iter_name] if iter_name else array[:, 0]
+                        if len(iterations):
+                            last_iteration = int(iterations[-1])
+                        if restart_iteration is not None:
+                            array = array[iterations < restart_iteration]
+                        else:
+                            array = array.copy()
+                        if iter_name:
+                            array[iter_name] += offset
+                        else:
+                            array[:, 0] += offset
+                        # all segments are appended in the layout (plain or typed) of the first one
+                        if dtype is None:
+                            dtype = array.dtype
+                        elif dtype.names is None:
+                            array = to_plain_array(array).astype(dtype)
+                        else:
+                            array = apply_schema(array_name, array).astype(dtype)
+                        n_rows = n_rows + array.shape[0]
+                        row_shape = array.shape[1:]
+                        array.tofile(buffer_file)
+                    # the next segment starts from the restart iteration of this one
+                    if restart_iteration is not None:
+                        offset = offset + restart_iteration
+                    else:
+                        offset = offset + last_iteration
+            if n_rows:
+                stitched_array.set_array(
+                    array_name,
+                    np.memmap(
+                        buffer_file_name,
+                        dtype=dtype,
+                        mode="r",
+                        shape=(n_rows,) + row_shape,
+                    ),
+                )
+    return stitched_array
@@ -8,6 +8,8 @@ Date: 2024-07-11
 # Please keep in mind to remove unnecessary modules in future versions.
 import os
 from aiida import orm
+from aiida_uppasd2.UppASD_Inputs import canonicalize_input_dict, write_table
+from aiida_uppasd2.UppASD_Data import UppASD_ChunkedArrayData
 from aiida.common import datastructures
 from aiida.engine import CalcJob
 from aiida.orm import (
@@ -30,6 +32,21 @@ from aiida.orm import (
 
 # Main class for UppASD calculations.
 class UppASD_Calculations(CalcJob):
+    # shell commands and file suffixes for compressing output files on the cluster after sd finishes
+    _compress_commands = {"gzip": "gzip -f {}", "zstd": "zstd -q -f --rm {}"}
+    _compress_suffixes = {"gzip": ".gz", "zstd": ".zst"}
+    _decompress_commands = {"gzip": "gzip -dc {}", "zstd": "zstd -q -dc {}"}
+    # header lines of input tables written from ArrayData, keyed by the array name
+    _input_file_headers = {
+        "restart": """################################################################################
+# File type: AiiDA-UppASD2 auto-restart file
+# Simulation type: AiiDA-UppASD2 workflow
+# Number of atoms:   According to main workflow
+# Number of ensembles:        According to main workflow
+################################################################################
+   #iterens   iatom           |Mom|             M_x             M_y             M_z"""
+    }
+
     @classmethod
     def define(cls, spec):
         super(UppASD_Calculations, cls).define(spec)
@@ -47,6 +64,62 @@ class UppASD_Calculations(CalcJob):
             required=True,
             help="list of files to parse and retrieve from the remote folder",
         )
+        # large input tables as nodes instead of nested lists in input_dict, the key is the file name in the sandbox
+        spec.input_namespace(
+            "input_files",
+            valid_type=(ArrayData, SinglefileData),
+            required=False,
+            dynamic=True,
+            help="input files (jij, dmdata, momfile, restart, ...) as SinglefileData or ArrayData, see UppASD_Inputs",
+        )
+        # optional settings for the parser, e.g. which files are parsed in the streaming mode
+        spec.input(
+            "parser_options",
+            valid_type=Dict,
+            required=False,
+            validator=cls._validate_parser_options,
+            help="dict of options for asd_parsers, see UppASD_Parsers.default_parser_options",
+        )
+        # optional remote compression of large output files, they should also be in retrieve_and_parse_name_list
+        spec.input(
+            "compress_name_list",
+            valid_type=List,
+            required=False,
+            help="list of files to compress on the cluster before retrieving, they are decompressed by the parser and not stored as files",
+        )
+        spec.input(
+            "compress_format",
+            valid_type=Str,
+            required=False,
+            validator=cls._validate_compress_format,
+            help="gzip (default) or zstd, zstd needs the zstd command on the cluster and the zstandard python package",
+        )
+        # restart from the restart file of a previous calculation on the same computer, without retrieving it
+        spec.input(
+            "parent_folder",
+            valid_type=RemoteData,
+            required=False,
+            help="remote folder of a previous UppASD calculation, its restart.<simid>.out is linked as 'restart'",
+        )
+        spec.input(
+            "restart_step_tag",
+            valid_type=Str,
+            required=False,
+            help="Nstep or mcNstep, if given the steps left after the restart file of parent_folder are computed on the cluster",
+        )
+        # input files that are the same for many calculations, uploaded once into a remote folder and linked
+        spec.input(
+            "shared_input_folder",
+            valid_type=RemoteData,
+            required=False,
+            help="remote folder with input files shared by many calculations, e.g. staged by GenericLoopWorkflow",
+        )
+        spec.input(
+            "shared_input_names",
+            valid_type=List,
+            required=False,
+            help="names of the files in shared_input_folder that are linked into the working directory",
+        )
         # output sections:
         spec.output(
             "output_array",
@@ -54,15 +127,79 @@ class UppASD_Calculations(CalcJob):
             help="the output arrays of a single UppASD calculation, it includes all request files (parsed into np arrays) in the retrieve_list_name",
             required=True,
         )
+        spec.output(
+            "chunked_array",
+            valid_type=UppASD_ChunkedArrayData,
+            help="the files of the parser option chunked_name_list (e.g. moment, trajectory) in compressed chunks that can be sliced without loading the whole array",
+            required=False,
+        )
+        spec.output(
+            "observables",
+            valid_type=Dict,
+            help="the mean and std over the tail of the files of the parser option summary_name_list, see UppASD_Results",
+            required=False,
+        )
 
-        spec.exit_code(451, "WallTimeError", message="Hit the max wall time")
+        # calculations that failed should not be reused when caching is enabled
+        spec.exit_code(
+            451,
+            "WallTimeError",
+            message="Hit the max wall time",
+            invalidates_cache=True,
+        )
+        spec.exit_code(
+            452,
+            "ParsingError",
+            message="Failed to parse one or more of the requested output files",
+            invalidates_cache=True,
+        )
 
-    def prepare_for_submission(self, folder):
+    @classmethod
+    def _validate_compress_format(cls, value, _):
+        if value is not None and value.value not in cls._compress_commands:
+            return f"compress_format should be one of {list(cls._compress_commands)}"
 
-        calcinfo = datastructures.CalcInfo()
+    @classmethod
+    def _validate_parser_options(cls, value, _):
+        # the restarts of the base workflow and 'verdi data asd retrieve_restart_file' read the restart array from
+        # output_array, it can not be moved into the chunked_array
+        if value is None:
+            return None
+        for name in value.get_dict().get("chunked_name_list", []):
+            if name.rstrip("*").split(".")[0] == "restart":
+                return "restart can not be in the parser option chunked_name_list, it is read from output_array by the restarts"
+        return None
 
-        # let's firstly dispatch the input dict into sveral input file in the sandbox
-        uppasd_aiida2_input_dict = self.inputs.input_dict.get_dict()
+    # Shell lines for the remote restart: the iteration of the linked restart file is written to a small file, which
+    # is retrieved (it is used to stitch the time series of the restarts in the base workflow). With restart_step_tag
+    # the tag (Nstep or mcNstep) in inpsd.dat is set to the steps of the parent calculation minus this iteration.
+    _restart_iteration_file_name = "restart_iteration.txt"
+    _remote_restart_decompress_text = """# the restart file of the parent calculation is compressed if it finished before the walltime
+if [ -e {file_name} ]; then rm -f restart && {command} > restart; fi"""
+    _remote_restart_text = """# AiiDA-UppASD2 remote restart
+restart_iteration=$(awk '!/^[[:space:]]*#/ {{print $1; exit}}' restart)
+echo $restart_iteration > {file_name}"""
+    _remote_restart_steps_text = """# run the steps that are left after the restart file of the parent calculation
+parent_steps=$(awk '$1 == "{tag}" {{print $2}}' parent_inpsd.dat)
+awk -v steps=$((parent_steps - restart_iteration)) '$1 == "{tag}" {{$2 = steps}} {{print}}' inpsd.dat > inpsd.dat.tmp && mv inpsd.dat.tmp inpsd.dat"""
+
+    @classmethod
+    def get_compress_format(cls, node, file_name, simid):
+        # compress_format of a calculation if it compresses file_name on the cluster, None otherwise
+        if node is None or "compress_name_list" not in node.inputs:
+            return None
+        compressed_names = [
+            name[:-1] + "." + simid + ".out" if name[-1] == "*" else name
+            for name in node.inputs.compress_name_list.get_list()
+        ]
+        if file_name not in compressed_names:
+            return None
+        if "compress_format" in node.inputs:
+            return node.inputs.compress_format.value
+        return "gzip"
+
+    @classmethod
+    def write_input_dict(cls, folder, uppasd_aiida2_input_dict):
         # in the input dict, we assume the keys represent the file name and the value is file content.
         input_file_name_list = uppasd_aiida2_input_dict.keys()
         for file_name in input_file_name_list:
@@ -87,10 +224,153 @@ class UppASD_Calculations(CalcJob):
                             line = " ".join(map(str, sublist))
                             file.write(line + "\n")
 
-        # calcinfo.local_copy_list = []
+    @classmethod
+    def write_input_nodes(cls, folder, input_files, target_folder=None):
+        # Input tables given as nodes: SinglefileData are copied as they are, ArrayData are written in one go.
+        # An ArrayData is written from the array with the same name as the file, otherwise from its only array.
+        # Returns the local_copy_list, target_folder is the path of folder in the sandbox (for the packed calculations).
+        local_copy_list = []
+        for file_name, file_node in input_files.items():
+            if isinstance(file_node, SinglefileData):
+                local_copy_list.append(
+                    (
+                        file_node.uuid,
+                        file_node.filename,
+                        (
+                            file_name
+                            if target_folder is None
+                            else os.path.join(target_folder, file_name)
+                        ),
+                    )
+                )
+            else:
+                array_names = file_node.get_arraynames()
+                array_name = file_name if file_name in array_names else array_names[0]
+                with folder.open(file_name, "w") as file:
+                    write_table(
+                        file,
+                        file_node.get_array(array_name),
+                        cls._input_file_headers.get(array_name),
+                    )
+        return local_copy_list
+
+    @classmethod
+    def get_shared_input_symlinks(cls, inputs, target_folder=None):
+        # remote_symlink_list entries of the shared input files, nothing is uploaded for them
+        if "shared_input_folder" not in inputs:
+            return []
+        shared_input_folder = inputs.shared_input_folder
+        return [
+            (
+                shared_input_folder.computer.uuid,
+                os.path.join(shared_input_folder.get_remote_path(), file_name),
+                (
+                    file_name
+                    if target_folder is None
+                    else os.path.join(target_folder, file_name)
+                ),
+            )
+            for file_name in inputs.shared_input_names.get_list()
+        ]
+
+    def prepare_for_submission(self, folder):
+        calcinfo = datastructures.CalcInfo()
+
+        # let's firstly dispatch the input dict into sveral input file in the sandbox
+        # the canonical form has every inpsd tag as a list of tokens (see UppASD_Inputs), also for dicts not made by the workflows
+        uppasd_aiida2_input_dict = canonicalize_input_dict(
+            self.inputs.input_dict.get_dict()
+        )
+        self.write_input_dict(folder, uppasd_aiida2_input_dict)
+        calcinfo.local_copy_list = self.write_input_nodes(
+            folder, self.inputs.get("input_files", {})
+        )
+
+        # The restart file of parent_folder is linked on the cluster, so the cost of a restart does not depend on the
+        # system size. inpsd.dat of the parent is linked as well for the number of steps left.
+        # If the parent compresses the restart file (compress_name_list) and finished, only the compressed file is
+        # left; it is linked as well and decompressed into the working directory before sd starts.
+        calcinfo.remote_symlink_list = self.get_shared_input_symlinks(self.inputs)
+        if "parent_folder" in self.inputs:
+            parent_folder = self.inputs.parent_folder
+            simid = uppasd_aiida2_input_dict["inpsd"]["simid"][0]
+            restart_name = f"restart.{simid}.out"
+            remote_names = [
+                (restart_name, "restart"),
+                ("inpsd.dat", "parent_inpsd.dat"),
+            ]
+            prepend_texts = []
+            compress_format = self.get_compress_format(
+                parent_folder.creator, restart_name, simid
+            )
+            if compress_format is not None:
+                suffix = self._compress_suffixes[compress_format]
+                remote_names.append((restart_name + suffix, "parent_restart" + suffix))
+                prepend_texts.append(
+                    self._remote_restart_decompress_text.format(
+                        file_name="parent_restart" + suffix,
+                        command=self._decompress_commands[compress_format].format(
+                            "parent_restart" + suffix
+                        ),
+                    )
+                )
+            for remote_name, file_name in remote_names:
+                calcinfo.remote_symlink_list.append(
+                    (
+                        parent_folder.computer.uuid,
+                        os.path.join(parent_folder.get_remote_path(), remote_name),
+                        file_name,
+                    )
+                )
+            prepend_texts.append(
+                self._remote_restart_text.format(
+                    file_name=self._restart_iteration_file_name
+                )
+            )
+            if "restart_step_tag" in self.inputs:
+                prepend_texts.append(
+                    self._remote_restart_steps_text.format(
+                        tag=self.inputs.restart_step_tag.value
+                    )
+                )
+            calcinfo.prepend_text = "\n".join(prepend_texts)
+
         codeinfo = datastructures.CodeInfo()
         # codeinfo.cmdline_params = []
         codeinfo.code_uuid = self.inputs.code.uuid
         calcinfo.codes_info = [codeinfo]
         calcinfo.retrieve_list = self.inputs.retrieve_and_parse_name_list.get_list()
+        if "parent_folder" in self.inputs:
+            calcinfo.retrieve_list.append(self._restart_iteration_file_name)
+
+        # Files in compress_name_list are compressed on the cluster after sd finishes and copied back in the temporary
+        # retrieve list, so only the compressed file goes over ssh and only the parsed arrays are stored.
+        # The uncompressed name is also in the list, in case sd did not finish and the compression did not run.
+        if "compress_name_list" in self.inputs:
+            compress_format = (
+                self.inputs.compress_format.value
+                if "compress_format" in self.inputs
+                else "gzip"
+            )
+            compress_commands = []
+            calcinfo.retrieve_temporary_list = []
+            for name in self.inputs.compress_name_list.get_list():
+                if name in calcinfo.retrieve_list:
+                    calcinfo.retrieve_list.remove(name)
+                file_name = name
+                if name[-1] == "*":
+                    file_name = (
+                        name[:-1]
+                        + "."
+                        + uppasd_aiida2_input_dict["inpsd"]["simid"][0]
+                        + ".out"
+                    )
+                compress_commands.append(
+                    self._compress_commands[compress_format].format(file_name)
+                )
+                calcinfo.retrieve_temporary_list.append(
+                    file_name + self._compress_suffixes[compress_format]
+                )
+                calcinfo.retrieve_temporary_list.append(file_name)
+            calcinfo.append_text = "\n".join(compress_commands)
         return calcinfo
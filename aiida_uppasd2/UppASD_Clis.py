@@ -2,7 +2,23 @@ import pandas as pd
 import click
 import pickle
 import os
+import io
+import gzip
+import contextlib
+import concurrent.futures
+import numpy as np
+from tabulate import tabulate
 from aiida import orm
+from aiida_uppasd2.UppASD_Schemas import to_plain_array
+from aiida_uppasd2.UppASD_Inputs import (
+    write_table,
+    read_inpsd,
+    read_table,
+    table_to_list,
+    save_input_bundle,
+)
+from aiida_uppasd2.UppASD_Results import collect_observables, results_to_arrays
+from aiida_uppasd2.UppASD_ArrayCache import get_cached_array, iter_npy_blocks
 
 
 @click.group()
@@ -12,103 +28,434 @@ def asd():
 
 @asd.command("uppasd_raw_input_parser")
 @click.argument("inputs", nargs=-1)
-def uppasd_raw_input_parser(inputs):
+@click.option(
+    "-f",
+    "--format",
+    "output_format",
+    type=click.Choice(["pkl", "npz"]),
+    default="pkl",
+    help="pkl: uppasd_aiida2_input.pkl with nested lists (default), npz: input bundle uppasd_aiida2_input.npz/.json (see UppASD_Inputs).",
+)
+def uppasd_raw_input_parser(inputs, output_format):
     """
     One example is: verdi data asd uppasd_raw_input_parser inpsd.dat momfile jij dmdata qfile posfile
 
+    The tables are read in one pass into arrays and written to uppasd_aiida2_input.pkl (as in the examples, load it
+    with pickle and split_input_dict). With -f npz they are written to uppasd_aiida2_input.npz and the inpsd tags to
+    uppasd_aiida2_input.json instead, load them with: input_dict, input_files = load_input_bundle("./uppasd_aiida2_input")
+    and use them as builder.input_dict = orm.Dict(dict=input_dict) and builder.input_files = input_files.
+
     Note that we now can only translate clear version of inpsd.dat
     Our user need to remove commonts that without sign (a new line that start with #),i.e.,BC  P P P              Boundary conditions (0=vacuum,P=periodic)
-    We also request one tage occupy only one line, e.g, cell       1.00000  0.00000   0.00000  0.00000   1.00000   0.00000  0.00000   0.00000   1.00000
-
+    Multi line tags (e.g. ip_mcanneal followed by its lines) are kept together, their lines must start with a number.
     """
-    uppasd_input_dict = {}
+    inpsd_dict = {}
+    tables = {}
     for file_name in inputs:
-        if file_name == "inpsd.dat":
-            inpsd_dict = {}
-            with open("inpsd.dat") as file:
-                inpsd_file = file.readlines()
-
-            for line_number in range(len(inpsd_file)):
-                if (
-                    inpsd_file[line_number][0] != " "
-                    and inpsd_file[line_number][0] != "\n"
-                    and inpsd_file[line_number][0] != "#"
-                ):
-                    inpsd_dict[inpsd_file[line_number].split()[0]] = inpsd_file[
-                        line_number
-                    ].split()[1:]
-            uppasd_input_dict["inpsd"] = inpsd_dict
-
+        if os.path.basename(file_name) == "inpsd.dat":
+            inpsd_dict = read_inpsd(file_name)
         else:
-            with open(file_name) as file:
-                file_cont = file.readlines()
-                for i in range(len(file_cont)):
-                    if file_cont[i].lstrip()[0] != "#":
-                        skiplines = i
-                        break
-            df = pd.read_csv(file_name, sep="\s+", header=None, skiprows=skiplines)
-            uppasd_input_dict[file_name] = [*map(list, zip(*map(df.get, df)))]
-    with open("./uppasd_aiida2_input.pkl", "wb") as f:
-        pickle.dump(uppasd_input_dict, f)
-
+            tables[os.path.basename(file_name)] = read_table(file_name)
+    if output_format == "npz":
+        save_input_bundle("./uppasd_aiida2_input", inpsd_dict, tables)
+    else:
+        uppasd_input_dict = {"inpsd": inpsd_dict}
+        for file_name, table in tables.items():
+            uppasd_input_dict[file_name] = table_to_list(table)
+        with open("./uppasd_aiida2_input.pkl", "wb") as f:
+            pickle.dump(uppasd_input_dict, f)
 
-@asd.command("retrieve_restart_file")
-@click.argument("pk", nargs=-1)
-def retrieve_restart_file(pk):
-    """
-    One example is: verdi data asd retrieve_restart_file 2854
 
-    Here 2854 is one PK for a baseworkflow or a calculation
-    """
-    head_of_restartfile = """################################################################################
+head_of_restartfile = """################################################################################
 # File type: AiiDA-UppASD2 cli retrived restart file
 # Simulation type: AiiDA-UppASD2 workflow
 # Number of atoms:   According to main workflow
 # Number of ensembles:        According to main workflow
 ################################################################################
-   #iterens   iatom           |Mom|             M_x             M_y             M_z
-"""
+   #iterens   iatom           |Mom|             M_x             M_y             M_z"""
 
-    cal_node_pk = pk[0]
-    qb = orm.QueryBuilder()
+_restart_compress_suffixes = {"none": "", "gzip": ".gz", "zstd": ".zst"}
 
-    # Identify the node type:
-    node = orm.load_node(cal_node_pk)
-    if node.node_type == "process.calculation.calcjob.CalcJobNode.":
-        qb.append(orm.CalcJobNode, filters={"id": str(cal_node_pk)}, tag="cal_node")
-    elif node.node_type == "process.workflow.workchain.WorkChainNode.":
-        qb.append(orm.WorkChainNode, filters={"id": str(cal_node_pk)}, tag="cal_node")
-    else:
-        raise ValueError("The input node type is not supported")
-
-    qb.append(orm.ArrayData, with_incoming="cal_node", tag="arrays")
-    all_array = qb.all()
-    array_name = all_array[0][0].get_arraynames()
-    if "restart" in array_name:
-        restart_moment = all_array[0][0].get_array("restart")
-        restart_moment_pd = pd.DataFrame(restart_moment)
-        # Set column 0 1 2 to int
-        restart_moment_pd[0] = restart_moment_pd[0].astype(int)
-        restart_moment_pd[1] = restart_moment_pd[1].astype(int)
-        restart_moment_pd[2] = restart_moment_pd[2].astype(int)
-        # check if the restart file is existed or not, if exist, remove it first
+
+def open_restart_output(path, compress):
+    # text handle of an output file, compressed while it is written
+    if compress == "gzip":
+        return gzip.open(path, "wt")
+    if compress == "zstd":
         try:
-            os.remove("./restart.PK_{}.out".format(cal_node_pk))
-        except:
-            pass
-
-        # Save_to_csv
-        restart_moment_pd.to_csv(
-            "./restart.PK_{}.out".format(cal_node_pk),
-            index=False,
-            header=False,
-            sep=" ",
+            import zstandard
+        except ImportError as exception:
+            raise click.ClickException(
+                "zstandard is needed for zstd compression, pip install aiida-uppasd2[zstd]"
+            ) from exception
+        return io.TextIOWrapper(
+            zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+        )
+    return open(path, "w")
+
+
+def write_restart_file(source, path, compress, block_rows):
+    # One pass: the header first and then the rows block by block, source is an open .npy handle or an array
+    if isinstance(source, np.ndarray):
+        blocks = (
+            source[start : start + block_rows]
+            for start in range(0, max(source.shape[0], 1), block_rows)
+        )
+    else:
+        blocks = iter_npy_blocks(source, block_rows)
+    with open_restart_output(path, compress) as handle:
+        header = head_of_restartfile
+        for block in blocks:
+            # %.15g writes the iteration, ensemble and atom columns as ints
+            write_table(handle, to_plain_array(block), header)
+            header = None
+        if header is not None:
+            handle.write(header + "\n")
+    return path
+
+
+@asd.command("retrieve_restart_file")
+@click.argument("pk", nargs=-1)
+@click.option(
+    "-g",
+    "--group",
+    "group_label",
+    default=None,
+    help="Label of a group of calculations or workflows.",
+)
+@click.option(
+    "-o",
+    "--output-folder",
+    "output_folder",
+    default=".",
+    help="Folder of the restart files, default: the current folder.",
+)
+@click.option(
+    "-c",
+    "--compress",
+    type=click.Choice(list(_restart_compress_suffixes)),
+    default="none",
+    help="Compress the restart files while they are written.",
+)
+@click.option(
+    "-j",
+    "--workers",
+    type=int,
+    default=4,
+    help="Number of restart files written at the same time.",
+)
+@click.option(
+    "--block-rows",
+    type=int,
+    default=100000,
+    help="Number of rows read and written at a time.",
+)
+@click.option(
+    "--cache",
+    is_flag=True,
+    default=False,
+    help="Read the restart array through the local array cache, see UppASD_ArrayCache.",
+)
+def retrieve_restart_file(
+    pk, group_label, output_folder, compress, workers, block_rows, cache
+):
+    """
+    One example is: verdi data asd retrieve_restart_file 2854 2855 -c gzip -j 8
+
+    Here 2854 and 2855 are PKs of calculations, baseworkflows, packed calculations or loop workflows (all finished
+    points of the loop are exported). Use -g GROUP_LABEL to export a group. The restart array of every node is written
+    to restart.PK_<pk>.out (restart.PK_<pk>_<member>.out for packed calculations) in one streaming pass.
+    """
+    node_pks = [int(i) for i in pk]
+    if group_label is not None:
+        node_pks += [node.pk for node in orm.load_group(group_label).nodes]
+    if not node_pks:
+        raise click.UsageError("Give at least one PK or a group")
+
+    # the points of the loop workflows, with one query
+    qb = orm.QueryBuilder()
+    qb.append(
+        orm.WorkflowNode, filters={"id": {"in": node_pks}}, project=["id"], tag="loop"
+    )
+    qb.append(
+        orm.Dict,
+        with_incoming="loop",
+        edge_filters={"label": "loop_dict_output_pk"},
+        project=["attributes"],
+    )
+    loop_pks = set()
+    for loop_pk, loop_dict_output_pk in qb.iterall():
+        loop_pks.add(loop_pk)
+        node_pks += list(loop_dict_output_pk.values())
+    node_pks = sorted(set(node_pks))
+
+    # the output arrays with a restart array of all nodes, with one query
+    qb = orm.QueryBuilder()
+    qb.append(
+        orm.ProcessNode, filters={"id": {"in": node_pks}}, project=["id"], tag="node"
+    )
+    qb.append(
+        orm.ArrayData,
+        with_incoming="node",
+        edge_filters={"label": {"like": "output_array%"}},
+        filters={"attributes": {"has_key": "array|restart"}},
+        edge_project=["label"],
+        project=["*"],
+    )
+    exports = []
+    exported_pks = set()
+    for node_pk, array_node, label in qb.iterall():
+        # output_arrays__<member> of packed calculations
+        suffix = "" if label == "output_array" else "_" + label.split("__", 1)[1]
+        file_name = "restart.PK_{}{}.out{}".format(
+            node_pk, suffix, _restart_compress_suffixes[compress]
+        )
+        exports.append((array_node, os.path.join(output_folder, file_name)))
+        exported_pks.add(node_pk)
+    missing_pks = set(node_pks) - exported_pks - loop_pks
+    if missing_pks:
+        click.echo(f"No restart array found for the nodes {sorted(missing_pks)}")
+    if not exports:
+        raise click.ClickException("The restart array is not found in the given nodes")
+    os.makedirs(output_folder, exist_ok=True)
+
+    # The repository handles are opened in the main thread and the workers only read and write, at most
+    # 2 * workers files are open at the same time
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        running = {}
+        for array_node, path in exports:
+            if len(running) >= 2 * workers:
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    running.pop(future).close()
+                    click.echo(f"Written {future.result()}")
+            stack = contextlib.ExitStack()
+            if cache:
+                source = get_cached_array(array_node, "restart")
+            else:
+                source = stack.enter_context(
+                    array_node.base.repository.open("restart.npy", mode="rb")
+                )
+            future = executor.submit(
+                write_restart_file, source, path, compress, block_rows
+            )
+            running[future] = stack
+        for future in concurrent.futures.as_completed(running):
+            running[future].close()
+            click.echo(f"Written {future.result()}")
+
+
+@asd.command("parser_report")
+@click.argument("pk", nargs=-1)
+@click.option(
+    "-g",
+    "--group",
+    "group_label",
+    default=None,
+    help="Label of a group of calculations or workflows.",
+)
+def parser_report(pk, group_label):
+    """
+    One example is: verdi data asd parser_report 2854
+
+    Here 2854 is one PK for a calculation, a baseworkflow or a loop workflow, the parser statistics of all
+    calculations in it are aggregated per output file type. Use -g GROUP_LABEL to aggregate over a group.
+    """
+    node_pks = [int(i) for i in pk]
+    if group_label is not None:
+        node_pks += [node.pk for node in orm.load_group(group_label).nodes]
+    if not node_pks:
+        raise click.UsageError("Give at least one PK or a group")
+
+    # the workflows and their sub workflows, one query per level of the call tree (with_ancestors only follows the
+    # input and create links and not the call links)
+    workflow_pks = set(node_pks)
+    called_pks = set(node_pks)
+    while called_pks:
+        qb = orm.QueryBuilder()
+        qb.append(
+            orm.WorkflowNode, filters={"id": {"in": list(called_pks)}}, tag="node"
         )
-        # Adding head of restartfile
-        with open("./restart.PK_{}.out".format(cal_node_pk), "r+") as f:
-            original = f.read()
-            f.seek(0)
-            f.write("{}".format(head_of_restartfile))
-            f.write(original)
+        qb.append(orm.WorkflowNode, with_incoming="node", project=["id"])
+        called_pks = set(qb.all(flat=True)) - workflow_pks
+        workflow_pks |= called_pks
+
+    # one query for the calculations given directly and one for the calculations called by the workflows
+    all_statistics = {}
+    for node_class, pks, relationship in [
+        (orm.CalcJobNode, node_pks, None),
+        (orm.WorkflowNode, list(workflow_pks), "with_incoming"),
+    ]:
+        qb = orm.QueryBuilder()
+        qb.append(node_class, filters={"id": {"in": pks}}, tag="node")
+        calc_filters = {"extras": {"has_key": "parser_statistics"}}
+        projections = ["id", "extras.parser_statistics"]
+        if relationship is None:
+            qb.add_filter("node", calc_filters)
+            qb.add_projection("node", projections)
+        else:
+            qb.append(
+                orm.CalcJobNode,
+                filters=calc_filters,
+                project=projections,
+                **{relationship: "node"},
+            )
+        for calc_pk, statistics in qb.iterall():
+            all_statistics[calc_pk] = statistics
+
+    if not all_statistics:
+        raise click.ClickException("No parser statistics found for the given nodes")
+
+    # aggregate per output file type, e.g. restart.xxx.out -> restart (also pack_<label>/restart.xxx.out of packed calculations)
+    file_types = {}
+    for statistics in all_statistics.values():
+        for filename, file_statistics in statistics["files"].items():
+            file_type = file_types.setdefault(
+                os.path.basename(filename).split(".")[0],
+                {
+                    "files": 0,
+                    "bytes": 0,
+                    "rows": 0,
+                    "time": 0.0,
+                    "max_time": 0.0,
+                    "peak": None,
+                },
+            )
+            file_type["files"] += 1
+            file_type["bytes"] += file_statistics["bytes"] or 0
+            file_type["rows"] += file_statistics["rows"]
+            file_type["time"] += file_statistics["parse_time"]
+            file_type["max_time"] = max(
+                file_type["max_time"], file_statistics["parse_time"]
+            )
+            if file_statistics.get("peak_memory") is not None:
+                file_type["peak"] = max(
+                    file_type["peak"] or 0, file_statistics["peak_memory"]
+                )
+
+    table = []
+    for name, file_type in sorted(
+        file_types.items(), key=lambda item: -item[1]["time"]
+    ):
+        table.append(
+            [
+                name,
+                file_type["files"],
+                f"{file_type['bytes'] / 1024**2:.1f}",
+                file_type["rows"],
+                f"{file_type['time']:.2f}",
+                f"{file_type['time'] / file_type['files']:.3f}",
+                f"{file_type['max_time']:.3f}",
+                (
+                    "-"
+                    if file_type["peak"] is None
+                    else f"{file_type['peak'] / 1024**2:.1f}"
+                ),
+            ]
+        )
+    click.echo(
+        tabulate(
+            table,
+            headers=[
+                "file",
+                "count",
+                "MB read",
+                "rows",
+                "time [s]",
+                "mean [s]",
+                "max [s]",
+                "peak [MB]",
+            ],
+            disable_numparse=True,
+        )
+    )
+    total_time = sum(statistics["total_time"] for statistics in all_statistics.values())
+    set_array_time = sum(
+        statistics["set_array_time"] for statistics in all_statistics.values()
+    )
+    click.echo(
+        f"\n{len(all_statistics)} calculations, total parser time {total_time:.2f} s, "
+        f"of which {set_array_time:.2f} s for putting the arrays into ArrayData"
+    )
+
+
+@asd.command("loop_results")
+@click.argument("pk", nargs=1, type=int)
+@click.option(
+    "-o",
+    "--output",
+    "output_file",
+    default=None,
+    help="Output file, .csv (default: loop_results.PK_<pk>.csv) or .parquet.",
+)
+def loop_results(pk, output_file):
+    """
+    One example is: verdi data asd loop_results 2854 -o phase_diagram.csv
+
+    Here 2854 is the PK of a loop workflow, one row per finished point with the swept values and the tail mean/std of
+    the observables, see UppASD_Results. Loop workflows without the loop_results output are collected with one query.
+    """
+    node = orm.load_node(pk)
+    if "loop_results" in node.outputs:
+        arrays = {
+            array_name: node.outputs.loop_results.get_array(array_name)
+            for array_name in node.outputs.loop_results.get_arraynames()
+        }
+    elif "loop_dict_output_pk" in node.outputs:
+        keys = list(node.inputs.loop_dict_input.get_dict().keys())
+        tags = {
+            point_pk: tag
+            for tag, point_pk in node.outputs.loop_dict_output_pk.get_dict().items()
+        }
+        # the swept values from the input_dict of the sub workflows, a key is a file or an inpsd tag
+        qb = orm.QueryBuilder()
+        qb.append(
+            orm.WorkflowNode,
+            filters={"id": {"in": list(tags)}},
+            project=["id"],
+            tag="workflow",
+        )
+        qb.append(
+            orm.Dict,
+            with_outgoing="workflow",
+            edge_filters={"label": "input_dict"},
+            project=[f"attributes.inpsd.{key}" for key in keys]
+            + [f"attributes.{key}" for key in keys],
+        )
+        points = []
+        for point_pk, *values in qb.iterall():
+            combination = [
+                inpsd_value if inpsd_value is not None else file_value
+                for inpsd_value, file_value in zip(
+                    values[: len(keys)], values[len(keys) :]
+                )
+            ]
+            points.append((tags[point_pk], combination, point_pk, None))
+        if len(points) < len(tags):
+            click.echo(
+                f"{len(tags) - len(points)} points are not sub workflows (packed calculations) and are skipped"
+            )
+        arrays = results_to_arrays(keys, points, collect_observables(list(tags)))
+    else:
+        raise click.ClickException("The given node is not a finished loop workflow")
+
+    # one column per column of the arrays, e.g. parameter_hfield_2, averages_mean_4
+    columns = {}
+    for array_name, array in arrays.items():
+        if array.ndim == 1:
+            columns[array_name] = array
+        elif array.shape[1] == 1:
+            columns[array_name] = array[:, 0]
+        else:
+            for column in range(array.shape[1]):
+                columns[f"{array_name}_{column}"] = array[:, column]
+    results = pd.DataFrame(columns)
+    if output_file is None:
+        output_file = "./loop_results.PK_{}.csv".format(pk)
+    if output_file.endswith(".parquet"):
+        results.to_parquet(output_file, index=False)
     else:
-        raise ValueError("The restart array is not found in the given node")
+        results.to_csv(output_file, index=False)
+    click.echo(f"{len(results)} points written to {output_file}")
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Data types of aiida-uppasd2.
+
+UppASD_ChunkedArrayData (entry point asd_chunked_array) stores large tables, e.g. the moment and trajectory files of
+long runs, as compressed chunks of rows instead of one .npy file, so parts of an array can be read without loading
+(and decompressing) the rest. Every chunk is a .npz file <array name>/chunk_<index>.npz in the repository of the node.
+
+For the tables with one block of rows per time step (the columns iteration, ensemble and atom first, as in moment and
+restart) the layout (rows per step, number of ensembles and atoms) is found from the iteration column when the array
+is set, and the chunks are whole steps:
+
+chunked = calc.outputs.chunked_array
+chunked.get_shape("moment")                                  (rows, columns) as in ArrayData
+chunked.get_rows("moment", 0, 3600)                          only the chunks of these rows are read
+chunked.get_steps("moment", steps=-1)                        last snapshot, shape (n_ens, n_atoms, n_cols)
+chunked.get_steps("moment", steps=slice(0, 100, 10), ensembles=0, atoms=slice(0, 50))
+
+The parser writes the files of the parser option "chunked_name_list" into the output chunked_array, see
+UppASD_Parsers.
+"""
+import io
+import numpy as np
+from aiida import orm
+from aiida_uppasd2.UppASD_Schemas import to_plain_array
+
+# the uncompressed size of one chunk
+_default_chunk_bytes = 16 * 1024**2
+# rows that are read at a time when the time step layout is found
+_layout_scan_rows = 1024**2
+
+
+def get_step_layout(array):
+    # rows per time step, ensembles and atoms of a table with the columns iteration, ensemble and atom first,
+    # None if the table is not made of equal blocks of rows per step. The whole iteration column is scanned block by
+    # block, a step can be longer than a block (e.g. 10^6 atoms and 2 ensembles).
+    if array.ndim < 1 or array.shape[0] == 0:
+        return None
+    n_rows = array.shape[0]
+    # the rows where the iteration changes and the ensembles of the first step
+    change_rows = []
+    ensembles = set()
+    previous = None
+    for start in range(0, n_rows, _layout_scan_rows):
+        block = to_plain_array(array[start : start + _layout_scan_rows])
+        if block.ndim != 2 or block.shape[1] < 3:
+            return None
+        iterations = block[:, 0]
+        if previous is None:
+            previous = iterations[0]
+        changes = np.flatnonzero(
+            iterations != np.concatenate([[previous], iterations[:-1]])
+        )
+        if not change_rows:
+            first_step_rows = changes[0] if changes.size else block.shape[0]
+            ensembles.update(np.unique(block[:first_step_rows, 1]).tolist())
+        change_rows.extend((start + changes).tolist())
+        previous = iterations[-1]
+    rows_per_step = change_rows[0] if change_rows else n_rows
+    if n_rows % rows_per_step != 0 or change_rows != list(
+        range(rows_per_step, n_rows, rows_per_step)
+    ):
+        return None
+    n_ensembles = len(ensembles)
+    if rows_per_step % n_ensembles != 0:
+        return None
+    return {
+        "rows_per_step": rows_per_step,
+        "n_steps": n_rows // rows_per_step,
+        "n_ensembles": n_ensembles,
+        "n_atoms": rows_per_step // n_ensembles,
+    }
+
+
+class UppASD_ChunkedArrayData(orm.Data):
+    _attribute_prefix = "chunked|"
+    _chunk_name = "{}/chunk_{:06d}.npz"
+
+    def set_array(self, name, array, chunk_rows=None):
+        # Write the array chunk by chunk, the array can be a memory map (e.g. from the streaming parser), then only
+        # one chunk is in memory at a time. chunk_rows is rounded to whole time steps.
+        layout = get_step_layout(array)
+        if chunk_rows is None:
+            row_bytes = max(array[:1].nbytes, 1)
+            chunk_rows = max(_default_chunk_bytes // row_bytes, 1)
+        if layout is not None:
+            rows_per_step = layout["rows_per_step"]
+            chunk_rows = max(chunk_rows // rows_per_step, 1) * rows_per_step
+        n_chunks = 0
+        for start in range(0, array.shape[0], chunk_rows):
+            handle = io.BytesIO()
+            np.savez_compressed(
+                handle, array=np.asarray(array[start : start + chunk_rows])
+            )
+            handle.seek(0)
+            self.base.repository.put_object_from_filelike(
+                handle, self._chunk_name.format(name, n_chunks)
+            )
+            n_chunks += 1
+        self.base.attributes.set(
+            self._attribute_prefix + name,
+            {
+                "shape": list(array.shape),
+                "chunk_rows": int(chunk_rows),
+                "n_chunks": n_chunks,
+                "layout": layout,
+            },
+        )
+
+    def get_arraynames(self):
+        return [
+            key[len(self._attribute_prefix) :]
+            for key in self.base.attributes.keys()
+            if key.startswith(self._attribute_prefix)
+        ]
+
+    def get_info(self, name):
+        try:
+            return self.base.attributes.get(self._attribute_prefix + name)
+        except AttributeError:
+            raise KeyError(
+                f"Array with name `{name}` not found in UppASD_ChunkedArrayData<{self.pk}>"
+            )
+
+    def get_shape(self, name):
+        return tuple(self.get_info(name)["shape"])
+
+    def get_layout(self, name):
+        return self.get_info(name)["layout"]
+
+    def get_chunk(self, name, index):
+        with self.base.repository.open(
+            self._chunk_name.format(name, index), mode="rb"
+        ) as handle:
+            return np.load(io.BytesIO(handle.read()), allow_pickle=False)["array"]
+
+    def get_rows(self, name, start=None, stop=None):
+        # rows start:stop of the array, only the chunks that hold them are read
+        info = self.get_info(name)
+        start, stop, _ = slice(start, stop).indices(info["shape"][0])
+        chunk_rows = info["chunk_rows"]
+        if stop <= start:
+            return (
+                self.get_chunk(name, 0)[:0]
+                if info["n_chunks"]
+                else np.empty([0] + info["shape"][1:])
+            )
+        chunks = [
+            self.get_chunk(name, index)
+            for index in range(start // chunk_rows, (stop - 1) // chunk_rows + 1)
+        ]
+        offset = (start // chunk_rows) * chunk_rows
+        return np.concatenate(chunks)[start - offset : stop - offset]
+
+    def get_array(self, name):
+        # the whole array, as ArrayData.get_array
+        return self.get_rows(name)
+
+    def get_steps(
+        self, name, steps=slice(None), ensembles=slice(None), atoms=slice(None)
+    ):
+        # Snapshots of a table with one block of rows per time step, shape (steps, ensembles, atoms, columns)
+        # without the dimensions that are selected by an int. steps, ensembles and atoms are ints, slices or lists
+        # of indices (of the steps, not the iteration numbers in the first column).
+        layout = self.get_layout(name)
+        if layout is None:
+            raise ValueError(
+                f"The array `{name}` has no time step layout, use get_rows"
+            )
+        step_indices = np.arange(layout["n_steps"])[steps]
+        rows_per_step = layout["rows_per_step"]
+        chunk_rows = self.get_info(name)["chunk_rows"]
+        snapshots = []
+        chunk_index, chunk = None, None
+        for step in np.atleast_1d(step_indices):
+            # the chunks are whole steps, a step is in one chunk and the last chunk is kept for the next step
+            start = step * rows_per_step
+            if start // chunk_rows != chunk_index:
+                chunk_index = start // chunk_rows
+                chunk = self.get_chunk(name, chunk_index)
+            block = chunk[start - chunk_index * chunk_rows :][:rows_per_step]
+            block = block.reshape(
+                (layout["n_ensembles"], layout["n_atoms"]) + block.shape[1:]
+            )
+            # plain tables have a column dimension, structured ones (typed_columns) do not
+            if block.ndim == 3:
+                snapshots.append(block[ensembles][..., atoms, :])
+            else:
+                snapshots.append(block[ensembles][..., atoms])
+        if np.ndim(step_indices) == 0:
+            return snapshots[0]
+        return np.stack(snapshots)
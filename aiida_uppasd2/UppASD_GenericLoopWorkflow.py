@@ -26,12 +26,37 @@ the parameters for looping the calculation. For example:
 ! Important: The value of each list should be a string, even if it is a number. See the example above.
 
 The output of the workflow is an orm.Dict where the keys are the values of the input dict above and the values are the pk of 
-the BaseRestartWorkChain. Users can use those pk for further analysis or data query.
+the BaseRestartWorkChain. Users can use those pk for further analysis or data query. The sub workflows that failed are
+listed in a second orm.Dict, loop_dict_failed_pk.
 
 Tips:
 1. We highly recommend setting a very high walltime or a high number of auto restart times for the BaseRestartWorkChain
 in case the loop workflow breaks.
-!ToDo: Add features to automatically restart the loop workflow if it breaks. 
+2. For large sweeps set max_concurrent, the sub workflows are then submitted in batches of max_concurrent and the next
+batch is submitted when the previous one is finished, instead of all combinations at once. With pack_size the limit
+counts points and not jobs, a batch of max_concurrent points runs in ceil(max_concurrent / pack_size) packed jobs.
+3. With warm_start_axis (e.g. "hfield") the points along this axis are run one after the other for every value of the
+other keys, each point starts from the restart file of the previous one (Initmag 4), like a field cooling or hysteresis
+protocol. warm_start_inpsd replaces inpsd tags of the warm started points, e.g. a shorter ip_mcanneal.
+4. With refine_dict the grid of loop_dict_input is a coarse start: the tail mean of one column of an output array (e.g.
+the skyrmion number in sknumber) is compared between neighbouring points and new points are submitted halfway between
+neighbours that differ by more than threshold, until the spacing is max_level times halved or max_points is reached.
+Only the keys in axes are refined (e.g. ["temp", "hfield"]). Values that are all integers (e.g. ncell) get integer
+midpoints, write them as floats ("10.0") to refine an integer valued axis like temp below a spacing of 1.
+5. For many small systems set pack_size, pack_size points are then run together in one UppASD_PackedCalculations job
+(one scheduler allocation, the processes are shared by the points), without the walltime restarts of the base workflow.
+A pack gets the resources of one point (num_machines, num_mpiprocs_per_machine), so every point runs on a share of the
+processes, and init_walltime times the number of its points (at most max_walltime) to make up for it.
+6. If the loop workflow breaks or some points failed, submit it again with the same inputs: the points that finished okay
+before in a sub workflow (same input_dict, content of the input files, code, parsed files, parser options, convergence
+monitor and stitched files) are reused and only the missing or failed ones are run. Packed points are not reused this
+way, a pack with the same inputs can be taken from the AiiDA cache if caching is enabled for asd_packed_calculations.
+7. With share_input_files the input files that do not change in the loop (jij, dmdata, posfile, momfile, ... of
+input_dict and input_files) are uploaded once to the computer and linked into the folder of every point, instead of one
+copy per point.
+8. The output loop_results holds the swept values and the tail mean/std of averages, totenergy, sknumber and
+cumulants of all finished points as columns (see UppASD_Results), 'verdi data asd loop_results PK' writes it to a csv
+or parquet file, e.g. for a phase diagram, without loading the arrays of every point.
 
 Warning: 
 1. Since we detect the input variable by name, please make sure not to use the same name for representation of tag and file.
@@ -46,13 +71,28 @@ Dr. Qichen Xu, Uppsala University & KTH, Sweden
 
 """
 
+import hashlib
+import json
 import re
+import numpy as np
 from aiida_uppasd2.UppASD_BaseWorkflow import UppASD_Baseworkflow
+from aiida_uppasd2.UppASD_Calculations import UppASD_Calculations
+from aiida_uppasd2.UppASD_PackedCalculations import UppASD_PackedCalculations
+from aiida_uppasd2.UppASD_Inputs import canonicalize_input_dict
+from aiida_uppasd2.UppASD_Reductions import tail_statistics
+from aiida_uppasd2.UppASD_Results import collect_observables, results_to_arrays
 from aiida import orm
+from aiida.common.folders import SandboxFolder
+from aiida.common.hashing import make_hash
 from aiida.engine import (
     ToContext,
     WorkChain,
+    if_,
+    while_,
 )
+from aiida.plugins import CalculationFactory
+
+TransferCalculation = CalculationFactory("core.transfer")
 
 
 class GenericLoopWorkflow(WorkChain):
@@ -67,20 +107,104 @@ class GenericLoopWorkflow(WorkChain):
 
         # Define loop_dict
         spec.input("loop_dict_input", valid_type=orm.Dict, required=True)
+        spec.input(
+            "max_concurrent",
+            valid_type=orm.Int,
+            required=False,
+            help="maximum number of sub workflows that run at the same time, default: all combinations at once. "
+            "With pack_size it counts the points, not the packed jobs",
+        )
+        # Warm start: the points along warm_start_axis are run one after the other (in the order of the list in
+        # loop_dict_input) and every point starts from the restart file of the previous finished point (Initmag 4)
+        spec.input(
+            "warm_start_axis",
+            valid_type=orm.Str,
+            required=False,
+            help="key of loop_dict_input along which the points are chained, e.g. hfield for a field sweep at every temp",
+        )
+        spec.input(
+            "warm_start_inpsd",
+            valid_type=orm.Dict,
+            required=False,
+            help="inpsd tags that replace the ones of input_dict for the warm started points, e.g. a shorter ip_mcanneal",
+        )
+        # Adaptive refinement: after the grid of loop_dict_input is done, new points are put between neighbouring
+        # points whose observable differs by more than threshold, e.g.
+        # {"observable": "sknumber", "column": 1, "threshold": 0.5, "axes": ["temp"], "max_level": 3, "max_points": 200}
+        spec.input(
+            "refine_dict",
+            valid_type=orm.Dict,
+            required=False,
+            validator=cls._validate_refine_dict,
+            help="observable (array name), column, threshold, axes (keys of loop_dict_input to refine), optional: "
+            "max_level (default 3), max_points, tail_fraction (default 0.5)",
+        )
+        # Finished sub workflows with the same inputs (see get_point_key) are reused instead of submitted again,
+        # so a loop workflow that broke or had failed points can be submitted again with the same inputs
+        spec.input(
+            "reuse_finished_points",
+            valid_type=orm.Bool,
+            default=lambda: orm.Bool(True),
+            required=False,
+        )
 
-        # Define the output of the workflow
+        # Job packing: the points are run pack_size at a time in one UppASD_PackedCalculations job instead of one
+        # UppASD_Baseworkflow each, for many small systems. Packed points are not restarted, reused (see get_point_key,
+        # a whole pack can be taken from the cache) or warm started.
+        spec.input(
+            "pack_size",
+            valid_type=orm.Int,
+            required=False,
+            help="number of points run together in one job, the resources of one point are shared by the points of a "
+            "pack and the walltime is init_walltime times the number of points (at most max_walltime)",
+        )
+
+        # The input files that are the same for all points (the tables of input_dict that are not looped over and
+        # input_files) are uploaded once into a remote folder and linked into every calculation, only inpsd.dat and
+        # the looped files are written for every point.
+        spec.input(
+            "share_input_files",
+            valid_type=orm.Bool,
+            default=lambda: orm.Bool(False),
+            required=False,
+        )
+
+        # Define the output of the workflow: the pk of the finished okay and of the failed sub workflows
         spec.output("loop_dict_output_pk", valid_type=orm.Dict, required=False)
+        spec.output("loop_dict_failed_pk", valid_type=orm.Dict, required=False)
+        # the swept values and the tail mean/std of the observables of all finished points as columns, see UppASD_Results
+        spec.output("loop_results", valid_type=orm.ArrayData, required=False)
 
         # Define a error code for when subworkflow fails
         spec.exit_code(
             400, "ERROR_SUB_LOOP_WORKFLOW_FAILED", message="Subworkflow in loop failed"
         )
+        spec.exit_code(
+            401,
+            "ERROR_STAGE_INPUT_FILES_FAILED",
+            message="Uploading the shared input files failed",
+        )
 
         spec.outline(
-            cls.loops,
+            cls.setup_loops,
+            if_(cls.should_share_input_files)(
+                cls.stage_input_files, cls.inspect_stage_input_files
+            ),
+            while_(cls.has_next_combinations)(cls.loops, cls.refine),
             cls.inspect_and_summarize,
         )
 
+    @classmethod
+    def _validate_refine_dict(cls, value, _):
+        if value is None:
+            return None
+        missing = {"observable", "column", "threshold", "axes"} - set(value.get_dict())
+        if missing:
+            return f"refine_dict misses the keys {sorted(missing)}"
+        # the axes are given explicitly, not every loop key is an axis that can be bisected (e.g. Mensemble)
+        if not isinstance(value["axes"], list) or not value["axes"]:
+            return "axes of refine_dict should be a non-empty list of keys of loop_dict_input"
+
     def generate_loops(
         self,
         loop_dict_input,
@@ -119,13 +243,10 @@ class GenericLoopWorkflow(WorkChain):
                 current_combination + [value],
             )
 
-    def submit_base_restart_workflow(
-        self,
-        current_combination,
-        keys_for_fuction,
-        sub_workflow_dict,
-        loop_dict_combinations,
+    def get_workflow_inputs(
+        self, current_combination, keys_for_fuction, parent_folder=None
     ):
+        # inputs of the UppASD_Baseworkflow of one combination and its tag
         workflow_input_dict = {
             "code": self.inputs.code,
             "mpirun": self.inputs.mpirun,
@@ -141,6 +262,22 @@ class GenericLoopWorkflow(WorkChain):
             "walltime_increase": self.inputs.walltime_increase,
             "autorestart_mode": self.inputs.autorestart_mode,
         }
+        # optional inputs of the ASD calculation
+        for name in [
+            "parser_options",
+            "compress_name_list",
+            "compress_format",
+            "input_files",
+            "remote_restart",
+            "stitch_name_list",
+            "adaptive_walltime",
+            "walltime_safety_factor",
+            "max_walltime",
+            "system_size",
+            "convergence_monitor",
+        ]:
+            if name in self.inputs:
+                workflow_input_dict[name] = self.inputs[name]
 
         sub_workflow_tag = ""
         for i in range(len(keys_for_fuction)):
@@ -163,41 +300,578 @@ class GenericLoopWorkflow(WorkChain):
                     current_combination[i]
                 )
 
+        # warm start from the restart file of the previous point of the chain
+        if parent_folder is not None:
+            workflow_input_dict["parent_folder"] = parent_folder
+            if "warm_start_inpsd" in self.inputs:
+                workflow_input_dict["input_dict"]["inpsd"].update(
+                    self.inputs.warm_start_inpsd.get_dict()
+                )
+
+        # the canonical form of the final input_dict, for the point key and caching
+        workflow_input_dict["input_dict"] = canonicalize_input_dict(
+            workflow_input_dict["input_dict"]
+        )
         # Repalce all symbols that are not allowed in the tag to '_'
         sub_workflow_tag = re.sub(r"[^a-zA-Z0-9_]", "_", sub_workflow_tag)
-        loop_dict_combinations.append(sub_workflow_tag)
-        future = self.submit(UppASD_Baseworkflow, **workflow_input_dict)
-        sub_workflow_dict[sub_workflow_tag] = future
+        return sub_workflow_tag, workflow_input_dict
 
-    def loops(self):
-        # Generate the inputs for the BaseRestartWorkChain using the loop_dict_input
-        # Step 1 : get the loop_dict_input and count the number of loops
+    @staticmethod
+    def get_content_hash(node):
+        # Hash of the type, attributes, computer and repository content of a stored or unstored node, the same file
+        # uploaded again gives the same hash. Computed here since node.base.caching.get_objects_to_hash is public only
+        # from aiida-core 2.6.
+        return make_hash(
+            [
+                node.node_type,
+                node.base.attributes.all,
+                node.computer.uuid if node.computer is not None else None,
+                node.base.repository.hash(),
+            ]
+        )
+
+    @staticmethod
+    def get_point_key(workflow_input_dict):
+        # Key of the physics of one point: the final input_dict, the content of the input files, the code, the parsed and
+        # stitched files, the convergence monitor and the restart file it starts from. Walltime and resources do not
+        # change the result and are not part of it. The nodes are keyed by the hash of their content (see
+        # get_content_hash, also for unstored nodes), the same files uploaded again give the same key.
+        parent_folder = workflow_input_dict.get("parent_folder")
+        key_dict = {
+            "input_dict": workflow_input_dict["input_dict"],
+            "code": workflow_input_dict["code"].uuid,
+            "retrieve_and_parse_name_list": workflow_input_dict[
+                "retrieve_and_parse_name_list"
+            ].get_list(),
+            "input_files": {
+                name: GenericLoopWorkflow.get_content_hash(node)
+                for name, node in workflow_input_dict.get("input_files", {}).items()
+            },
+            "parent_folder": (
+                GenericLoopWorkflow.get_content_hash(parent_folder)
+                if parent_folder is not None
+                else None
+            ),
+            "parser_options": (
+                workflow_input_dict["parser_options"].get_dict()
+                if "parser_options" in workflow_input_dict
+                else None
+            ),
+            "convergence_monitor": (
+                workflow_input_dict["convergence_monitor"].get_dict()
+                if "convergence_monitor" in workflow_input_dict
+                else None
+            ),
+            "stitch_name_list": (
+                workflow_input_dict["stitch_name_list"].get_list()
+                if "stitch_name_list" in workflow_input_dict
+                else None
+            ),
+        }
+        return hashlib.sha256(json.dumps(key_dict, sort_keys=True).encode()).hexdigest()
+
+    def get_finished_points(self, point_keys):
+        # the finished okay sub workflows of earlier runs with these keys, in one query
+        if not point_keys or not self.inputs.reuse_finished_points.value:
+            return {}
+        qb = orm.QueryBuilder()
+        qb.append(
+            orm.WorkChainNode,
+            filters={
+                "extras.loop_point_key": {"in": point_keys},
+                "attributes.exit_status": 0,
+            },
+            project=["extras.loop_point_key", "*"],
+        )
+        return {point_key: node for point_key, node in qb.iterall()}
+
+    def collect_combination(
+        self,
+        current_combination,
+        keys_for_fuction,
+        sub_workflow_dict,
+        loop_dict_combinations,
+    ):
+        # only store the combination, the sub workflows are submitted in batches of max_concurrent by loops
+        loop_dict_combinations.append(current_combination)
+
+    def setup_loops(self):
+        # Generate all the combinations of the loop_dict_input, nothing is submitted here
         loop_dict_input = self.inputs.loop_dict_input.get_dict()
         loop_dict_input_keys = list(loop_dict_input.keys())
-        loop_dict_combinations = []  # store all the combinations tags for next step use
-        sub_workflow_dict = {}  # a empty dict for store all the sub workflows results
-        # Step 2: generate all the combinations for the loops and submit and submit the sub workflows.
+        pending_combinations = []
         self.generate_loops(
             loop_dict_input,
-            self.submit_base_restart_workflow,
+            self.collect_combination,
             loop_dict_input_keys,
             loop_dict_input_keys,
-            sub_workflow_dict,
-            loop_dict_combinations,
+            {},
+            pending_combinations,
         )
-        # Step 3: store all tags for next step use into ctx
-        self.ctx.loop_dict_combinations = loop_dict_combinations
-        # Step 4: return all calculated sub workflows to context
+        self.ctx.loop_dict_input_keys = loop_dict_input_keys
+        self.ctx.pending_chains = self.get_chains(
+            loop_dict_input_keys, pending_combinations
+        )
+        # store all the combinations tags for next step use
+        self.ctx.loop_dict_combinations = []
+        # combination of every tag and observable of every finished tag, for the refinement
+        self.ctx.tag_combinations = {}
+        # packed points: tag -> [tag of the packed calculation, label of the point in the pack]
+        self.ctx.pack_members = {}
+        self.ctx.pack_count = 0
+        self.ctx.observables = {}
+        if "refine_dict" in self.inputs:
+            self.ctx.refine_min_spacing = self.get_min_spacing(loop_dict_input)
+
+    def get_chains(self, loop_dict_input_keys, combinations):
+        # Group the combinations into chains that are run one point after the other,
+        # without warm_start_axis every combination is a chain of its own
+        if "warm_start_axis" not in self.inputs:
+            return [
+                {"combinations": [combination], "previous": None}
+                for combination in combinations
+            ]
+        axis_index = loop_dict_input_keys.index(self.inputs.warm_start_axis.value)
+        chains = {}
+        for combination in combinations:
+            # all the other loop values are the same within a chain
+            chain_key = str(combination[:axis_index] + combination[axis_index + 1 :])
+            chains.setdefault(chain_key, []).append(combination)
+        return [{"combinations": chain, "previous": None} for chain in chains.values()]
+
+    def should_share_input_files(self):
+        return self.inputs.share_input_files.value
+
+    def stage_input_files(self):
+        # Write the shared input files once into a FolderData and copy them to a remote folder with core.transfer
+        input_dict = self.inputs.input_dict.get_dict()
+        shared_input_dict = {
+            file_name: value
+            for file_name, value in input_dict.items()
+            if file_name != "inpsd" and file_name not in self.ctx.loop_dict_input_keys
+        }
+        input_files = {
+            file_name: file_node
+            for file_name, file_node in self.inputs.get("input_files", {}).items()
+            if file_name not in self.ctx.loop_dict_input_keys
+        }
+        folder_data = orm.FolderData()
+        with SandboxFolder() as sandbox:
+            UppASD_Calculations.write_input_dict(
+                sandbox, canonicalize_input_dict(shared_input_dict)
+            )
+            UppASD_Calculations.write_input_nodes(
+                sandbox,
+                {
+                    file_name: file_node
+                    for file_name, file_node in input_files.items()
+                    if isinstance(file_node, orm.ArrayData)
+                },
+            )
+            folder_data.base.repository.put_object_from_tree(sandbox.abspath)
+        for file_name, file_node in input_files.items():
+            if isinstance(file_node, orm.SinglefileData):
+                with file_node.open(mode="rb") as handle:
+                    folder_data.base.repository.put_object_from_filelike(
+                        handle, file_name
+                    )
+        self.ctx.shared_input_names = sorted(
+            folder_data.base.repository.list_object_names()
+        )
+        # core.transfer does not accept an empty local_files, every file of the points is looped over
+        if not self.ctx.shared_input_names:
+            self.report("No input files are left to share, the points upload their own")
+            return
+        instructions = {
+            "retrieve_files": False,
+            "local_files": [
+                ["shared_input_files", file_name, file_name]
+                for file_name in self.ctx.shared_input_names
+            ],
+        }
+        future = self.submit(
+            TransferCalculation,
+            instructions=orm.Dict(dict=instructions),
+            source_nodes={"shared_input_files": folder_data},
+            metadata={
+                "computer": self.inputs.code.computer,
+                "label": "shared input files",
+            },
+        )
+        self.report(
+            f"Uploading the shared input files {self.ctx.shared_input_names} once"
+        )
+        return ToContext(stage_input_files=future)
+
+    def inspect_stage_input_files(self):
+        if "stage_input_files" not in self.ctx:
+            return
+        if not self.ctx.stage_input_files.is_finished_ok:
+            return self.exit_codes.ERROR_STAGE_INPUT_FILES_FAILED
+        self.ctx.shared_input_folder = self.ctx.stage_input_files.outputs.remote_folder
+        # one List node for all points
+        self.ctx.shared_input_names = orm.List(list=self.ctx.shared_input_names).store()
+
+    def use_shared_input_files(self, workflow_input_dict):
+        # Remove the shared files from the inputs of one point and link them from the shared folder instead,
+        # this is done after the point key is computed, so the key does not depend on the shared folder
+        if "shared_input_folder" not in self.ctx:
+            return
+        # the system size of the learned walltime rates needs posfile, so it is computed before posfile is removed
+        if "system_size" not in workflow_input_dict:
+            workflow_input_dict["system_size"] = orm.Int(
+                UppASD_Baseworkflow.get_system_size(
+                    workflow_input_dict["input_dict"],
+                    workflow_input_dict.get("input_files", {}),
+                )
+            )
+        shared_input_names = self.ctx.shared_input_names.get_list()
+        for file_name in shared_input_names:
+            workflow_input_dict["input_dict"].pop(file_name, None)
+        input_files = {
+            file_name: file_node
+            for file_name, file_node in workflow_input_dict.pop(
+                "input_files", {}
+            ).items()
+            if file_name not in shared_input_names
+        }
+        if input_files:
+            workflow_input_dict["input_files"] = input_files
+        workflow_input_dict["shared_input_folder"] = self.ctx.shared_input_folder
+        workflow_input_dict["shared_input_names"] = self.ctx.shared_input_names
+
+    def has_next_combinations(self):
+        return len(self.ctx.pending_chains) > 0
+
+    def get_parent_folder(self, tag):
+        # remote folder of the last calculation of a finished sub workflow, None if it can not be used for a warm start
+        if tag is None:
+            return None
+        previous = self.ctx[tag]
+        if (
+            not self.is_point_finished_ok(tag)
+            or "remote_folder" not in previous.outputs
+        ):
+            self.report(
+                f"{tag} did not finish, the next point starts without warm start"
+            )
+            return None
+        return previous.outputs.remote_folder
+
+    def submit_pack(self, pack_points):
+        # Submit the points of one pack as one UppASD_PackedCalculations job, the point i is the member member_i
+        pack_tag = f"pack_{self.ctx.pack_count}"
+        self.ctx.pack_count += 1
+        workflow_input_dict = pack_points[0][1]
+        # the points share the processes of one point, so every point runs about len(pack_points) times longer
+        walltime = self.inputs.init_walltime.value * len(pack_points)
+        if "max_walltime" in self.inputs and walltime > self.inputs.max_walltime.value:
+            walltime = self.inputs.max_walltime.value
+            self.report(
+                f"The walltime of {pack_tag} is limited to max_walltime {walltime} s, its points may not finish"
+            )
+        inputs = {
+            "code": workflow_input_dict["code"],
+            "input_dicts": {
+                f"member_{i}": orm.Dict(dict=point_input_dict["input_dict"])
+                for i, (_, point_input_dict) in enumerate(pack_points)
+            },
+            "retrieve_and_parse_name_list": workflow_input_dict[
+                "retrieve_and_parse_name_list"
+            ],
+            "metadata": {
+                "options": {
+                    "resources": {
+                        "num_machines": self.inputs.num_machines.value,
+                        "num_mpiprocs_per_machine": self.inputs.num_mpiprocs_per_machine.value,
+                    },
+                    "max_wallclock_seconds": walltime,
+                    "withmpi": self.inputs.mpirun.value,
+                },
+                "label": self.inputs.label.value,
+                "description": self.inputs.description.value,
+            },
+        }
+        for name in [
+            "parser_options",
+            "input_files",
+            "shared_input_folder",
+            "shared_input_names",
+        ]:
+            if name in workflow_input_dict:
+                inputs[name] = workflow_input_dict[name]
+        for i, (sub_workflow_tag, _) in enumerate(pack_points):
+            self.ctx.pack_members[sub_workflow_tag] = [pack_tag, f"member_{i}"]
+        return pack_tag, self.submit(UppASD_PackedCalculations, **inputs)
+
+    def get_point_node(self, tag):
+        # the sub workflow of a point, or the packed calculation it ran in
+        if tag in self.ctx.pack_members:
+            return self.ctx[self.ctx.pack_members[tag][0]]
+        return self.ctx[tag]
+
+    def is_point_finished_ok(self, tag):
+        if tag in self.ctx.pack_members:
+            pack_tag, label = self.ctx.pack_members[tag]
+            outputs = self.ctx[pack_tag].outputs
+            if "pack_status" not in outputs:
+                return False
+            return outputs.pack_status.get(label) == "finished"
+        return self.ctx[tag].is_finished_ok
+
+    def get_point_output_arrays(self, tag):
+        # the output arrays of a point, the stitched array of the restarts first
+        node = self.get_point_node(tag)
+        if tag in self.ctx.pack_members:
+            label = self.ctx.pack_members[tag][1]
+            if "output_arrays" in node.outputs and label in node.outputs.output_arrays:
+                return [node.outputs.output_arrays[label]]
+            return []
+        return [
+            node.outputs[output_name]
+            for output_name in ["stitched_array", "output_array"]
+            if output_name in node.outputs
+        ]
+
+    def loops(self):
+        # Submit the next point of the next chains, at most max_concurrent sub workflows run at the same time.
+        # The engine resumes the workchain when all the sub workflows of the batch are finished, so the next batch
+        # is submitted when the window is empty.
+        if "max_concurrent" in self.inputs:
+            batch_size = max(self.inputs.max_concurrent.value, 1)
+        else:
+            batch_size = len(self.ctx.pending_chains)
+        batch = self.ctx.pending_chains[:batch_size]
+        continued_chains = []
+        # the inputs of the whole batch are generated first, to look up the finished points in one query
+        points = []
+        for chain in batch:
+            sub_workflow_tag, workflow_input_dict = self.get_workflow_inputs(
+                chain["combinations"][0],
+                self.ctx.loop_dict_input_keys,
+                parent_folder=self.get_parent_folder(chain["previous"]),
+            )
+            points.append(
+                (
+                    chain,
+                    sub_workflow_tag,
+                    workflow_input_dict,
+                    self.get_point_key(workflow_input_dict),
+                )
+            )
+        finished_points = self.get_finished_points(
+            [point_key for _, _, _, point_key in points]
+        )
+        sub_workflow_dict = {}  # a empty dict for store all the sub workflows results
+        pack_points = []
+        reused_points = 0
+        for chain, sub_workflow_tag, workflow_input_dict, point_key in points:
+            self.ctx.loop_dict_combinations.append(sub_workflow_tag)
+            self.ctx.tag_combinations[sub_workflow_tag] = chain["combinations"][0]
+            if point_key in finished_points:
+                self.ctx[sub_workflow_tag] = finished_points[point_key]
+                reused_points += 1
+            else:
+                self.use_shared_input_files(workflow_input_dict)
+                # single points (no warm start chain) are packed
+                if (
+                    "pack_size" in self.inputs
+                    and chain["previous"] is None
+                    and len(chain["combinations"]) == 1
+                ):
+                    pack_points.append((sub_workflow_tag, workflow_input_dict))
+                else:
+                    future = self.submit(UppASD_Baseworkflow, **workflow_input_dict)
+                    future.base.extras.set("loop_point_key", point_key)
+                    sub_workflow_dict[sub_workflow_tag] = future
+            # the rest of the chain continues from this point in the next step
+            if len(chain["combinations"]) > 1:
+                continued_chains.append(
+                    {
+                        "combinations": chain["combinations"][1:],
+                        "previous": sub_workflow_tag,
+                    }
+                )
+        pack_size = self.inputs.pack_size.value if "pack_size" in self.inputs else 1
+        for i in range(0, len(pack_points), pack_size):
+            pack_tag, future = self.submit_pack(pack_points[i : i + pack_size])
+            sub_workflow_dict[pack_tag] = future
+        self.ctx.pending_chains = (
+            continued_chains + self.ctx.pending_chains[batch_size:]
+        )
+        self.report(
+            f"Submitted {len(sub_workflow_dict)} sub workflows and packs, reused {reused_points} finished ones, "
+            f"{len(self.ctx.pending_chains)} chains are left"
+        )
+        # return the calculated sub workflows of this batch to context
         return ToContext(**sub_workflow_dict)
 
+    @staticmethod
+    def to_numbers(value):
+        # loop value ("10" or ["0", "0", "10"]) -> float vector, None if it is not numeric
+        try:
+            return np.atleast_1d(np.array(value, dtype=np.float64))
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def is_integer_value(value):
+        # loop value ("50" or ["50", "50", "1"]) of integers only, e.g. ncell
+        tokens = [value] if isinstance(value, str) else list(value)
+        try:
+            for token in tokens:
+                int(token)
+        except (TypeError, ValueError):
+            return False
+        return True
+
+    @staticmethod
+    def get_midpoint(value, other_value):
+        # value between two loop values, in the same format (string or list of strings),
+        # rounded down if both are integers (ncell 50 and 85 -> 67), since UppASD reads those tags as integers
+        midpoint = (
+            np.atleast_1d(np.array(value, dtype=np.float64))
+            + np.atleast_1d(np.array(other_value, dtype=np.float64))
+        ) / 2
+        is_integer = GenericLoopWorkflow.is_integer_value(value)
+        if is_integer and GenericLoopWorkflow.is_integer_value(other_value):
+            midpoint = [str(int(x)) for x in np.floor(midpoint)]
+        else:
+            midpoint = [f"{x:.10g}" for x in midpoint]
+        if isinstance(value, str):
+            return midpoint[0]
+        return midpoint
+
+    def get_refine_axes(self, loop_dict_input_keys):
+        refine_dict = self.inputs.refine_dict.get_dict()
+        return [key for key in refine_dict["axes"] if key in loop_dict_input_keys]
+
+    def get_min_spacing(self, loop_dict_input):
+        # the points are refined down to the smallest spacing of the coarse grid / 2**max_level along every axis
+        max_level = self.inputs.refine_dict.get_dict().get("max_level", 3)
+        min_spacing = {}
+        for key in self.get_refine_axes(list(loop_dict_input.keys())):
+            values = [self.to_numbers(value) for value in loop_dict_input[key]]
+            if any(value is None for value in values) or len(values) < 2:
+                continue
+            spacing = min(
+                np.linalg.norm(values[i + 1] - values[i])
+                for i in range(len(values) - 1)
+            )
+            min_spacing[key] = float(spacing) / 2**max_level
+        return min_spacing
+
+    def get_observable(self, tag):
+        # mean of the observable column over the tail of the time series of a finished sub workflow
+        refine_dict = self.inputs.refine_dict.get_dict()
+        if not self.is_point_finished_ok(tag):
+            return None
+        for output_array in self.get_point_output_arrays(tag):
+            if refine_dict["observable"] in output_array.get_arraynames():
+                statistics = tail_statistics(
+                    output_array.get_array(refine_dict["observable"]),
+                    refine_dict.get("tail_fraction", 0.5),
+                )
+                return float(statistics[0, refine_dict["column"]])
+        return None
+
+    def refine(self):
+        # When the current grid is done, add the midpoints of neighbouring points whose observable differs by more
+        # than threshold. Neighbours are the points with the same values of all other keys, next to each other along
+        # one axis. The refined points are not warm started.
+        if "refine_dict" not in self.inputs or self.ctx.pending_chains:
+            return
+        refine_dict = self.inputs.refine_dict.get_dict()
+        keys = self.ctx.loop_dict_input_keys
+        for tag in self.ctx.loop_dict_combinations:
+            if tag not in self.ctx.observables:
+                self.ctx.observables[tag] = self.get_observable(tag)
+        budget = refine_dict.get("max_points", np.inf) - len(
+            self.ctx.loop_dict_combinations
+        )
+        known_combinations = [str(c) for c in self.ctx.tag_combinations.values()]
+        new_combinations = []
+        for key, min_spacing in self.ctx.refine_min_spacing.items():
+            axis_index = keys.index(key)
+            lines = {}
+            for tag, combination in self.ctx.tag_combinations.items():
+                if self.ctx.observables[tag] is None:
+                    continue
+                line_key = str(combination[:axis_index] + combination[axis_index + 1 :])
+                lines.setdefault(line_key, []).append(
+                    (self.to_numbers(combination[axis_index]), tag, combination)
+                )
+            for line in lines.values():
+                # order the points of a line along the axis
+                line.sort(key=lambda point: tuple(point[0]))
+                for (value, tag, combination), (other_value, other_tag, _) in zip(
+                    line[:-1], line[1:]
+                ):
+                    difference = abs(
+                        self.ctx.observables[tag] - self.ctx.observables[other_tag]
+                    )
+                    distance = np.linalg.norm(other_value - value)
+                    if (
+                        difference <= refine_dict["threshold"]
+                        or distance / 2 < min_spacing
+                    ):
+                        continue
+                    new_combination = list(combination)
+                    new_combination[axis_index] = self.get_midpoint(
+                        combination[axis_index],
+                        self.ctx.tag_combinations[other_tag][axis_index],
+                    )
+                    if str(new_combination) in known_combinations:
+                        continue
+                    known_combinations.append(str(new_combination))
+                    new_combinations.append(new_combination)
+        if len(new_combinations) > budget:
+            self.report("The refinement is limited by max_points")
+            new_combinations = new_combinations[: max(int(budget), 0)]
+        if new_combinations:
+            self.report(f"Refining the grid with {len(new_combinations)} new points")
+        self.ctx.pending_chains = [
+            {"combinations": [combination], "previous": None}
+            for combination in new_combinations
+        ]
+
+    def get_loop_results(self, loop_dict_output_pk):
+        # one table of all finished points, the observables of all points are fetched with one query
+        points = [
+            (
+                tag,
+                self.ctx.tag_combinations[tag],
+                pk,
+                self.ctx.pack_members[tag][1] if tag in self.ctx.pack_members else None,
+            )
+            for tag, pk in loop_dict_output_pk.items()
+        ]
+        arrays = results_to_arrays(
+            self.ctx.loop_dict_input_keys,
+            points,
+            collect_observables(set(loop_dict_output_pk.values())),
+        )
+        loop_results = orm.ArrayData()
+        for array_name, array in arrays.items():
+            loop_results.set_array(array_name, array)
+        return loop_results.store()
+
     def inspect_and_summarize(self):
-        # We need the pk of the sub workflows
+        # We need the pk of the sub workflows, the finished okay and the failed ones are listed separately
         loop_dict_output_pk = {}
-        # Check if all the sub workflows are finished okay
+        loop_dict_failed_pk = {}
+        # (the pk of a packed point is the pk of its UppASD_PackedCalculations)
         for tag in self.ctx.loop_dict_combinations:
-            if not self.ctx[tag].is_finished_ok:
-                return self.exit_codes.ERROR_SUB_LOOP_WORKFLOW_FAILED
-        all_tags = self.ctx.loop_dict_combinations
-        for tag in all_tags:
-            loop_dict_output_pk[tag] = self.ctx[tag].pk
+            if self.is_point_finished_ok(tag):
+                loop_dict_output_pk[tag] = self.get_point_node(tag).pk
+            else:
+                loop_dict_failed_pk[tag] = self.get_point_node(tag).pk
         self.out("loop_dict_output_pk", orm.Dict(dict=loop_dict_output_pk).store())
+        self.out("loop_dict_failed_pk", orm.Dict(dict=loop_dict_failed_pk).store())
+        self.out("loop_results", self.get_loop_results(loop_dict_output_pk))
+        # Submitting the loop workflow again with the same inputs only runs the failed points
+        if loop_dict_failed_pk:
+            self.report(
+                f"{len(loop_dict_failed_pk)} sub workflows failed: {loop_dict_failed_pk}"
+            )
+            return self.exit_codes.ERROR_SUB_LOOP_WORKFLOW_FAILED
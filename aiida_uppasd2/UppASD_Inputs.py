@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers for the input files of UppASD calculations.
+
+Large input tables (jij, dmdata, momfile, posfile, restart files, ...) should not be stored as nested lists inside the
+input_dict, since the whole Dict ends up as JSONB in the database. They can instead be given to UppASD_Calculations as
+ArrayData or SinglefileData nodes in the input_files namespace, keyed by the file name in the sandbox:
+
+input_dict, input_files = split_input_dict(inpsd_dict_load)
+builder.input_dict = orm.Dict(dict=input_dict)
+builder.input_files = input_files
+
+SinglefileData nodes are copied as they are, ArrayData nodes are written with write_table.
+
+canonicalize_input_dict brings an input dict into one canonical form: every inpsd tag is a list of string tokens with
+numbers written in one format (e.g. 1.00000 -> 1, 1.0E-03 -> 0.001) and the cells of the tables are python ints, floats
+or strings. The tokens of the tags that are names (simid and the file names: posfile, exchange, ...) are kept as they
+are, simid 00000001 stays 00000001. The workflows store the input_dict of their calculations in this form and
+split_input_dict and load_input_bundle return it, so identical physics gives identical node hashes and AiiDA caching can
+reuse calculations, e.g. with:
+
+verdi config set caching.enabled_for aiida.calculations:asd_calculations
+
+A Dict given directly to a calculation is used as it is, build it with canonicalize_input_dict (or split_input_dict) to
+share the cache with the calculations of the workflows.
+
+'verdi data asd uppasd_raw_input_parser -f npz' writes the raw input files into an input bundle (the default is still
+uppasd_aiida2_input.pkl): the numeric tables as float64 arrays in uppasd_aiida2_input.npz and the inpsd tags (and the
+tables that are not numeric, e.g. qfile) in uppasd_aiida2_input.json. load_input_bundle gives the same input_dict and
+input_files as split_input_dict:
+
+input_dict, input_files = load_input_bundle("./uppasd_aiida2_input")
+"""
+import os
+import json
+import numbers
+import numpy as np
+from aiida import orm
+
+
+def write_table(handle, array, header=None):
+    # Bulk writer for input tables, %.15g prints the index columns as ints and the floats with all digits of the text they were read from
+    if header is not None:
+        handle.write(header + "\n")
+    np.savetxt(handle, array, fmt="%.15g")
+
+
+def table_to_array_data(table):
+    # nested list (rows of an input file) -> ArrayData with the array 'table'
+    array_data = orm.ArrayData()
+    array_data.set_array("table", np.array(table, dtype=np.float64))
+    return array_data
+
+
+def split_input_dict(uppasd_input_dict):
+    # Move the tables of an input dict (from uppasd_aiida2_input.pkl) into ArrayData nodes,
+    # the inpsd tags, qfile (it has a header line) and tables with rows of different length stay in the dict
+    input_dict = {}
+    input_files = {}
+    for file_name, value in uppasd_input_dict.items():
+        if file_name == "inpsd" or "qfile" in file_name:
+            input_dict[file_name] = value
+            continue
+        try:
+            input_files[file_name] = table_to_array_data(value)
+        except ValueError:
+            input_dict[file_name] = value
+    return canonicalize_input_dict(input_dict), input_files
+
+
+# inpsd tags whose tokens are names of the run or of input files, besides the tags that end with "file"
+_name_tags = ["simid", "exchange", "dm", "pd", "bq", "biqdm", "chir", "fourx"]
+
+
+def is_name_tag(tag):
+    return tag in _name_tags or tag.endswith("file")
+
+
+def canonicalize_token(token, tag=None):
+    # one inpsd token as a string, numbers in one format, other strings (P, T, ...) and the tokens of the name tags
+    # (simid, file names, see is_name_tag) as they are
+    if tag is not None and is_name_tag(tag):
+        return str(token).strip()
+    if isinstance(token, (bool, np.bool_)):
+        return str(token)
+    if isinstance(token, numbers.Integral):
+        return str(int(token))
+    if isinstance(token, numbers.Real):
+        return f"{float(token):.15g}"
+    token = str(token).strip()
+    try:
+        return str(int(token))
+    except ValueError:
+        pass
+    try:
+        return f"{float(token):.15g}"
+    except ValueError:
+        return token
+
+
+def canonicalize_cell(cell):
+    # one cell of an input table: python int, float or string
+    if isinstance(cell, (bool, np.bool_)):
+        return str(cell)
+    if isinstance(cell, numbers.Integral):
+        return int(cell)
+    if isinstance(cell, numbers.Real):
+        return float(cell)
+    cell = str(cell).strip()
+    for number_type in [int, float]:
+        try:
+            return number_type(cell)
+        except ValueError:
+            pass
+    return cell
+
+
+def canonicalize_input_dict(uppasd_input_dict):
+    # Canonical form of an input dict: sorted keys, inpsd tags as lists of string tokens (a bare string is split into
+    # tokens, the \\n of multi line tags is kept), tables as lists of rows of int/float/str cells
+    canonical_dict = {}
+    for file_name in sorted(uppasd_input_dict):
+        value = uppasd_input_dict[file_name]
+        if file_name == "inpsd":
+            canonical_dict["inpsd"] = {}
+            for tag in sorted(value):
+                tokens = value[tag]
+                if isinstance(tokens, str):
+                    tokens = tokens.split()
+                elif not isinstance(tokens, (list, tuple, np.ndarray)):
+                    tokens = [tokens]
+                canonical_dict["inpsd"][tag] = [
+                    canonicalize_token(token, tag) for token in tokens
+                ]
+        else:
+            canonical_dict[file_name] = [
+                [
+                    canonicalize_cell(cell)
+                    for cell in (row.tolist() if isinstance(row, np.ndarray) else row)
+                ]
+                for row in value
+            ]
+    return canonical_dict
+
+
+def read_inpsd(path):
+    # Read inpsd.dat into {tag: [tokens]}. The lines of a multi line tag (ip_mcanneal, ip_nphase, ntraj, a cell on
+    # three lines, ...) start with a number, they are joined to the tag with \\n as in a hand written
+    # 'ip_mcanneal 2\\n1000 100\\n1000 50', so the block is written back line by line. Text after # is a comment,
+    # other lines that start with a space are ignored as before.
+    inpsd_dict = {}
+    tag = None
+    with open(path) as file:
+        for line in file:
+            tokens = line.split("#")[0].split()
+            if not tokens:
+                continue
+            if tag is not None and canonicalize_cell(tokens[0]) != tokens[0]:
+                if inpsd_dict[tag]:
+                    tokens[0] = inpsd_dict[tag].pop() + "\\n" + tokens[0]
+                inpsd_dict[tag] += tokens
+            elif line[0].isspace():
+                continue
+            else:
+                tag = tokens[0]
+                inpsd_dict[tag] = tokens[1:]
+    return inpsd_dict
+
+
+def read_table(path):
+    # Read an input table in one pass into a float64 array (lines with # are comments). Tables with text or rows of
+    # different length are returned as lists of rows of int/float/str cells, the qfile without its header line.
+    skip_header = 1 if "qfile" in os.path.basename(path) else 0
+    try:
+        return np.loadtxt(path, comments="#", ndmin=2, skiprows=skip_header)
+    except ValueError:
+        with open(path) as file:
+            lines = file.readlines()[skip_header:]
+        return [
+            [canonicalize_cell(cell) for cell in line.split("#")[0].split()]
+            for line in lines
+            if line.split("#")[0].strip()
+        ]
+
+
+def table_to_list(table):
+    # float64 table -> rows of python numbers, the columns with only integral values as ints (atom indices, ...)
+    if not isinstance(table, np.ndarray):
+        return table
+    rows = table.astype(object)
+    for column in range(table.shape[1]):
+        if np.all(table[:, column] == np.round(table[:, column])):
+            rows[:, column] = table[:, column].astype(np.int64)
+    return rows.tolist()
+
+
+def save_input_bundle(path, inpsd_dict, tables):
+    # path.npz: the numeric tables, path.json: the inpsd tags and the other tables
+    arrays = {}
+    json_dict = {"inpsd": inpsd_dict}
+    for file_name, table in tables.items():
+        if isinstance(table, np.ndarray) and "qfile" not in file_name:
+            arrays[file_name] = table
+        else:
+            json_dict[file_name] = table_to_list(table)
+    np.savez_compressed(path + ".npz", **arrays)
+    with open(path + ".json", "w") as file:
+        json.dump(json_dict, file, indent=1)
+
+
+def load_input_bundle(path):
+    # input_dict and input_files (ArrayData) of an input bundle written by save_input_bundle, as split_input_dict
+    with open(path + ".json") as file:
+        input_dict = json.load(file)
+    input_files = {}
+    with np.load(path + ".npz", allow_pickle=False) as arrays:
+        for file_name in arrays.files:
+            array_data = orm.ArrayData()
+            array_data.set_array("table", arrays[file_name])
+            input_files[file_name] = array_data
+    return canonicalize_input_dict(input_dict), input_files
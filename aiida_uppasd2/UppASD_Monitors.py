@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Monitors for UppASD calculations.
+
+The convergence monitor tails the time series of a running calculation (averages.<simid>.out and
+totenergy.<simid>.out by default) and stops the job once they are flat, so equilibrated runs do not need to run the
+full Nstep/mcNstep. It is attached to a calculation through the monitors namespace of the CalcJob:
+
+builder.monitors = {
+    "convergence": orm.Dict(
+        {
+            "entry_point": "asd.convergence",
+            "minimum_poll_interval": 600,
+            "kwargs": {"window": 200, "drift_tolerance": 1e-3},
+        }
+    )
+}
+
+The criterion: the last 'window' rows of every monitored column are split into two halves, the column is converged
+when the means of the halves differ by less than drift_tolerance (relative to the mean, or absolute below
+absolute_tolerance) and, if std_tolerance is given, the relative standard deviation of the window is below it.
+
+When all columns are converged the job is killed, the convergence is stored in the 'convergence_monitor' extra of
+the calculation and the parser treats the run as finished instead of a WallTimeError.
+"""
+import numpy as np
+from aiida.engine.processes.calcjobs.monitors import CalcJobMonitorResult
+
+# columns that are monitored by default: M of averages and the total energy of totenergy
+_default_columns = {"averages": [4], "totenergy": [1]}
+
+
+def is_converged(
+    table, columns, window, drift_tolerance, absolute_tolerance, std_tolerance
+):
+    # apply the drift/variance criterion to the last window rows of a table
+    if table.shape[0] < window:
+        return False
+    tail = table[-window:, columns]
+    first_mean = tail[: window // 2].mean(axis=0)
+    second_mean = tail[window // 2 :].mean(axis=0)
+    scale = np.maximum(np.abs(second_mean), absolute_tolerance)
+    if np.any(np.abs(second_mean - first_mean) > drift_tolerance * scale):
+        return False
+    if std_tolerance is not None and np.any(tail.std(axis=0) > std_tolerance * scale):
+        return False
+    return True
+
+
+def convergence_monitor(
+    node,
+    transport,
+    columns=None,
+    window=200,
+    drift_tolerance=1e-3,
+    absolute_tolerance=1e-8,
+    std_tolerance=None,
+):
+    # columns: {file type: [column indices]}, only the last window rows of the files are read through the transport
+    columns = columns or _default_columns
+    cwd = node.get_remote_workdir()
+    if cwd is None:
+        return None
+    simid = node.inputs.input_dict["inpsd"]["simid"][0]
+    last_iterations = {}
+    for file_type, file_columns in columns.items():
+        file_name = f"{cwd}/{file_type}.{simid}.out"
+        retval, stdout, _ = transport.exec_command_wait(
+            f"tail -n {int(window)} {file_name}"
+        )
+        # the file is not written yet
+        if retval != 0 or not stdout.strip():
+            return None
+        # the last line is being written if it has no newline yet, it is left for the next poll
+        lines = stdout.splitlines(keepends=True)
+        if not lines[-1].endswith("\n"):
+            lines = lines[:-1]
+        if not lines:
+            return None
+        try:
+            table = np.loadtxt(lines, comments="#", ndmin=2)
+        except ValueError:
+            return None
+        if not is_converged(
+            table,
+            file_columns,
+            int(window),
+            drift_tolerance,
+            absolute_tolerance,
+            std_tolerance,
+        ):
+            return None
+        last_iterations[file_type] = int(table[-1, 0])
+    message = f"Converged within the last {window} rows at iterations {last_iterations}"
+    node.base.extras.set(
+        "convergence_monitor",
+        {"converged": True, "iterations": last_iterations, "window": window},
+    )
+    # the job is killed, but the files are still retrieved and the exit code is left to the parser
+    return CalcJobMonitorResult(message=message, override_exit_code=False)
@@ -0,0 +1,192 @@
+"""
+Packed UppASD calculations: many small UppASD runs in one scheduler job.
+
+Every input dict of the input_dicts namespace is written into its own sub folder pack_<label> of the working
+directory and all sd runs are started at the same time in the job, each with procs_per_member MPI processes (default:
+the allocated processes divided by the number of members). The output files of every member are parsed by
+asd_packed_parsers into output_arrays.<label>, the state of every member is in the output pack_status.
+
+For thousands of small systems (e.g. the 60x60 examples) the time in the queue is much longer than the run time, with
+packing one job of the queue runs many of them. The members are not restarted if the job hits the walltime, use
+UppASD_Baseworkflow for long runs.
+"""
+
+import os
+import shlex
+from aiida.common import datastructures
+from aiida.engine import CalcJob
+from aiida.orm import (
+    Int,
+    RemoteData,
+    List,
+    Dict,
+    ArrayData,
+    SinglefileData,
+)
+from aiida_uppasd2.UppASD_Calculations import UppASD_Calculations
+from aiida_uppasd2.UppASD_Inputs import canonicalize_input_dict
+
+
+class UppASD_PackedCalculations(CalcJob):
+    _member_folder = "pack_{}"
+    _member_stdout_name = "uppasd.out"
+    _member_run_text = "(cd {folder} && {command} > {stdout} 2>&1) &"
+
+    @classmethod
+    def define(cls, spec):
+        super(UppASD_PackedCalculations, cls).define(spec)
+        spec.input_namespace(
+            "input_dicts",
+            valid_type=Dict,
+            required=True,
+            dynamic=True,
+            help="input dicts (as for asd_calculations) of the members of the pack, the key is the label of the member",
+        )
+        spec.input(
+            "retrieve_and_parse_name_list",
+            valid_type=List,
+            required=True,
+            help="list of files to parse and retrieve from the folder of every member",
+        )
+        # input files that are the same for all members, e.g. jij and posfile of a field/temperature sweep
+        spec.input_namespace(
+            "input_files",
+            valid_type=(ArrayData, SinglefileData),
+            required=False,
+            dynamic=True,
+            help="input files shared by all members as SinglefileData or ArrayData, see UppASD_Inputs",
+        )
+        spec.input(
+            "shared_input_folder",
+            valid_type=RemoteData,
+            required=False,
+            help="remote folder with input files shared by many calculations, e.g. staged by GenericLoopWorkflow",
+        )
+        spec.input(
+            "shared_input_names",
+            valid_type=List,
+            required=False,
+            help="names of the files in shared_input_folder that are linked into the folder of every member",
+        )
+        spec.input(
+            "parser_options",
+            valid_type=Dict,
+            required=False,
+            help="dict of options for asd_parsers, see UppASD_Parsers.default_parser_options",
+        )
+        spec.input(
+            "procs_per_member",
+            valid_type=Int,
+            required=False,
+            help="MPI processes of every sd run, default: the allocated processes divided by the number of members",
+        )
+        spec.inputs["metadata"]["options"]["parser_name"].default = "asd_packed_parsers"
+
+        spec.output_namespace(
+            "output_arrays",
+            valid_type=ArrayData,
+            dynamic=True,
+            help="the output arrays of every member, as output_array of asd_calculations",
+        )
+        spec.output(
+            "pack_status",
+            valid_type=Dict,
+            required=False,
+            help="the state of every member, keyed by the label: finished, walltime or parsing_error",
+        )
+        spec.output(
+            "observables",
+            valid_type=Dict,
+            required=False,
+            help="the observables of every member as the output observables of asd_calculations, keyed by the label",
+        )
+
+        # calculations that failed should not be reused when caching is enabled
+        spec.exit_code(
+            451,
+            "WallTimeError",
+            message="Hit the max wall time before all members finished",
+            invalidates_cache=True,
+        )
+        spec.exit_code(
+            452,
+            "ParsingError",
+            message="Failed to parse one or more of the requested output files",
+            invalidates_cache=True,
+        )
+
+    def get_member_command(self):
+        # The command line of one sd run, from the code and the mpirun command of the computer
+        # with the processes of one member instead of the whole allocation
+        code = self.inputs.code
+        resources = dict(self.node.get_option("resources"))
+        num_mpiprocs_per_machine = resources.get(
+            "num_mpiprocs_per_machine",
+            self.node.computer.get_default_mpiprocs_per_machine() or 1,
+        )
+        tot_num_mpiprocs = resources.get(
+            "tot_num_mpiprocs",
+            resources.get("num_machines", 1) * num_mpiprocs_per_machine,
+        )
+        if "procs_per_member" in self.inputs:
+            procs_per_member = self.inputs.procs_per_member.value
+        else:
+            procs_per_member = max(tot_num_mpiprocs // len(self.inputs.input_dicts), 1)
+        subst_dict = dict(resources)
+        subst_dict["num_mpiprocs_per_machine"] = num_mpiprocs_per_machine
+        subst_dict["tot_num_mpiprocs"] = procs_per_member
+        if self.node.get_option("withmpi"):
+            mpi_args = [
+                arg.format(**subst_dict)
+                for arg in self.node.computer.get_mpirun_command()
+            ]
+            command = code.get_prepend_cmdline_params(mpi_args)
+        else:
+            command = code.get_prepend_cmdline_params()
+        command = command + code.get_executable_cmdline_params()
+        return " ".join(shlex.quote(str(arg)) for arg in command)
+
+    def prepare_for_submission(self, folder):
+        calcinfo = datastructures.CalcInfo()
+        calcinfo.local_copy_list = []
+        calcinfo.retrieve_list = []
+        calcinfo.remote_symlink_list = []
+        command = self.get_member_command()
+        run_texts = [
+            "# AiiDA-UppASD2 packed calculation: all members run at the same time"
+        ]
+        for label, input_dict in self.inputs.input_dicts.items():
+            member_folder = self._member_folder.format(label)
+            subfolder = folder.get_subfolder(member_folder, create=True)
+            uppasd_aiida2_input_dict = canonicalize_input_dict(input_dict.get_dict())
+            UppASD_Calculations.write_input_dict(subfolder, uppasd_aiida2_input_dict)
+            calcinfo.local_copy_list += UppASD_Calculations.write_input_nodes(
+                subfolder, self.inputs.get("input_files", {}), member_folder
+            )
+            calcinfo.remote_symlink_list += (
+                UppASD_Calculations.get_shared_input_symlinks(
+                    self.inputs, member_folder
+                )
+            )
+            run_texts.append(
+                self._member_run_text.format(
+                    folder=member_folder,
+                    command=command,
+                    stdout=self._member_stdout_name,
+                )
+            )
+            # the files are retrieved into the same sub folder, they have the same names in all members
+            simid = uppasd_aiida2_input_dict["inpsd"]["simid"][0]
+            for name in self.inputs.retrieve_and_parse_name_list.get_list() + [
+                self._member_stdout_name
+            ]:
+                if name[-1] == "*":
+                    name = name[:-1] + "." + simid + ".out"
+                calcinfo.retrieve_list.append(
+                    (os.path.join(member_folder, name), ".", 2)
+                )
+        run_texts.append("wait")
+        # the sd runs are started by the job script itself, not as codes of the calculation
+        calcinfo.prepend_text = "\n".join(run_texts)
+        calcinfo.codes_info = []
+        return calcinfo
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Parser for the packed UppASD calculations (asd_packed_calculations), every member is parsed like a single calculation
+by the methods of UppASD_Parsers.
+"""
+import time
+import tracemalloc
+from aiida.engine import ExitCode
+from aiida.orm import Dict
+from aiida.plugins import CalculationFactory
+from aiida_uppasd2.UppASD_Parsers import UppASD_Parsers
+
+ASDPackedCalculation = CalculationFactory("asd_packed_calculations")
+
+
+class UppASD_PackedParsers(UppASD_Parsers):
+    def parse(self, **kwargs):
+        output_folder = self.retrieved
+        files_requested = self.node.inputs.retrieve_and_parse_name_list.get_list()
+
+        parse_start_time = time.perf_counter()
+        parser_options = self.get_parser_options()
+        if parser_options["trace_memory"]:
+            tracemalloc.start()
+        # The statistics of all members are stored together, keyed by <member folder>/<file name>,
+        # the state of every member in the output pack_status: finished, walltime or parsing_error and the observables of
+        # every member in the output observables, keyed by the label (outputs and not extras, the extras are not copied
+        # to cached calculations)
+        parser_statistics = {
+            "files": {},
+            "failed_files": [],
+            "parse_workers": parser_options["parse_workers"],
+            "set_array_time": 0.0,
+        }
+        pack_status = {}
+        observables = {}
+        for label, input_dict in self.node.inputs.input_dicts.items():
+            member_folder = ASDPackedCalculation._member_folder.format(label)
+            if member_folder not in output_folder.list_object_names():
+                pack_status[label] = "walltime"
+                continue
+            retrived_file_name_list = [
+                f"{member_folder}/{name}"
+                for name in output_folder.list_object_names(member_folder)
+            ]
+            # 'restart*' -> 'restart.<simid>.out'
+            filenames = [
+                self.get_output_file_name(name, input_dict["inpsd"]["simid"][0])
+                for name in files_requested
+            ]
+            (
+                output_arrays,
+                file_statistics,
+                failed_files,
+                set_array_time,
+            ) = self.parse_output_files(
+                filenames,
+                retrived_file_name_list,
+                kwargs.get("retrieved_temporary_folder"),
+                parser_options,
+                folder=member_folder,
+            )
+            self.out(f"output_arrays.{label}", output_arrays)
+            observables[label] = self.get_observables(output_arrays, parser_options)
+            for filename, statistics in file_statistics.items():
+                parser_statistics["files"][f"{member_folder}/{filename}"] = statistics
+            parser_statistics["failed_files"] += [
+                f"{member_folder}/{filename}" for filename in failed_files
+            ]
+            parser_statistics["set_array_time"] += set_array_time
+
+            stdout_name = f"{member_folder}/{ASDPackedCalculation._member_stdout_name}"
+            # a member that is stopped before the end is restarted even if one of its files can not be parsed
+            if stdout_name not in retrived_file_name_list or (
+                "Simulation finished"
+                not in output_folder.get_object_content(stdout_name)
+            ):
+                pack_status[label] = "walltime"
+            elif failed_files:
+                pack_status[label] = "parsing_error"
+            else:
+                pack_status[label] = "finished"
+
+        parser_statistics["total_time"] = time.perf_counter() - parse_start_time
+        if parser_options["trace_memory"]:
+            parser_statistics["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.node.base.extras.set("parser_statistics", parser_statistics)
+        self.out("pack_status", Dict(pack_status))
+        self.out("observables", Dict(observables))
+        if "parsing_error" in pack_status.values():
+            return ASDPackedCalculation.exit_codes.ParsingError
+        if "walltime" in pack_status.values():
+            return ASDPackedCalculation.exit_codes.WallTimeError
+        return ExitCode(0)
@@ -2,14 +2,26 @@
 """
 Parser for UppASD
 """
+import os
 import json
+import time
+import tracemalloc
+import io
+import gzip
+import contextlib
+import concurrent.futures
+import tempfile
+import itertools
+import functools
 import numpy as np
-import pandas as pd
 from aiida import orm
 from aiida.engine import ExitCode
 from aiida.parsers.parser import Parser
 from aiida.plugins import CalculationFactory
 from aiida.common.exceptions import NotExistent
+from aiida_uppasd2.UppASD_Schemas import apply_schema
+from aiida_uppasd2.UppASD_Data import UppASD_ChunkedArrayData
+from aiida_uppasd2.UppASD_Reductions import reduce_table, tail_statistics, tail_summary
 from aiida.orm import (
     Code,
     SinglefileData,
@@ -31,60 +43,353 @@ ASDCalculation = CalculationFactory("asd_calculations")
 
 
 class UppASD_Parsers(Parser):
-    # Some exceptions: aniso.out,
-    def aniso_struct_out_parser(sekf, input_file):
-        f = open(input_file)
-        all_file = f.readlines()[1:]
-        index = 0
-        for i in range(int((len(all_file) / 4))):
-            if i == 0:
-                atom_number = np.array([i])
-                easy_axis = np.array(np.float_(all_file[index + 2].strip("\n").split()))
-                aniso_K = np.array(np.float_(all_file[index + 3].strip("\n").split()))
+    # Default parser options, they can be overwritten by the parser_options input of the calculation.
+    default_parser_options = {
+        # Files that are parsed chunk by chunk into an on-disk array instead of being loaded at once,
+        # e.g. the moment and trajectory files of large systems.
+        "stream_name_list": ["moment*", "trajectory*"],
+        # Number of rows read per chunk in the streaming mode
+        "stream_chunk_rows": 100000,
+        # Number of threads used to parse the requested files concurrently, 1 means one file after the other
+        "parse_workers": 1,
+        # Store the tables with a schema in UppASD_Schemas as structured arrays with named, typed columns
+        # (int32 iterations and indices), optionally with the observables in float32.
+        "typed_columns": False,
+        "float32": False,
+        # Trace the peak memory of every parsed file with tracemalloc (slower), the timings are always recorded.
+        # With parse_workers > 1 the peak of a file includes the files that are parsed at the same time.
+        "trace_memory": False,
+        # Decimation of time series, e.g. {"averages*": {"stride": 10}}, see UppASD_Reductions for the format.
+        "reduce_dict": {},
+        # The mean and std over the tail of these time series are stored in the output observables (Dict) of the
+        # calculation, for collecting the results of a sweep with one query (see UppASD_Results)
+        "summary_name_list": ["averages*", "totenergy*", "sknumber*", "cumulants*"],
+        "summary_tail_fraction": 0.5,
+        # Files that are stored in the output chunked_array (UppASD_ChunkedArrayData) instead of output_array, in
+        # compressed chunks of rows, so single snapshots of e.g. ["moment*"] can be read without loading the rest.
+        # restart is not allowed, the restarts read it from output_array.
+        "chunked_name_list": [],
+    }
 
-            else:
-                atom_number = np.vstack([atom_number, np.array([i])])
-                easy_axis = np.vstack(
-                    [
-                        easy_axis,
-                        np.array(np.float_(all_file[index + 2].strip("\n").split())),
-                    ]
-                )
-                aniso_K = np.vstack(
-                    [
-                        aniso_K,
-                        np.array(np.float_(all_file[index + 3].strip("\n").split())),
-                    ]
-                )
+    def get_parser_options(self):
+        parser_options = dict(self.default_parser_options)
+        if "parser_options" in self.node.inputs:
+            parser_options.update(self.node.inputs.parser_options.get_dict())
+        return parser_options
 
-            index = index + 4
+    @staticmethod
+    def get_file_type(filename):
+        # 'moment*', 'moment.xxx.out' -> 'moment'
+        return filename.rstrip("*").split(".")[0]
+
+    # Some exceptions: aniso.out,
+    def aniso_struct_out_parser(self, input_file):
+        # aniso.out has one header line followed by a record of 4 lines per atom,
+        # the 3rd line of a record is the easy axis and the 4th line holds the anisotropy constants.
+        # All records are sliced out of one bulk read, so the cost is linear in the number of atoms.
+        all_file = input_file.readlines()[1:]
+        atom_num = len(all_file) // 4
+        if atom_num == 0:
+            return np.empty((0, 1))
+        atom_number = np.arange(atom_num, dtype=np.float64).reshape(-1, 1)
+        easy_axis = np.loadtxt(all_file[2 : 4 * atom_num : 4], ndmin=2)
+        aniso_K = np.loadtxt(all_file[3 : 4 * atom_num : 4], ndmin=2)
         aniso_full = np.hstack([atom_number, easy_axis, aniso_K])
         return aniso_full
 
     # General parser for tensor output
-    def get_skiplines(
-        self, input_file
-    ):  # pylint: disable=too-many-locals, too-many-statements, too-many-branches
-        # Read line by one to check which line is not the comment line, the reason why we don't use pd.read_csv(file_name, comment='#') is because we want to use sep="\s+".
-        skipline = 0
+    def get_header(self, input_file):
+        # Read the comment header (lines start with #) line by line and leave the handle at the first data line,
+        # so the header and the table are read in one pass over the same file handle.
+        header = []
         while True:
+            position = input_file.tell() if input_file.seekable() else None
             line = input_file.readline()
             if not line.lstrip().startswith(
                 b"#"
             ):  # we here use thebyte mode so a string should be b"#"
                 break
-            skipline = skipline + 1
-        return skipline
-
-    def general_parse(
-        self, input_file, skipline
-    ):  # pylint: disable=too-many-locals, too-many-statements, too-many-branches
-        # Read line by one to check which line is not the comment line, the reason why we don't use pd.read_csv(file_name, comment='#') is because we want to use sep="\s+".
-        output_tensor = pd.read_csv(
-            input_file, sep="\s+", header=None, skiprows=skipline
-        ).to_numpy()
+            header.append(line.decode().strip())
+        if not line:  # file with only the header
+            return header, None
+        if position is not None:
+            input_file.seek(position)
+            return header, input_file
+        return header, itertools.chain([line], input_file)
+
+    def complete_lines(self, data_lines):
+        # Yield the lines of a table without an incomplete last line. A run that is killed at the walltime or by the
+        # convergence monitor stops in the middle of a row, so a last line without a newline or with another number
+        # of columns than the first data row is the end of the data and not a broken file.
+        n_cols = None
+        previous = None
+        for line in data_lines:
+            if previous is not None:
+                yield previous
+            previous = line
+            if n_cols is None:
+                n_cols = len(line.split(b"#")[0].split()) or None
+        if previous is None:
+            return
+        if previous.endswith(b"\n") and len(previous.split(b"#")[0].split()) in (
+            0,
+            n_cols,
+        ):
+            yield previous
+        else:
+            self.logger.warning(
+                f"Dropped the incomplete last line of a table: {previous[:80]!r}"
+            )
+
+    def general_parse(self, data_lines):
+        # UppASD tables are whitespace separated floats with a fixed number of columns,
+        # np.loadtxt parses them with its C tokenizer, which is much faster than the regex separator of pandas.
+        if data_lines is None:
+            return np.empty((0, 0))
+        data_lines = self.complete_lines(data_lines)
+        first_line = next(data_lines, None)
+        if first_line is None:
+            return np.empty((0, 0))
+        output_tensor = np.loadtxt(
+            itertools.chain([first_line], data_lines), comments="#", ndmin=2
+        )
         return output_tensor
 
+    def stream_parse(self, data_lines, chunk_rows, raw_file_name, convert=None):
+        # Streaming version of general_parse for huge files (moment, trajectory, ...).
+        # The file is read chunk_rows lines at a time and every chunk is appended to a raw binary file on disk,
+        # the result is a memory-mapped array, so the peak memory does not depend on the length of the file.
+        n_rows = 0
+        n_cols = 0
+        if data_lines is not None:
+            data_lines = self.complete_lines(data_lines)
+            with open(raw_file_name, "wb") as raw_file:
+                while True:
+                    lines = list(itertools.islice(data_lines, chunk_rows))
+                    if not lines:
+                        break
+                    chunk = np.loadtxt(lines, comments="#", ndmin=2)
+                    n_cols = chunk.shape[1]
+                    # e.g. the typed columns are applied chunk by chunk as well
+                    if convert is not None:
+                        chunk = convert(chunk)
+                    n_rows = n_rows + chunk.shape[0]
+                    dtype = chunk.dtype
+                    chunk.tofile(raw_file)
+        if n_rows == 0:
+            return np.empty((0, n_cols))
+        return np.memmap(
+            raw_file_name, dtype=dtype, mode="r", shape=(n_rows,) + chunk.shape[1:]
+        )
+
+    def open_compressed(self, path):
+        # Open a file that was compressed on the cluster, it is decompressed on the fly while it is read
+        if path.endswith(".gz"):
+            return gzip.open(path, "rb")
+        if path.endswith(".zst"):
+            try:
+                import zstandard
+            except ImportError as exception:
+                raise ImportError(
+                    "zstandard is needed for zstd compressed files, pip install aiida-uppasd2[zstd]"
+                ) from exception
+            return io.BufferedReader(
+                zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+            )
+        return open(path, "rb")
+
+    def open_output_file(
+        self, filename, retrived_file_name_list, retrieved_temporary_folder
+    ):
+        # Files from the retrieve list are read from the retrieved FolderData,
+        # the compressed files (compress_name_list) from the temporary folder of the retrieved files
+        if filename in retrived_file_name_list:
+            return self.retrieved.open(filename, "rb")
+        if retrieved_temporary_folder is None:
+            return None
+        for suffix in list(ASDCalculation._compress_suffixes.values()) + [""]:
+            path = os.path.join(retrieved_temporary_folder, filename + suffix)
+            if os.path.isfile(path):
+                return self.open_compressed(path)
+        return None
+
+    def get_output_file_name(self, filename, simid=None):
+        # 'restart*' -> 'restart.<simid>.out'
+        if simid is None:
+            simid = self.node.inputs.input_dict["inpsd"]["simid"][0]
+        if filename[-1] == "*":
+            filename = filename[:-1] + "." + simid + ".out"
+        return filename
+
+    def parse_file(self, filename, input_file, parser_options, stream_folder):
+        # Parse one retrieved file into a dict of numpy arrays, the key is the name in the output ArrayData
+        # .split('.')[0] for name like 'restart.xxx.out' to 'restart'
+        array_name = filename.split(".")[0]
+        # parser special files:
+        if "aniso" in filename:
+            return {array_name: self.aniso_struct_out_parser(input_file)}
+        # parser general files:
+        file_type = self.get_file_type(filename)
+        convert = None
+        if parser_options["typed_columns"]:
+            convert = functools.partial(
+                apply_schema, file_type, float32=parser_options["float32"]
+            )
+        header, data_lines = self.get_header(input_file)
+        stream_file_types = [
+            self.get_file_type(name) for name in parser_options["stream_name_list"]
+        ]
+        if file_type in stream_file_types:
+            output = self.stream_parse(
+                data_lines,
+                parser_options["stream_chunk_rows"],
+                os.path.join(stream_folder, filename + ".raw"),
+                convert,
+            )
+        else:
+            output = self.general_parse(data_lines)
+            if convert is not None:
+                output = convert(output)
+        reduce_dict = {
+            self.get_file_type(name): reduce_option
+            for name, reduce_option in parser_options["reduce_dict"].items()
+        }
+        if file_type not in reduce_dict:
+            return {array_name: output}
+        # time series decimation, the full table is only kept if it is asked for
+        reduce_option = reduce_dict[file_type]
+        outputs = {
+            array_name: reduce_table(
+                file_type,
+                output,
+                stride=reduce_option.get("stride"),
+                block=reduce_option.get("block"),
+                last=reduce_option.get("last"),
+            ),
+            array_name
+            + "_stats": tail_statistics(output, reduce_option.get("tail_fraction", 0.5)),
+        }
+        if reduce_option.get("keep_full", False):
+            outputs[array_name + "_full"] = output
+        return outputs
+
+    def parse_file_with_statistics(
+        self, filename, input_file, parser_options, stream_folder
+    ):
+        # parse_file plus the statistics of this file: bytes read, rows and columns, wall time and peak memory
+        if parser_options["trace_memory"]:
+            tracemalloc.reset_peak()
+        start_time = time.perf_counter()
+        outputs = self.parse_file(filename, input_file, parser_options, stream_folder)
+        statistics = {"parse_time": time.perf_counter() - start_time}
+        if parser_options["trace_memory"]:
+            statistics["peak_memory"] = tracemalloc.get_traced_memory()[1]
+        try:
+            # all readers consume the file, so the position is the number of (decompressed) bytes
+            statistics["bytes"] = input_file.tell()
+        except (OSError, ValueError):
+            statistics["bytes"] = None
+        output = outputs[filename.split(".")[0]]
+        statistics["rows"] = output.shape[0]
+        statistics["columns"] = (
+            len(output.dtype.names) if output.dtype.names else output.shape[-1]
+        )
+        return outputs, statistics
+
+    def parse_output_files(
+        self,
+        filenames,
+        retrived_file_name_list,
+        retrieved_temporary_folder,
+        parser_options,
+        folder=None,
+        chunked_arrays=None,
+    ):
+        # Parse the output files of one UppASD run into one ArrayData, folder is the sub folder of the run in the
+        # retrieved files (for the packed calculations), the file names are given without it. The files of
+        # chunked_name_list are put into chunked_arrays (UppASD_ChunkedArrayData) if it is given.
+        # on-disk buffer for the streamed arrays, it is removed after the arrays are put into the ArrayData
+        stream_folder = tempfile.TemporaryDirectory()
+
+        # The files are parsed by a pool of parse_workers threads, the handles are opened here in the main thread
+        # and only the reading and parsing is done by the workers. An error in one file does not stop the others.
+        futures = {}
+        with contextlib.ExitStack() as stack:
+            executor = stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(
+                    max_workers=parser_options["parse_workers"]
+                )
+            )
+            for filename in filenames:
+                f = self.open_output_file(
+                    filename if folder is None else f"{folder}/{filename}",
+                    retrived_file_name_list,
+                    retrieved_temporary_folder,
+                )
+                # files that are not retrieved are skipped
+                if f is None:
+                    continue
+                f = stack.enter_context(f)
+                futures[filename] = executor.submit(
+                    self.parse_file_with_statistics,
+                    filename,
+                    f,
+                    parser_options,
+                    stream_folder.name,
+                )
+            concurrent.futures.wait(futures.values())
+
+        output_arrays = ArrayData()
+        chunked_file_types = [
+            self.get_file_type(name) for name in parser_options["chunked_name_list"]
+        ]
+        failed_files = []
+        file_statistics = {}
+        set_array_time = 0.0
+        for filename, future in futures.items():
+            try:
+                outputs, file_statistics[filename] = future.result()
+            except Exception as exception:
+                self.logger.error(f"Failed to parse the file '{filename}': {exception}")
+                failed_files.append(filename)
+                continue
+            start_time = time.perf_counter()
+            for array_name, output in outputs.items():
+                if (
+                    chunked_arrays is not None
+                    and self.get_file_type(filename) in chunked_file_types
+                ):
+                    chunked_arrays.set_array(array_name, output)
+                else:
+                    output_arrays.set_array(array_name, output)
+            set_array_time = set_array_time + time.perf_counter() - start_time
+            del outputs
+        futures.clear()
+        stream_folder.cleanup()
+        return output_arrays, file_statistics, failed_files, set_array_time
+
+    def get_observables(self, output_arrays, parser_options):
+        # {file type: {"mean": [...], "std": [...]}} of the summary files, from the _stats array if the file is reduced
+        observables = {}
+        array_names = output_arrays.get_arraynames()
+        for name in parser_options["summary_name_list"]:
+            file_type = self.get_file_type(name)
+            if file_type + "_stats" in array_names:
+                summary = output_arrays.get_array(file_type + "_stats")[:2]
+            elif file_type in array_names:
+                summary = tail_summary(
+                    output_arrays.get_array(file_type),
+                    parser_options["summary_tail_fraction"],
+                )
+            else:
+                continue
+            # nan is not allowed in the attributes of a Dict
+            observables[file_type] = {
+                row_name: [None if np.isnan(value) else float(value) for value in row]
+                for row_name, row in zip(["mean", "std"], summary)
+            }
+        return observables
+
     def parse(self, **kwargs):
         output_folder = self.retrieved
 
@@ -99,45 +404,58 @@ class UppASD_Parsers(Parser):
         #     )
         #     return self.exit_codes.ERROR_MISSING_OUTPUT_FILES
 
-        # Walltime check
-        output_arrays = ArrayData()
-        for filename in files_requested:
-            # parser special files:
-            if "aniso" in filename:
-                aniso_filename = filename
-                if filename[-1] == "*":
-                    filename = (
-                        filename[:-1]
-                        + "."
-                        + self.node.inputs.input_dict["inpsd"]["simid"][0]
-                        + ".out"
-                    )
-                if filename in retrived_file_name_list:
-                    with output_folder.open(aniso_filename, "rb") as f:
-                        aniso = self.aniso_struct_out_parser(f)
-                        output_arrays.set_array(
-                            filename.split(".")[0], aniso
-                        )  # .split('.')[0] for name like 'aniso.xxx.out' to 'aniso'
-                # parser general files:
-            else:
-                if filename[-1] == "*":
-                    filename = (
-                        filename[:-1]
-                        + "."
-                        + self.node.inputs.input_dict["inpsd"]["simid"][0]
-                        + ".out"
-                    )
-                if filename in retrived_file_name_list:
-                    with output_folder.open(filename, "rb") as f:
-                        skipline = self.get_skiplines(f)
-                    with output_folder.open(filename, "rb") as f:
-                        output = self.general_parse(f, skipline)
-                    output_arrays.set_array(filename.split(".")[0], output)
+        parse_start_time = time.perf_counter()
+        parser_options = self.get_parser_options()
+        if parser_options["trace_memory"]:
+            tracemalloc.start()
+        # 'restart*' -> 'restart.<simid>.out'
+        filenames = [self.get_output_file_name(name) for name in files_requested]
+        chunked_arrays = UppASD_ChunkedArrayData()
+        (
+            output_arrays,
+            file_statistics,
+            failed_files,
+            set_array_time,
+        ) = self.parse_output_files(
+            filenames,
+            retrived_file_name_list,
+            kwargs.get("retrieved_temporary_folder"),
+            parser_options,
+            chunked_arrays=chunked_arrays,
+        )
         self.out("output_array", output_arrays)
-        # after return current result we can check if the walltime is reached
+        if chunked_arrays.get_arraynames():
+            self.out("chunked_array", chunked_arrays)
+
+        # The parser statistics are stored in the extras of the calculation node, so they can be queried,
+        # see 'verdi data asd parser_report'
+        parser_statistics = {
+            "files": file_statistics,
+            "failed_files": failed_files,
+            "parse_workers": parser_options["parse_workers"],
+            "set_array_time": set_array_time,
+            "total_time": time.perf_counter() - parse_start_time,
+        }
+        if parser_options["trace_memory"]:
+            parser_statistics["peak_memory"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.node.base.extras.set("parser_statistics", parser_statistics)
+        self.out(
+            "observables", Dict(self.get_observables(output_arrays, parser_options))
+        )
+        # The walltime is checked before the failed files, a run that is stopped before the end has to be restarted
+        # (WallTimeError) even if one of its files can not be parsed, the failed files are in parser_statistics.
         with output_folder.open("_scheduler-stdout.txt", "rb") as handler:
             log = str(handler.read())
-            if "Simulation finished" in log:
-                return ExitCode(0)
-            else:
-                return ASDCalculation.exit_codes.WallTimeError
+        finished = "Simulation finished" in log
+        # the job was stopped by the convergence monitor (see UppASD_Monitors), this is not a walltime error
+        if not finished and self.node.base.extras.get("convergence_monitor", {}).get(
+            "converged"
+        ):
+            self.logger.info("The calculation was stopped by the convergence monitor")
+            finished = True
+        if not finished:
+            return ASDCalculation.exit_codes.WallTimeError
+        if failed_files:
+            return ASDCalculation.exit_codes.ParsingError
+        return ExitCode(0)
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Reductions of UppASD time series (averages, totenergy, sknumber, cumulants, ...).
+
+The parser uses them to store decimated tables instead of the full resolution ones, see the parser option
+"reduce_dict" in UppASD_Parsers. One entry of reduce_dict looks like:
+
+"averages*": {"stride": 10}          keep every 10th row
+"totenergy*": {"block": 100}         average blocks of 100 rows
+"sknumber*": {"last": 50}            keep the last 50 rows only
+
+Additional keys of an entry are "tail_fraction" (the part of the table used for the summary statistics, default 0.5)
+and "keep_full" (also store the full table as <name>_full).
+
+The summary statistics of the tail are stored as <name>_stats, a (3, n_cols) array with the rows mean, std and the
+integrated autocorrelation time (in rows) of each column.
+
+The mean and std of the tail of the observables (see the parser option "summary_name_list") are also stored in the
+output observables (Dict) of the calculation, so the results of many calculations can be collected with one query, see
+UppASD_Results.
+"""
+import numpy as np
+from aiida_uppasd2.UppASD_Schemas import apply_schema, to_plain_array
+
+
+def reduce_table(file_type, array, stride=None, block=None, last=None):
+    # decimate a time series table, the rows are the time steps
+    if last is not None:
+        array = array[-int(last) :]
+    if stride is not None:
+        array = array[:: int(stride)]
+    if block is not None:
+        block = int(block)
+        plain_array = to_plain_array(array)
+        n_blocks = plain_array.shape[0] // block
+        # the incomplete last block is dropped
+        block_array = (
+            plain_array[: n_blocks * block]
+            .reshape(n_blocks, block, plain_array.shape[1])
+            .mean(axis=1)
+        )
+        if array.dtype.names is not None:
+            block_array = apply_schema(
+                file_type, block_array, array.dtype[-1] == np.float32
+            )
+        array = block_array
+    return array
+
+
+def autocorrelation_time(series, window_factor=5):
+    # integrated autocorrelation time with the automatic window of Sokal, nan for a constant series
+    series = np.asarray(series, dtype=np.float64)
+    n = series.shape[0]
+    series = series - series.mean()
+    if n < 2 or not np.any(series):
+        return np.nan
+    # autocorrelation function from the FFT, zero padded to avoid the circular part
+    spectrum = np.fft.rfft(series, n=2 * n)
+    acf = np.fft.irfft(spectrum * np.conjugate(spectrum))[:n]
+    acf = acf / acf[0]
+    taus = 2.0 * np.cumsum(acf) - 1.0
+    window = np.arange(n) >= window_factor * taus
+    if np.any(window):
+        return taus[np.argmax(window)]
+    return taus[-1]
+
+
+def tail_statistics(array, tail_fraction=0.5):
+    # mean, std and autocorrelation time of every column in the last tail_fraction of the rows
+    plain_array = to_plain_array(array)
+    if plain_array.shape[0] == 0:
+        return np.full((3, plain_array.shape[1]), np.nan)
+    n_tail = max(int(np.ceil(plain_array.shape[0] * tail_fraction)), 1)
+    tail = plain_array[-n_tail:]
+    return np.vstack(
+        [
+            tail.mean(axis=0),
+            tail.std(axis=0),
+            [autocorrelation_time(column) for column in tail.T],
+        ]
+    )
+
+
+def tail_summary(array, tail_fraction=0.5):
+    # mean and std of every column in the last tail_fraction of the rows, as tail_statistics without the
+    # autocorrelation time
+    plain_array = to_plain_array(array)
+    if plain_array.shape[0] == 0:
+        return np.full((2, plain_array.shape[1]), np.nan)
+    n_tail = max(int(np.ceil(plain_array.shape[0] * tail_fraction)), 1)
+    tail = plain_array[-n_tail:]
+    return np.vstack([tail.mean(axis=0), tail.std(axis=0)])
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar results of many UppASD calculations, e.g. the points of a GenericLoopWorkflow sweep.
+
+The parser stores the mean and std over the tail of the observables (averages, totenergy, sknumber, cumulants, see the
+parser option "summary_name_list") in the output observables (Dict) of every calculation. collect_observables fetches
+these small outputs for thousands of points with one query, instead of loading the ArrayData of every point, and
+results_to_arrays puts them into one table with a row per point:
+
+tag                    (n,)          the tag of the point in the loop
+pk                     (n,)          the pk of the sub workflow (or packed calculation) of the point
+parameter_<key>        (n, dim)      the swept value of every loop key, as strings if it is not numeric
+<file type>_mean       (n, n_cols)   the tail mean of every column, nan if the point has no such file
+<file type>_std        (n, n_cols)   the tail std of every column
+
+The loop workflow stores this table as the output loop_results (ArrayData), it can be written to a csv or parquet file
+with 'verdi data asd loop_results PK'.
+"""
+import numpy as np
+from aiida import orm
+
+
+def collect_observables(point_pks):
+    # {pk: observables} of the points, the points are sub workflows (their last calculation with observables is used)
+    # or calculations, for a packed calculation the observables of all members keyed by the label
+    observables = {}
+    # calculations given directly (packed calculations)
+    qb = orm.QueryBuilder()
+    qb.append(
+        orm.CalcJobNode,
+        filters={"id": {"in": list(point_pks)}},
+        project=["id"],
+        tag="calculation",
+    )
+    qb.append(
+        orm.Dict,
+        with_incoming="calculation",
+        edge_filters={"label": "observables"},
+        project=["attributes"],
+    )
+    for pk, calc_observables in qb.iterall():
+        observables[pk] = calc_observables
+    # the calculations called by the sub workflows, the restarts of one workflow are ordered by pk
+    qb = orm.QueryBuilder()
+    qb.append(
+        orm.WorkflowNode,
+        filters={"id": {"in": list(point_pks)}},
+        project=["id"],
+        tag="workflow",
+    )
+    qb.append(
+        orm.CalcJobNode,
+        with_incoming="workflow",
+        project=["id"],
+        tag="calculation",
+    )
+    qb.append(
+        orm.Dict,
+        with_incoming="calculation",
+        edge_filters={"label": "observables"},
+        project=["attributes"],
+    )
+    last_calculation = {}
+    for pk, calc_pk, calc_observables in qb.iterall():
+        if calc_pk > last_calculation.get(pk, -1):
+            last_calculation[pk] = calc_pk
+            observables[pk] = calc_observables
+    return observables
+
+
+def parameter_to_array(values):
+    # swept values of one key ("10", "0 0 10" or ["0", "0", "10"]) -> (n, dim) float array, strings if not numeric
+    tokens = [
+        value.split() if isinstance(value, str) else list(value) for value in values
+    ]
+    try:
+        return np.array(tokens, dtype=np.float64).reshape(len(values), -1)
+    except ValueError:
+        return np.array([" ".join(map(str, token)) for token in tokens])
+
+
+def results_to_arrays(keys, points, observables):
+    # points: list of (tag, combination, pk, label), one row per point, label is the member of a packed calculation
+    # (None otherwise). The columns of an observable are padded with nan to the widest point.
+    point_observables = []
+    for _, _, pk, label in points:
+        calc_observables = observables.get(pk, {})
+        if label is not None:
+            calc_observables = calc_observables.get(label, {})
+        point_observables.append(calc_observables)
+    arrays = {
+        "tag": np.array([tag for tag, _, _, _ in points]),
+        "pk": np.array([pk for _, _, pk, _ in points], dtype=np.int64),
+    }
+    for i, key in enumerate(keys):
+        arrays[f"parameter_{key}"] = parameter_to_array(
+            [combination[i] for _, combination, _, _ in points]
+        )
+    file_types = sorted(
+        {
+            file_type
+            for calc_observables in point_observables
+            for file_type in calc_observables
+        }
+    )
+    for file_type in file_types:
+        for row_name in ["mean", "std"]:
+            rows = [
+                calc_observables.get(file_type, {}).get(row_name) or []
+                for calc_observables in point_observables
+            ]
+            table = np.full((len(points), max(len(row) for row in rows)), np.nan)
+            for j, row in enumerate(rows):
+                table[j, : len(row)] = [
+                    np.nan if value is None else value for value in row
+                ]
+            arrays[f"{file_type}_{row_name}"] = table
+    return arrays
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Column schemas for the parsed UppASD output tables.
+
+By default every parsed table is stored as one float64 matrix. With the parser option "typed_columns" the tables of
+the file types listed here are stored as numpy structured arrays instead, i.e. every column has a name and a proper
+type: iteration counters and atom/ensemble indices become int32 and (with the parser option "float32") the
+observables can be stored in single precision.
+
+Columns that are not named in the schema (e.g. new energy terms in totenergy) get the name col<i> and are float.
+
+Use to_plain_array to get the old 2D float64 matrix back and table_to_list to get python rows with int indices.
+"""
+import numpy as np
+from numpy.lib import recfunctions
+
+# file type: (names of the leading int columns, names of the following float columns)
+OUTPUT_SCHEMAS = {
+    "restart": (["iter", "ens", "atom"], ["mom", "mx", "my", "mz"]),
+    "moment": (["iter", "ens", "atom"], ["mom", "mx", "my", "mz"]),
+    "coord": (["atom"], ["x", "y", "z"]),
+    "averages": (["iter"], ["Mx", "My", "Mz", "M", "M_stdv"]),
+    "totenergy": (
+        ["iter"],
+        [
+            "tot",
+            "exc",
+            "ani",
+            "dm",
+            "pd",
+            "biqdm",
+            "bq",
+            "dip",
+            "zeeman",
+            "lsf",
+            "chir",
+            "ring",
+            "sa",
+        ],
+    ),
+    "sknumber": (["iter"], ["skx_num", "skx_avg", "skx_std"]),
+    "mcinitial": (["iter"], ["M_avg", "U_bind", "susc"]),
+    "cumulants": (["iter"], []),
+}
+
+# coord has two int columns (atom type and atom number) after the coordinates
+OUTPUT_TRAILING_INT_SCHEMAS = {
+    "coord": ["atype", "anumb"],
+}
+
+
+def get_dtype(file_type, n_cols, float32=False):
+    # return the structured dtype of a table with n_cols columns, None if the file type has no schema
+    if file_type not in OUTPUT_SCHEMAS:
+        return None
+    float_type = np.float32 if float32 else np.float64
+    int_names, float_names = OUTPUT_SCHEMAS[file_type]
+    trailing_int_names = OUTPUT_TRAILING_INT_SCHEMAS.get(file_type, [])
+    fields = []
+    for i in range(n_cols):
+        if i < len(int_names):
+            fields.append((int_names[i], np.int32))
+        elif i < len(int_names) + len(float_names):
+            fields.append((float_names[i - len(int_names)], float_type))
+        elif i - len(int_names) - len(float_names) < len(trailing_int_names):
+            fields.append(
+                (trailing_int_names[i - len(int_names) - len(float_names)], np.int32)
+            )
+        else:
+            fields.append((f"col{i}", float_type))
+    return np.dtype(fields)
+
+
+def apply_schema(file_type, array, float32=False):
+    # convert a 2D float table into a structured array following the schema of its file type
+    if array.dtype.names is not None or array.ndim != 2:
+        return array
+    dtype = get_dtype(file_type, array.shape[1], float32)
+    if dtype is None:
+        return array
+    # the values are integers written as text, so rounding before the cast is safe
+    typed_array = np.empty(array.shape[0], dtype=dtype)
+    for i, name in enumerate(dtype.names):
+        if np.issubdtype(dtype[name], np.integer):
+            typed_array[name] = np.rint(array[:, i])
+        else:
+            typed_array[name] = array[:, i]
+    return typed_array
+
+
+def to_plain_array(array):
+    # return the parsed table as a 2D float64 matrix, both for plain and structured arrays
+    if array.dtype.names is None:
+        return array
+    return recfunctions.structured_to_unstructured(array, dtype=np.float64)
+
+
+def table_to_list(file_type, array):
+    # return the rows of a parsed table as python lists, index columns are python ints
+    return [list(row) for row in apply_schema(file_type, array).tolist()]
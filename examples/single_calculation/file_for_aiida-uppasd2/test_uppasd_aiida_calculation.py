@@ -11,6 +11,7 @@ from aiida import orm, load_profile
 from aiida.plugins import CalculationFactory
 from aiida.engine import submit
 import pickle
+from aiida_uppasd2.UppASD_Inputs import split_input_dict
 
 load_profile()
 code = orm.load_code("local_code_uppasd@localhost")
@@ -21,9 +22,12 @@ with open("./uppasd_aiida2_input.pkl", "rb") as f:
     inpsd_dict_load = pickle.load(f)
 
 
+# the tables (jij, dmdata, momfile, posfile) go into ArrayData nodes, only the inpsd tags stay in the Dict
+inpsd_dict_load, input_files = split_input_dict(inpsd_dict_load)
 input_dict = orm.Dict(dict=inpsd_dict_load)
 builder.code = code
 builder.input_dict = input_dict
+builder.input_files = input_files
 builder.retrieve_and_parse_name_list = orm.List(["totenergy*", "restart*"])
 builder.metadata.options.resources = {"num_machines": 1, "num_mpiprocs_per_machine": 8}
 builder.metadata.options.max_wallclock_seconds = 55
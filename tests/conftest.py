@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+Fixtures for the tests of aiida-uppasd2, the AiiDA profile is a temporary one from aiida.tools.pytest_fixtures.
+"""
+import io
+import os
+import pytest
+from aiida import orm
+from aiida.common.links import LinkType
+from aiida.plugins import ParserFactory
+
+pytest_plugins = ["aiida.tools.pytest_fixtures"]
+
+EXAMPLE_FOLDER = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    os.pardir,
+    "examples",
+    "single_calculation",
+    "single_UppASD_calculation",
+)
+
+
+@pytest.fixture
+def example_path():
+    # path of a file of the example calculation
+    def _example_path(file_name):
+        return os.path.join(EXAMPLE_FOLDER, file_name)
+
+    return _example_path
+
+
+@pytest.fixture
+def example_file():
+    # content (bytes) of a file of the example calculation
+    def _example_file(file_name):
+        with open(os.path.join(EXAMPLE_FOLDER, file_name), "rb") as handle:
+            return handle.read()
+
+    return _example_file
+
+
+@pytest.fixture
+def generate_calc_job_node(aiida_localhost):
+    # A stored CalcJobNode of asd_calculations with the given inputs and retrieved files {name: bytes},
+    # the scheduler stdout says the simulation is finished unless stdout is given
+    def _generate_calc_job_node(
+        files,
+        retrieve_and_parse_name_list,
+        input_dict=None,
+        parser_options=None,
+        stdout=b"Simulation finished\n",
+        process_type="aiida.calculations:asd_calculations",
+        extra_inputs=None,
+    ):
+        node = orm.CalcJobNode(computer=aiida_localhost, process_type=process_type)
+        node.set_option("resources", {"num_machines": 1})
+        if input_dict is None:
+            input_dict = {"inpsd": {"simid": ["SCsurf_T"]}}
+        inputs = {
+            "input_dict": orm.Dict(input_dict),
+            "retrieve_and_parse_name_list": orm.List(retrieve_and_parse_name_list),
+        }
+        if parser_options is not None:
+            inputs["parser_options"] = orm.Dict(parser_options)
+        inputs.update(extra_inputs or {})
+        for link_label, input_node in inputs.items():
+            input_node.store()
+            node.base.links.add_incoming(input_node, LinkType.INPUT_CALC, link_label)
+        node.store()
+        retrieved = orm.FolderData()
+        for file_name, content in files.items():
+            retrieved.base.repository.put_object_from_filelike(
+                io.BytesIO(content), file_name
+            )
+        if stdout is not None:
+            retrieved.base.repository.put_object_from_filelike(
+                io.BytesIO(stdout), "_scheduler-stdout.txt"
+            )
+        retrieved.base.links.add_incoming(node, LinkType.CREATE, "retrieved")
+        retrieved.store()
+        return node
+
+    return _generate_calc_job_node
+
+
+@pytest.fixture
+def parse_node():
+    # run a parser on a CalcJobNode, returns the outputs and the node of the parse calcfunction
+    def _parse_node(node, entry_point="asd_parsers"):
+        return ParserFactory(entry_point).parse_from_node(node, store_provenance=False)
+
+    return _parse_node
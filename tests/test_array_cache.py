@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of UppASD_ArrayCache, the cache folder is a temporary folder.
+"""
+import os
+import numpy as np
+import pytest
+from aiida import orm
+from aiida_uppasd2.UppASD_ArrayCache import ArrayCache, get_cached_array
+
+
+def make_array_node(n_rows, store=True):
+    array_node = orm.ArrayData()
+    array_node.set_array(
+        "restart", np.arange(n_rows * 7, dtype=np.float64).reshape(-1, 7)
+    )
+    if store:
+        array_node.store()
+    return array_node
+
+
+@pytest.fixture
+def count_copies(monkeypatch):
+    # the paths of the copies made from the repository
+    copies = []
+    add_array = ArrayCache.add_array
+
+    def counted_add_array(self, node, array_name, path):
+        copies.append(path)
+        add_array(self, node, array_name, path)
+
+    monkeypatch.setattr(ArrayCache, "add_array", counted_add_array)
+    return copies
+
+
+def test_cache_hit(aiida_profile, tmp_path, count_copies):
+    # the second access is a memory map of the same local copy and marks it as used
+    array_node = make_array_node(100)
+    cache = ArrayCache(str(tmp_path))
+    array = cache.get_array(array_node, "restart")
+    assert isinstance(array, np.memmap)
+    np.testing.assert_array_equal(array, array_node.get_array("restart"))
+    path = cache.get_path(array_node, "restart")
+    os.utime(path, (1, 1))
+
+    array = cache.get_array(array_node, "restart")
+    np.testing.assert_array_equal(array, array_node.get_array("restart"))
+    assert count_copies == [path]
+    assert os.stat(path).st_mtime > 1
+
+
+def test_cache_modified_node(aiida_profile, tmp_path, count_copies):
+    # a change of the node (here its extras) changes its mtime, the old copy is replaced
+    array_node = make_array_node(100)
+    cache = ArrayCache(str(tmp_path))
+    cache.get_array(array_node, "restart")
+    old_path = cache.get_path(array_node, "restart")
+    array_node.base.extras.set("note", "modified")
+    new_path = cache.get_path(array_node, "restart")
+    assert new_path != old_path
+
+    array = cache.get_array(array_node, "restart")
+    np.testing.assert_array_equal(array, array_node.get_array("restart"))
+    assert count_copies == [old_path, new_path]
+    assert not os.path.exists(old_path)
+    assert os.listdir(os.path.dirname(new_path)) == [os.path.basename(new_path)]
+
+
+def test_cache_eviction(aiida_profile, tmp_path):
+    # room for two arrays, the least recently used array and its folders are removed
+    array_nodes = [make_array_node(1000) for _ in range(3)]
+    array_size = array_nodes[0].get_array("restart").nbytes + 128
+    cache = ArrayCache(str(tmp_path), max_size=2.5 * array_size / 1024**3)
+    paths = [cache.get_path(array_node, "restart") for array_node in array_nodes]
+    for array_node, access_time in zip(array_nodes[:2], [1, 2]):
+        cache.get_array(array_node, "restart")
+        os.utime(cache.get_path(array_node, "restart"), (access_time, access_time))
+    # the first array is used again, so the second one is the least recently used
+    cache.get_array(array_nodes[0], "restart")
+
+    cache.get_array(array_nodes[2], "restart")
+    assert [os.path.exists(path) for path in paths] == [True, False, True]
+    assert not os.path.exists(os.path.join(str(tmp_path), array_nodes[1].uuid))
+
+
+def test_cache_unstored_node(tmp_path):
+    # unstored nodes are read from the node, nothing is written to the cache
+    array_node = make_array_node(10, store=False)
+    array = ArrayCache(str(tmp_path)).get_array(array_node, "restart")
+    np.testing.assert_array_equal(array, array_node.get_array("restart"))
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_get_cached_array(aiida_profile, tmp_path, monkeypatch):
+    # the cache folder from the environment, an unknown array raises a KeyError
+    monkeypatch.setenv("AIIDA_UPPASD2_ARRAY_CACHE", str(tmp_path))
+    array_node = make_array_node(10)
+    array = get_cached_array(array_node, "restart")
+    np.testing.assert_array_equal(array, array_node.get_array("restart"))
+    assert os.listdir(str(tmp_path)) == [array_node.uuid]
+    with pytest.raises(KeyError):
+        get_cached_array(array_node, "moment")
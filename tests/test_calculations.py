@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of UppASD_Calculations, the calcinfo of prepare_for_submission and the shell lines of the remote restart.
+"""
+import gzip
+import os
+import subprocess
+import pytest
+from aiida import orm
+from aiida.common.folders import Folder
+from aiida.common.links import LinkType
+from aiida.engine.utils import instantiate_process
+from aiida.manage import get_manager
+from aiida.plugins import CalculationFactory
+from aiida_uppasd2.UppASD_Inputs import canonicalize_input_dict
+
+ASDCalculation = CalculationFactory("asd_calculations")
+
+
+@pytest.fixture
+def prepare_calculation(aiida_code_installed, tmp_path):
+    # calcinfo and the folder of the written input files of asd_calculations
+    def _prepare_calculation(**inputs):
+        code = aiida_code_installed(
+            default_calc_job_plugin="asd_calculations", filepath_executable="/bin/true"
+        )
+        inputs.setdefault(
+            "input_dict", orm.Dict({"inpsd": {"simid": ["SCsurf_T"], "Nstep": ["100"]}})
+        )
+        inputs.setdefault("retrieve_and_parse_name_list", orm.List(["averages*"]))
+        inputs["code"] = code
+        inputs["metadata"] = {"options": {"resources": {"num_machines": 1}}}
+        process = instantiate_process(
+            get_manager().get_runner(), ASDCalculation, **inputs
+        )
+        (tmp_path / "sandbox").mkdir()
+        folder = Folder(str(tmp_path / "sandbox"))
+        return process.prepare_for_submission(folder), folder
+
+    return _prepare_calculation
+
+
+def generate_parent_folder(
+    generate_calc_job_node, aiida_localhost, remote_path, compress
+):
+    # the remote folder of a finished parent calculation, with or without restart* in compress_name_list
+    extra_inputs = {}
+    if compress is not None:
+        extra_inputs = {
+            "compress_name_list": orm.List(["restart*"]),
+            "compress_format": orm.Str(compress),
+        }
+    parent = generate_calc_job_node({}, [], extra_inputs=extra_inputs)
+    remote_folder = orm.RemoteData(computer=aiida_localhost, remote_path=remote_path)
+    remote_folder.base.links.add_incoming(parent, LinkType.CREATE, "remote_folder")
+    return remote_folder.store()
+
+
+def run_prepend_text(calcinfo, folder, working_directory):
+    # link the remote files and run the prepend text in the working directory, as the scheduler job does
+    folder_path = folder.abspath
+    for file_name in os.listdir(folder_path):
+        os.rename(
+            os.path.join(folder_path, file_name),
+            os.path.join(working_directory, file_name),
+        )
+    for _, source, target in calcinfo.remote_symlink_list:
+        os.symlink(source, os.path.join(working_directory, target))
+    subprocess.run(
+        ["bash", "-e", "-c", calcinfo.prepend_text], cwd=working_directory, check=True
+    )
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_remote_restart_compressed_parent(
+    prepare_calculation,
+    generate_calc_job_node,
+    aiida_localhost,
+    example_file,
+    tmp_path,
+    compressed,
+):
+    # the parent compressed its restart file (gzip removes the original) if it finished, and not if it hit the
+    # walltime; the next calculation reads the restart file in both cases
+    restart = example_file("restart.SCsurf_T.out")
+    parent_path = tmp_path / "parent"
+    parent_path.mkdir()
+    (parent_path / "inpsd.dat").write_text("simid SCsurf_T\nNstep 100\n")
+    if compressed:
+        (parent_path / "restart.SCsurf_T.out.gz").write_bytes(gzip.compress(restart))
+    else:
+        (parent_path / "restart.SCsurf_T.out").write_bytes(restart)
+    parent_folder = generate_parent_folder(
+        generate_calc_job_node, aiida_localhost, str(parent_path), "gzip"
+    )
+    calcinfo, folder = prepare_calculation(
+        parent_folder=parent_folder, restart_step_tag=orm.Str("Nstep")
+    )
+    working_directory = tmp_path / "work"
+    working_directory.mkdir()
+    run_prepend_text(calcinfo, folder, str(working_directory))
+
+    assert (working_directory / "restart").read_bytes() == restart
+    # the files of the parent are not changed
+    assert sorted(os.listdir(parent_path)) == sorted(
+        ["inpsd.dat", "restart.SCsurf_T.out" + (".gz" if compressed else "")]
+    )
+    iteration = int((working_directory / "restart_iteration.txt").read_text())
+    assert f"Nstep {100 - iteration}" in (working_directory / "inpsd.dat").read_text()
+
+
+def test_remote_restart_uncompressed_parent(
+    prepare_calculation, generate_calc_job_node, aiida_localhost, tmp_path
+):
+    parent_folder = generate_parent_folder(
+        generate_calc_job_node, aiida_localhost, str(tmp_path), None
+    )
+    calcinfo, _ = prepare_calculation(parent_folder=parent_folder)
+    assert [target for _, _, target in calcinfo.remote_symlink_list] == [
+        "restart",
+        "parent_inpsd.dat",
+    ]
+    assert "gzip" not in calcinfo.prepend_text
+
+
+def test_hash_of_canonical_input_dict(aiida_code_installed):
+    # the input_dict is linked as it is given, the canonical forms of the same inputs hash the same
+    code = aiida_code_installed(
+        default_calc_job_plugin="asd_calculations", filepath_executable="/bin/true"
+    )
+    input_dicts = [
+        {"inpsd": {"simid": ["00000001"], "temp": ["100"]}},
+        {"inpsd": {"temp": "100.000", "simid": "00000001"}},
+        {"inpsd": {"temp": [100], "simid": ["00000001"]}},
+    ]
+    hashes = []
+    for input_dict in input_dicts:
+        input_node = orm.Dict(canonicalize_input_dict(input_dict))
+        process = instantiate_process(
+            get_manager().get_runner(),
+            ASDCalculation,
+            code=code,
+            input_dict=input_node,
+            retrieve_and_parse_name_list=orm.List(["averages*"]),
+            metadata={"options": {"resources": {"num_machines": 1}}},
+        )
+        assert process.node.inputs.input_dict.uuid == input_node.uuid
+        hashes.append(process.node.base.caching.compute_hash())
+    assert len(set(hashes)) == 1
+
+    # a Dict that is not canonical is not replaced, it keeps its provenance
+    input_node = orm.Dict(input_dicts[1])
+    process = instantiate_process(
+        get_manager().get_runner(),
+        ASDCalculation,
+        code=code,
+        input_dict=input_node,
+        retrieve_and_parse_name_list=orm.List(["averages*"]),
+        metadata={"options": {"resources": {"num_machines": 1}}},
+    )
+    assert process.node.inputs.input_dict.uuid == input_node.uuid
+    assert process.node.inputs.input_dict.get_dict() == input_dicts[1]
+
+
+@pytest.mark.parametrize(
+    "chunked_name_list, valid",
+    [(["moment*", "trajectory*"], True), (["moment*", "restart*"], False)],
+)
+def test_chunked_name_list_without_restart(
+    aiida_code_installed, chunked_name_list, valid
+):
+    # the restart array stays in output_array, the restarts and the restart export read it from there
+    code = aiida_code_installed(
+        default_calc_job_plugin="asd_calculations", filepath_executable="/bin/true"
+    )
+    inputs = {
+        "code": code,
+        "input_dict": orm.Dict({"inpsd": {"simid": ["SCsurf_T"]}}),
+        "retrieve_and_parse_name_list": orm.List(["moment*", "restart*"]),
+        "parser_options": orm.Dict({"chunked_name_list": chunked_name_list}),
+        "metadata": {"options": {"resources": {"num_machines": 1}}},
+    }
+    if valid:
+        instantiate_process(get_manager().get_runner(), ASDCalculation, **inputs)
+    else:
+        with pytest.raises(ValueError, match="chunked_name_list"):
+            instantiate_process(get_manager().get_runner(), ASDCalculation, **inputs)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of UppASD_Clis.
+"""
+import io
+import os
+import numpy as np
+import pytest
+from aiida import orm
+from aiida.common.links import LinkType
+from aiida.manage import get_manager
+from click.testing import CliRunner
+from aiida_uppasd2.UppASD_ArrayCache import iter_npy_blocks
+from aiida_uppasd2.UppASD_Clis import parser_report, retrieve_restart_file
+
+
+def make_restart_array(n_ensembles, n_atoms):
+    # restart table: iteration, ensemble, atom, moment length and direction
+    rows = [
+        [1000, ens + 1, atom + 1, 2.2, 0.0, 0.0, 1.0]
+        for ens in range(n_ensembles)
+        for atom in range(n_atoms)
+    ]
+    return np.array(rows, dtype=np.float64)
+
+
+def pack_repository():
+    # move all loose objects of the profile into compressed packs, then the repository returns the objects as
+    # stream decompressers (read only, no readinto)
+    get_manager().get_profile_storage().get_repository().maintain(
+        live=False,
+        pack_loose=True,
+        compress=True,
+        do_repack=False,
+        clean_storage=False,
+        do_vacuum=False,
+    )
+
+
+@pytest.fixture
+def packed_restart(aiida_profile):
+    array = make_restart_array(3, 50)
+    array_node = orm.ArrayData()
+    array_node.set_array("restart", array)
+    array_node.store()
+    pack_repository()
+    return array_node, array
+
+
+def test_iter_npy_blocks_packed(packed_restart):
+    array_node, array = packed_restart
+    with array_node.base.repository.open("restart.npy", mode="rb") as handle:
+        assert not hasattr(handle, "readinto")
+        blocks = list(iter_npy_blocks(handle, 40))
+    assert [block.shape[0] for block in blocks] == [40, 40, 40, 30]
+    np.testing.assert_array_equal(np.concatenate(blocks), array)
+
+
+def test_iter_npy_blocks_truncated():
+    handle = io.BytesIO()
+    np.save(handle, make_restart_array(1, 10))
+    handle = io.BytesIO(handle.getvalue()[:-8])
+    with pytest.raises(ValueError):
+        list(iter_npy_blocks(handle, 4))
+
+
+@pytest.mark.parametrize("compress", ["none", "gzip"])
+def test_retrieve_restart_file_packed(
+    packed_restart, aiida_localhost, tmp_path, compress
+):
+    array_node, array = packed_restart
+    calc = orm.CalcJobNode(computer=aiida_localhost)
+    calc.store()
+    array_node.base.links.add_incoming(calc, LinkType.CREATE, "output_array")
+    result = CliRunner().invoke(
+        retrieve_restart_file,
+        [str(calc.pk), "-o", str(tmp_path), "-c", compress, "--block-rows", "7"],
+    )
+    assert result.exit_code == 0, result.output
+    path = os.path.join(str(tmp_path), f"restart.PK_{calc.pk}.out")
+    if compress == "gzip":
+        path += ".gz"
+    written = np.loadtxt(path, comments="#")
+    np.testing.assert_allclose(written, array)
+
+
+def make_statistics(rows, parse_time):
+    # parser_statistics extra of one calculation with an averages and a restart file
+    return {
+        "files": {
+            "averages.SCsurf_T.out": {
+                "rows": rows,
+                "columns": 6,
+                "bytes": 1024**2,
+                "parse_time": parse_time,
+            },
+            "restart.SCsurf_T.out": {
+                "rows": 10,
+                "columns": 7,
+                "bytes": None,
+                "parse_time": 0.5,
+                "peak_memory": 2 * 1024**2,
+            },
+        },
+        "failed_files": [],
+        "parse_workers": 1,
+        "set_array_time": 0.25,
+        "total_time": 2.0,
+    }
+
+
+def test_parser_report(aiida_profile, aiida_localhost):
+    # one calculation given directly and one called by the sub workflow of a workflow, the statistics are summed
+    # per file type
+    workflow = orm.WorkflowNode()
+    workflow.store()
+    sub_workflow = orm.WorkflowNode()
+    sub_workflow.base.links.add_incoming(workflow, LinkType.CALL_WORK, "call")
+    sub_workflow.store()
+    calcs = []
+    for rows, parse_time in [(100, 1.0), (300, 3.0)]:
+        calc = orm.CalcJobNode(computer=aiida_localhost)
+        if calcs:
+            calc.base.links.add_incoming(sub_workflow, LinkType.CALL_CALC, "call")
+        calc.store()
+        calc.base.extras.set("parser_statistics", make_statistics(rows, parse_time))
+        calcs.append(calc)
+
+    result = CliRunner().invoke(parser_report, [str(calcs[0].pk), str(workflow.pk)])
+    assert result.exit_code == 0, result.output
+    lines = result.output.splitlines()
+    assert lines[0].split() == [
+        "file",
+        "count",
+        "MB",
+        "read",
+        "rows",
+        "time",
+        "[s]",
+        "mean",
+        "[s]",
+        "max",
+        "[s]",
+        "peak",
+        "[MB]",
+    ]
+    # sorted by the total parse time
+    assert lines[2].split() == [
+        "averages",
+        "2",
+        "2.0",
+        "400",
+        "4.00",
+        "2.000",
+        "3.000",
+        "-",
+    ]
+    assert lines[3].split() == [
+        "restart",
+        "2",
+        "0.0",
+        "20",
+        "1.00",
+        "0.500",
+        "0.500",
+        "2.0",
+    ]
+    assert "2 calculations, total parser time 4.00 s, of which 0.50 s" in result.output
+
+    result = CliRunner().invoke(parser_report, [])
+    assert result.exit_code != 0
+
+
+@pytest.mark.parametrize(
+    "options", [["--block-rows", "7"], ["--block-rows", "7", "--cache"], ["--cache"]]
+)
+def test_retrieve_restart_file_blocks(
+    packed_restart, aiida_localhost, tmp_path, monkeypatch, options
+):
+    # the restart file written block by block (or from the cache) is the same as the one written at once
+    monkeypatch.setenv("AIIDA_UPPASD2_ARRAY_CACHE", str(tmp_path / "cache"))
+    array_node, _ = packed_restart
+    calc = orm.CalcJobNode(computer=aiida_localhost)
+    calc.store()
+    array_node.base.links.add_incoming(calc, LinkType.CREATE, "output_array")
+    contents = []
+    for output_folder, output_options in [("whole", []), ("blocks", options)]:
+        result = CliRunner().invoke(
+            retrieve_restart_file,
+            [str(calc.pk), "-o", str(tmp_path / output_folder)] + output_options,
+        )
+        assert result.exit_code == 0, result.output
+        with open(tmp_path / output_folder / f"restart.PK_{calc.pk}.out") as handle:
+            contents.append(handle.read())
+    assert contents[0] == contents[1]
+    assert os.path.exists(tmp_path / "cache" / array_node.uuid) == (
+        "--cache" in options
+    )
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of UppASD_Data.
+"""
+import numpy as np
+import pytest
+from aiida_uppasd2 import UppASD_Data
+from aiida_uppasd2.UppASD_Data import UppASD_ChunkedArrayData, get_step_layout
+
+
+def make_moment_table(n_steps, n_ensembles, n_atoms):
+    # moment table: iteration, ensemble, atom, moment length and direction
+    rows = [
+        [step * 100, ens + 1, atom + 1, 2.2, step, ens, atom]
+        for step in range(n_steps)
+        for ens in range(n_ensembles)
+        for atom in range(n_atoms)
+    ]
+    return np.array(rows, dtype=np.float64)
+
+
+@pytest.fixture
+def short_scan(monkeypatch):
+    # a step of the tables in the tests (12 rows) is longer than the rows that are scanned at a time
+    monkeypatch.setattr(UppASD_Data, "_layout_scan_rows", 5)
+
+
+def test_get_step_layout_long_step(short_scan):
+    assert get_step_layout(make_moment_table(5, 2, 6)) == {
+        "rows_per_step": 12,
+        "n_steps": 5,
+        "n_ensembles": 2,
+        "n_atoms": 6,
+    }
+
+
+def test_get_step_layout_without_steps(short_scan):
+    table = make_moment_table(5, 2, 6)
+    # the last step is cut
+    assert get_step_layout(table[:-3]) is None
+    # the steps do not have the same number of rows
+    assert get_step_layout(np.concatenate([table[:12], table[30:]])) is None
+    # one row per iteration, as averages
+    assert get_step_layout(table[::12])["rows_per_step"] == 1
+    assert get_step_layout(table[:, :2]) is None
+
+
+def make_chunked(table, chunk_rows):
+    chunked = UppASD_ChunkedArrayData()
+    chunked.set_array("moment", table, chunk_rows=chunk_rows)
+    chunked.store()
+    return chunked
+
+
+def test_get_rows(aiida_profile, short_scan):
+    # chunks of two steps, the rows are read across the chunk boundaries
+    table = make_moment_table(5, 2, 6)
+    chunked = make_chunked(table, 30)
+    info = chunked.get_info("moment")
+    assert (info["chunk_rows"], info["n_chunks"]) == (24, 3)
+    assert chunked.get_shape("moment") == table.shape
+    np.testing.assert_array_equal(chunked.get_rows("moment", 20, 50), table[20:50])
+    np.testing.assert_array_equal(chunked.get_rows("moment", -5), table[-5:])
+    assert chunked.get_rows("moment", 30, 10).shape == (0, 7)
+    np.testing.assert_array_equal(chunked.get_array("moment"), table)
+    with pytest.raises(KeyError):
+        chunked.get_rows("restart")
+
+
+def test_get_steps(aiida_profile, short_scan):
+    table = make_moment_table(5, 2, 6)
+    steps = table.reshape(5, 2, 6, 7)
+    chunked = make_chunked(table, 30)
+    np.testing.assert_array_equal(chunked.get_steps("moment", -1), steps[-1])
+    np.testing.assert_array_equal(
+        chunked.get_steps("moment", slice(0, 5, 2), ensembles=1, atoms=slice(0, 3)),
+        steps[0:5:2, 1, 0:3],
+    )
+    np.testing.assert_array_equal(chunked.get_steps("moment", [3, 1]), steps[[3, 1]])
+    np.testing.assert_array_equal(chunked.get_steps("moment"), steps)
+
+    chunked = make_chunked(table[:-3], 30)
+    assert chunked.get_layout("moment") is None
+    with pytest.raises(ValueError, match="get_rows"):
+        chunked.get_steps("moment", 0)
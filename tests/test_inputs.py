@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of UppASD_Inputs and of 'verdi data asd uppasd_raw_input_parser'.
+"""
+import os
+import pickle
+import numpy as np
+from click.testing import CliRunner
+from aiida_uppasd2.UppASD_Clis import uppasd_raw_input_parser
+from aiida_uppasd2.UppASD_Inputs import (
+    canonicalize_input_dict,
+    load_input_bundle,
+    read_inpsd,
+    split_input_dict,
+)
+
+INPUT_FILE_NAMES = ["inpsd.dat", "momfile", "jij", "dmdata", "posfile"]
+
+
+def test_read_inpsd(example_path):
+    inpsd_dict = read_inpsd(example_path("inpsd.dat"))
+    assert inpsd_dict["simid"] == ["SCsurf_T"]
+    assert inpsd_dict["ncell"] == ["60", "60", "1"]
+    assert len(inpsd_dict["cell"]) == 9
+    # the lines of a multi line tag are kept together, joined with \n
+    assert inpsd_dict["ip_mcanneal"] == [
+        "4\\n1000",
+        "100\\n1000",
+        "50\\n1000",
+        "20\\n1000",
+        "1.0001",
+    ]
+    assert inpsd_dict["timestep"] == ["1.000e-15"]
+    assert "1000" not in inpsd_dict
+
+
+def test_read_inpsd_comments(tmp_path):
+    path = tmp_path / "inpsd.dat"
+    path.write_text(
+        "simid test # the name\n# a comment\n   indented line\nmode M\nip_nphase 2\n100 0.5\n200 0.1\n"
+    )
+    assert read_inpsd(str(path)) == {
+        "simid": ["test"],
+        "mode": ["M"],
+        "ip_nphase": ["2\\n100", "0.5\\n200", "0.1"],
+    }
+
+
+def run_raw_input_parser(example_path, tmp_path, monkeypatch, *options):
+    # the raw input files of the example, written into tmp_path
+    monkeypatch.chdir(tmp_path)
+    paths = [example_path(name) for name in INPUT_FILE_NAMES]
+    result = CliRunner().invoke(uppasd_raw_input_parser, paths + list(options))
+    assert result.exit_code == 0, result.output
+
+
+def test_raw_input_parser_default_pkl(example_path, tmp_path, monkeypatch):
+    # the default output is the pkl that the examples load
+    run_raw_input_parser(example_path, tmp_path, monkeypatch)
+    assert sorted(os.listdir(tmp_path)) == ["uppasd_aiida2_input.pkl"]
+    with open(tmp_path / "uppasd_aiida2_input.pkl", "rb") as file:
+        uppasd_input_dict = pickle.load(file)
+    assert sorted(uppasd_input_dict) == sorted(["inpsd"] + INPUT_FILE_NAMES[1:])
+    assert uppasd_input_dict["inpsd"]["simid"] == ["SCsurf_T"]
+
+
+def test_raw_input_parser_npz_bundle(example_path, tmp_path, monkeypatch):
+    # the npz bundle gives the same inputs as the pkl through split_input_dict
+    run_raw_input_parser(example_path, tmp_path, monkeypatch, "-f", "pkl")
+    run_raw_input_parser(example_path, tmp_path, monkeypatch, "-f", "npz")
+    with open(tmp_path / "uppasd_aiida2_input.pkl", "rb") as file:
+        input_dict, input_files = split_input_dict(pickle.load(file))
+    bundle_dict, bundle_files = load_input_bundle(str(tmp_path / "uppasd_aiida2_input"))
+    assert bundle_dict == input_dict
+    assert sorted(bundle_files) == sorted(input_files)
+    for file_name, array_data in input_files.items():
+        np.testing.assert_allclose(
+            bundle_files[file_name].get_array("table"), array_data.get_array("table")
+        )
+
+
+def test_canonicalize_input_dict():
+    canonical_dict = canonicalize_input_dict(
+        {
+            "inpsd": {
+                "temp": "1.00000",
+                "timestep": ["1.0E-15"],
+                "Nstep": 10000,
+                "ncell": "60  60 1",
+                "BC": ["P", "P", "0"],
+                "ip_mcanneal": ["2\\n1000", "100.000\\n1000", "50"],
+            },
+            "jij": [["1", "2", "0.50", 1.0]],
+        }
+    )
+    assert canonical_dict == {
+        "inpsd": {
+            "BC": ["P", "P", "0"],
+            "Nstep": ["10000"],
+            "ip_mcanneal": ["2\\n1000", "100.000\\n1000", "50"],
+            "ncell": ["60", "60", "1"],
+            "temp": ["1"],
+            "timestep": ["1e-15"],
+        },
+        "jij": [[1, 2, 0.5, 1.0]],
+    }
+    assert list(canonical_dict["inpsd"]) == sorted(canonical_dict["inpsd"])
+    assert canonicalize_input_dict(canonical_dict) == canonical_dict
+
+
+def test_canonicalize_name_tags():
+    # the run name and the file names are not numbers, even if they look like one
+    canonical_dict = canonicalize_input_dict(
+        {
+            "inpsd": {
+                "simid": "00000001",
+                "posfile": "./1.0",
+                "exchange": ["007"],
+                "restartfile": ["1e3"],
+                "temp": "001",
+            }
+        }
+    )
+    assert canonical_dict["inpsd"] == {
+        "exchange": ["007"],
+        "posfile": ["./1.0"],
+        "restartfile": ["1e3"],
+        "simid": ["00000001"],
+        "temp": ["1"],
+    }
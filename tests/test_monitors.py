@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of UppASD_Monitors, the files of the running calculation are the output of a mocked transport.
+"""
+import io
+from types import SimpleNamespace
+import numpy as np
+from aiida.common import AttributeDict
+from aiida_uppasd2.UppASD_Monitors import convergence_monitor, is_converged
+
+
+class MockTransport:
+    # exec_command_wait returns the last lines of the given tables, like tail -n on the cluster
+    def __init__(self, tables, truncated=""):
+        self.tables = tables
+        self.truncated = truncated
+        self.commands = []
+
+    def exec_command_wait(self, command):
+        self.commands.append(command)
+        window = int(command.split()[2])
+        file_type = command.split("/")[-1].split(".")[0]
+        if file_type not in self.tables:
+            return 1, "", "tail: cannot open"
+        handle = io.StringIO()
+        np.savetxt(handle, self.tables[file_type][-window:], fmt="%.8e")
+        return 0, handle.getvalue() + self.truncated, ""
+
+
+class MockNode:
+    def __init__(self):
+        self.inputs = AttributeDict({"input_dict": {"inpsd": {"simid": ["SCsurf_T"]}}})
+        self.extras = {}
+        self.base = SimpleNamespace(extras=SimpleNamespace(set=self.extras.__setitem__))
+
+    def get_remote_workdir(self):
+        return "/scratch/work"
+
+
+def make_table(n_rows, drift=0.0, noise=0.0, columns=6):
+    # iteration column and observables around 0.5 with a linear drift and gaussian noise
+    rng = np.random.default_rng(0)
+    iterations = np.arange(n_rows) * 100.0
+    values = 0.5 + drift * np.arange(n_rows) / n_rows
+    values = values[:, None] + noise * rng.normal(size=(n_rows, columns - 1))
+    return np.column_stack([iterations, values])
+
+
+def test_is_converged_drift():
+    # the means of the two halves of the window are compared relative to the mean
+    flat = make_table(400, noise=1e-5)
+    assert is_converged(flat, [4], 200, 1e-3, 1e-8, None)
+    drifting = make_table(400, drift=0.01, noise=1e-5)
+    assert not is_converged(drifting, [4], 200, 1e-3, 1e-8, None)
+    assert is_converged(drifting, [4], 200, 1e-1, 1e-8, None)
+    # fewer rows than the window
+    assert not is_converged(flat, [4], 500, 1e-3, 1e-8, None)
+    # the relative std of the window
+    noisy = make_table(400, noise=1e-2)
+    assert is_converged(noisy, [4], 200, 1e-1, 1e-8, None)
+    assert not is_converged(noisy, [4], 200, 1e-1, 1e-8, 1e-3)
+    # a column around zero is compared with the absolute tolerance
+    zero = np.column_stack([np.arange(400), 1e-15 * np.arange(400)])
+    assert is_converged(zero, [1], 200, 1e-3, 1e-8, None)
+    assert not is_converged(zero, [1], 200, 1e-3, 1e-14, None)
+
+
+def test_convergence_monitor_converged():
+    node = MockNode()
+    tables = {"averages": make_table(300), "totenergy": make_table(300, columns=14)}
+    # the last line is being written when the file is tailed, it is left out
+    transport = MockTransport(tables, truncated="  30000 5.0e-01 5.0")
+    result = convergence_monitor(node, transport, window=200)
+    assert result is not None and not result.override_exit_code
+    assert transport.commands == [
+        "tail -n 200 /scratch/work/averages.SCsurf_T.out",
+        "tail -n 200 /scratch/work/totenergy.SCsurf_T.out",
+    ]
+    assert node.extras["convergence_monitor"] == {
+        "converged": True,
+        "iterations": {"averages": 29900, "totenergy": 29900},
+        "window": 200,
+    }
+
+
+def test_convergence_monitor_not_converged():
+    node = MockNode()
+    # totenergy drifts
+    tables = {
+        "averages": make_table(300),
+        "totenergy": make_table(300, drift=0.1, columns=14),
+    }
+    assert convergence_monitor(node, MockTransport(tables), window=200) is None
+    # totenergy is not written yet
+    tables = {"averages": make_table(300)}
+    assert convergence_monitor(node, MockTransport(tables), window=200) is None
+    # only the given columns are monitored
+    tables = {"averages": make_table(300, drift=0.1)}
+    transport = MockTransport(tables)
+    assert convergence_monitor(node, transport, columns={"averages": [4]}) is None
+    assert (
+        convergence_monitor(
+            node, transport, columns={"averages": [4]}, drift_tolerance=0.2
+        )
+        is not None
+    )
+    assert "convergence_monitor" in node.extras
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of UppASD_PackedParsers and of the state of the packed points in the loop workflow.
+"""
+from aiida import orm
+from aiida.common import AttributeDict
+from aiida.common.links import LinkType
+from aiida_uppasd2.UppASD_GenericLoopWorkflow import GenericLoopWorkflow
+
+
+def generate_packed_node(generate_calc_job_node, example_file, finished_labels):
+    # a packed calculation of two members, the members in finished_labels have the example averages and stdout
+    files = {}
+    for label in finished_labels:
+        files[f"pack_{label}/averages.SCsurf_T.out"] = example_file(
+            "averages.SCsurf_T.out"
+        )
+        files[f"pack_{label}/uppasd.out"] = b"Simulation finished\n"
+    input_dicts = {
+        f"input_dicts__{label}": orm.Dict({"inpsd": {"simid": ["SCsurf_T"]}})
+        for label in ["member_0", "member_1"]
+    }
+    return generate_calc_job_node(
+        files,
+        ["averages*"],
+        process_type="aiida.calculations:asd_packed_calculations",
+        extra_inputs=input_dicts,
+    )
+
+
+def test_packed_parser_pack_status(generate_calc_job_node, example_file, parse_node):
+    node = generate_packed_node(generate_calc_job_node, example_file, ["member_0"])
+    outputs, calcfunction = parse_node(node, "asd_packed_parsers")
+    assert calcfunction.exit_status == 451
+    assert outputs["pack_status"].get_dict() == {
+        "member_0": "finished",
+        "member_1": "walltime",
+    }
+    assert "averages" in outputs["output_arrays"]["member_0"].get_arraynames()
+    # the state is an output and not an extra, the extras are not copied to cached calculations
+    assert "pack_status" not in node.base.extras.keys()
+
+
+def test_is_point_finished_ok_reads_output(
+    generate_calc_job_node, example_file, parse_node
+):
+    node = generate_packed_node(
+        generate_calc_job_node, example_file, ["member_0", "member_1"]
+    )
+    outputs, _ = parse_node(node, "asd_packed_parsers")
+    workflow = AttributeDict(
+        {
+            "ctx": AttributeDict(
+                {
+                    "pack_members": {"a": ["pack_0", "member_1"]},
+                    "pack_0": node,
+                }
+            )
+        }
+    )
+    assert not GenericLoopWorkflow.is_point_finished_ok(workflow, "a")
+    pack_status = outputs["pack_status"].store()
+    pack_status.base.links.add_incoming(node, LinkType.CREATE, "pack_status")
+    assert GenericLoopWorkflow.is_point_finished_ok(workflow, "a")
+
+
+def test_packed_parser_observables(generate_calc_job_node, example_file, parse_node):
+    node = generate_packed_node(
+        generate_calc_job_node, example_file, ["member_0", "member_1"]
+    )
+    outputs, calcfunction = parse_node(node, "asd_packed_parsers")
+    assert calcfunction.exit_status == 0
+    observables = outputs["observables"].get_dict()
+    assert set(observables) == {"member_0", "member_1"}
+    assert set(observables["member_0"]["averages"]) == {"mean", "std"}
+    assert "observables" not in node.base.extras.keys()
+
+
+def test_packed_parser_walltime_before_parsing_error(
+    generate_calc_job_node, example_file, parse_node
+):
+    # member_1 was stopped in the middle of the run with a broken file, it is restarted and not a parsing error
+    node = generate_calc_job_node(
+        {
+            "pack_member_0/averages.SCsurf_T.out": example_file(
+                "averages.SCsurf_T.out"
+            ),
+            "pack_member_0/uppasd.out": b"Simulation finished\n",
+            "pack_member_1/averages.SCsurf_T.out": b"1 2 3\n4 5\n6 7 8\n",
+        },
+        ["averages*"],
+        process_type="aiida.calculations:asd_packed_calculations",
+        extra_inputs={
+            f"input_dicts__{label}": orm.Dict({"inpsd": {"simid": ["SCsurf_T"]}})
+            for label in ["member_0", "member_1"]
+        },
+    )
+    outputs, calcfunction = parse_node(node, "asd_packed_parsers")
+    assert calcfunction.exit_status == 451
+    assert outputs["pack_status"].get_dict() == {
+        "member_0": "finished",
+        "member_1": "walltime",
+    }
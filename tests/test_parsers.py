@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of UppASD_Parsers.
+"""
+import io
+import time
+import numpy as np
+import pytest
+from aiida_uppasd2.UppASD_Parsers import UppASD_Parsers
+from aiida_uppasd2.UppASD_Schemas import apply_schema, to_plain_array
+from aiida_uppasd2.UppASD_Reductions import autocorrelation_time, reduce_table
+
+
+def make_aniso_file(n_atoms, constant=False):
+    # aniso.out: one header line and 4 lines per atom, the easy axis in the 3rd and the constants in the 4th line
+    if constant:
+        record = b"  atom\n  1\n  0.0 0.0 1.0\n  0.5 0.1\n"
+        return b"# aniso\n" + record * n_atoms
+    lines = [b"# aniso"]
+    for i in range(n_atoms):
+        lines += [
+            b"  atom %d" % (i + 1),
+            b"  1",
+            b"  %.1f 0.0 1.0" % i,
+            b"  %.1f %.1f" % (0.5 * i, 0.1),
+        ]
+    return b"\n".join(lines) + b"\n"
+
+
+@pytest.fixture
+def parser(generate_calc_job_node):
+    return UppASD_Parsers(generate_calc_job_node({}, []))
+
+
+def test_aniso_struct_out_parser(parser):
+    aniso = parser.aniso_struct_out_parser(io.BytesIO(make_aniso_file(3)))
+    expected = np.array(
+        [
+            [0.0, 0.0, 0.0, 1.0, 0.0, 0.1],
+            [1.0, 1.0, 0.0, 1.0, 0.5, 0.1],
+            [2.0, 2.0, 0.0, 1.0, 1.0, 0.1],
+        ]
+    )
+    np.testing.assert_allclose(aniso, expected)
+    assert parser.aniso_struct_out_parser(io.BytesIO(b"# aniso\n")).shape == (0, 1)
+
+
+def test_aniso_struct_out_parser_scales_linearly(parser):
+    # 10^5 and 10^6 atoms: a linear parser takes about 10 times longer for the large file, the old one with one
+    # np.vstack per atom was quadratic (100 times)
+    timings = {}
+    for n_atoms in [10**5, 10**6]:
+        content = make_aniso_file(n_atoms, constant=True)
+        start_time = time.perf_counter()
+        aniso = parser.aniso_struct_out_parser(io.BytesIO(content))
+        timings[n_atoms] = time.perf_counter() - start_time
+        assert aniso.shape == (n_atoms, 6)
+        np.testing.assert_array_equal(aniso[-1], [n_atoms - 1, 0.0, 0.0, 1.0, 0.5, 0.1])
+    assert timings[10**6] / timings[10**5] < 30
+
+
+def make_moment_file(n_steps, n_ensembles, n_atoms):
+    # moment.out: iteration, ensemble, atom, |m|, mx, my, mz
+    rows = []
+    for step in range(n_steps):
+        for ensemble in range(1, n_ensembles + 1):
+            for atom in range(1, n_atoms + 1):
+                rows.append(
+                    [step * 100, ensemble, atom, 1.0, 0.1 * step, 0.01 * atom, 0.5]
+                )
+    handle = io.BytesIO()
+    np.savetxt(handle, rows, fmt="%.8g", header="iter ens iatom |Mom| M_x M_y M_z")
+    return handle.getvalue(), np.array(rows)
+
+
+def test_stream_parse_matches_full_parse(generate_calc_job_node, parse_node):
+    # the moment file is read 7 rows at a time into an on-disk array, the result is the same as a full read
+    content, expected = make_moment_file(5, 2, 4)
+    node = generate_calc_job_node(
+        {"moment.SCsurf_T.out": content},
+        ["moment*"],
+        parser_options={"stream_name_list": ["moment*"], "stream_chunk_rows": 7},
+    )
+    results, calcfunction = parse_node(node)
+    assert calcfunction.is_finished_ok
+    np.testing.assert_allclose(results["output_array"].get_array("moment"), expected)
+
+    node = generate_calc_job_node(
+        {"moment.SCsurf_T.out": content},
+        ["moment*"],
+        parser_options={"stream_name_list": []},
+    )
+    results, _ = parse_node(node)
+    np.testing.assert_allclose(results["output_array"].get_array("moment"), expected)
+
+
+def test_stream_parse_empty_file(parser, tmp_path):
+    output = parser.stream_parse(None, 10, str(tmp_path / "empty.raw"))
+    assert output.shape[0] == 0
+
+
+def test_get_header_and_general_parse(parser):
+    # the comment header is read line by line and the table from the same handle
+    content = b"# first\n  # second\n1 2.5 3\n4 5.5 6\n"
+    header, data_lines = parser.get_header(io.BytesIO(content))
+    assert header == ["# first", "# second"]
+    np.testing.assert_allclose(
+        parser.general_parse(data_lines), [[1, 2.5, 3], [4, 5.5, 6]]
+    )
+    # a handle that can not seek gives the first data line back in front of the rest
+    stream = io.BufferedReader(io.BytesIO(content))
+    stream.seekable = lambda: False
+    header, data_lines = parser.get_header(stream)
+    np.testing.assert_allclose(
+        parser.general_parse(data_lines), [[1, 2.5, 3], [4, 5.5, 6]]
+    )
+    # a file with only the header
+    header, data_lines = parser.get_header(io.BytesIO(b"# only\n"))
+    assert header == ["# only"] and data_lines is None
+    assert parser.general_parse(data_lines).shape == (0, 0)
+
+
+@pytest.mark.parametrize(
+    "file_name", ["averages.SCsurf_T.out", "restart.SCsurf_T.out", "coord.SCsurf_T.out"]
+)
+def test_parse_example_files(
+    generate_calc_job_node, parse_node, example_file, file_name
+):
+    # the parsed arrays are the tables of the example calculation
+    content = example_file(file_name)
+    node = generate_calc_job_node({file_name: content}, [file_name.split(".")[0] + "*"])
+    results, calcfunction = parse_node(node)
+    assert calcfunction.is_finished_ok
+    np.testing.assert_allclose(
+        results["output_array"].get_array(file_name.split(".")[0]),
+        np.loadtxt(io.BytesIO(content), comments="#", ndmin=2),
+    )
+    statistics = node.base.extras.get("parser_statistics")
+    assert statistics["files"][file_name]["bytes"] == len(content)
+
+
+def test_parse_walltime_and_missing_files(
+    generate_calc_job_node, parse_node, example_file
+):
+    # without 'Simulation finished' in the scheduler stdout the calculation hit the walltime,
+    # files that are not retrieved are skipped
+    node = generate_calc_job_node(
+        {"averages.SCsurf_T.out": example_file("averages.SCsurf_T.out")},
+        ["averages*", "totenergy*"],
+        stdout=b"",
+    )
+    results, calcfunction = parse_node(node)
+    assert calcfunction.exit_status == 451
+    assert results["output_array"].get_arraynames() == ["averages"]
+
+
+def test_typed_columns(generate_calc_job_node, parse_node, example_file):
+    # iteration, ensemble and atom are int32 columns, the observables float64 or float32
+    content = example_file("restart.SCsurf_T.out")
+    expected = np.loadtxt(io.BytesIO(content), comments="#", ndmin=2)
+    for float32, float_type in [(False, np.float64), (True, np.float32)]:
+        node = generate_calc_job_node(
+            {"restart.SCsurf_T.out": content},
+            ["restart*"],
+            parser_options={"typed_columns": True, "float32": float32},
+        )
+        results, _ = parse_node(node)
+        restart = results["output_array"].get_array("restart")
+        assert restart.dtype.names == ("iter", "ens", "atom", "mom", "mx", "my", "mz")
+        assert restart.dtype["atom"] == np.int32
+        assert restart.dtype["mx"] == float_type
+        np.testing.assert_array_equal(restart["atom"], expected[:, 2].astype(int))
+        np.testing.assert_allclose(
+            to_plain_array(restart), expected, rtol=1e-6 if float32 else 1e-12
+        )
+
+
+def test_apply_schema_unknown_columns():
+    # columns that are not in the schema are float col<i>, file types without a schema stay plain
+    table = np.array([[1, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0]])
+    typed = apply_schema("averages", table)
+    assert typed.dtype.names[-1] == "col6"
+    np.testing.assert_allclose(to_plain_array(typed), table)
+    assert apply_schema("unknown", table) is table
+
+
+def test_reduce_dict(generate_calc_job_node, parse_node, example_file):
+    # stride, block average and last rows of a time series, with the tail statistics and the full table on request
+    content = example_file("averages.SCsurf_T.out")
+    full = np.loadtxt(io.BytesIO(content), comments="#", ndmin=2)
+    node = generate_calc_job_node(
+        {"averages.SCsurf_T.out": content},
+        ["averages*"],
+        parser_options={"reduce_dict": {"averages*": {"block": 3, "keep_full": True}}},
+    )
+    results, _ = parse_node(node)
+    output_array = results["output_array"]
+    n_blocks = full.shape[0] // 3
+    np.testing.assert_allclose(
+        output_array.get_array("averages"),
+        full[: n_blocks * 3].reshape(n_blocks, 3, -1).mean(axis=1),
+    )
+    np.testing.assert_allclose(output_array.get_array("averages_full"), full)
+    stats = output_array.get_array("averages_stats")
+    tail = full[-int(np.ceil(full.shape[0] * 0.5)) :]
+    assert stats.shape == (3, full.shape[1])
+    np.testing.assert_allclose(stats[0], tail.mean(axis=0))
+    np.testing.assert_allclose(stats[1], tail.std(axis=0))
+
+    for option, expected in [
+        ({"stride": 4}, full[::4]),
+        ({"last": 5}, full[-5:]),
+    ]:
+        assert np.array_equal(reduce_table("averages", full, **option), expected)
+
+
+def test_autocorrelation_time():
+    # white noise has a time of about one row, a slowly varying series a long one, a constant series nan
+    rng = np.random.default_rng(0)
+    noise = rng.normal(size=20000)
+    assert 0.8 < autocorrelation_time(noise) < 1.2
+    correlated = np.convolve(noise, np.ones(50) / 50, mode="valid")
+    assert autocorrelation_time(correlated) > 20
+    assert np.isnan(autocorrelation_time(np.ones(10)))
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_parse_truncated_last_row(
+    generate_calc_job_node, parse_node, example_file, stream
+):
+    # a run killed at the walltime stops in the middle of a row, the complete rows are kept and the run can restart
+    content = example_file("averages.SCsurf_T.out")
+    expected = np.loadtxt(io.BytesIO(content), comments="#", ndmin=2)
+    last_line_start = content.rstrip(b"\n").rfind(b"\n") + 1
+    truncated = content[: last_line_start + 30]
+    node = generate_calc_job_node(
+        {"averages.SCsurf_T.out": truncated},
+        ["averages*"],
+        parser_options={"stream_name_list": ["averages*"] if stream else []},
+        stdout=b"",
+    )
+    results, calcfunction = parse_node(node)
+    assert calcfunction.exit_status == 451
+    np.testing.assert_allclose(
+        results["output_array"].get_array("averages"), expected[:-1]
+    )
+
+
+def test_complete_lines(parser):
+    # only the last line can be incomplete, a broken row inside the table is still an error
+    lines = [b"# header\n", b"1 2 3\n", b"4 5 6\n"]
+    assert list(parser.complete_lines(lines)) == lines
+    assert list(parser.complete_lines(lines + [b"7 8"])) == lines
+    assert list(parser.complete_lines(lines + [b"7 8 9"])) == lines
+    assert list(parser.complete_lines([b"1 2"])) == []
+    with pytest.raises(ValueError):
+        parser.general_parse(iter([b"1 2 3\n", b"4 5\n", b"7 8 9\n"]))
+
+
+@pytest.mark.parametrize(
+    "stdout, exit_status", [(b"Simulation finished\n", 452), (b"", 451)]
+)
+def test_parse_workers_with_failed_file(
+    generate_calc_job_node, parse_node, example_file, stdout, exit_status
+):
+    # the files are parsed by 3 threads, a broken file does not stop the others and a run that is stopped before
+    # the end is still a walltime error, so it is restarted
+    names = ["averages", "restart", "coord"]
+    contents = {
+        f"{name}.SCsurf_T.out": example_file(f"{name}.SCsurf_T.out") for name in names
+    }
+    contents["totenergy.SCsurf_T.out"] = b"1 2 3\n4 5\n6 7 8\n"
+    node = generate_calc_job_node(
+        contents,
+        [name + "*" for name in names + ["totenergy"]],
+        parser_options={"parse_workers": 3},
+        stdout=stdout,
+    )
+    results, calcfunction = parse_node(node)
+    assert calcfunction.exit_status == exit_status
+    output_array = results["output_array"]
+    assert sorted(output_array.get_arraynames()) == sorted(names)
+    for name in names:
+        np.testing.assert_allclose(
+            output_array.get_array(name),
+            np.loadtxt(io.BytesIO(contents[f"{name}.SCsurf_T.out"]), ndmin=2),
+        )
+    statistics = node.base.extras.get("parser_statistics")
+    assert statistics["failed_files"] == ["totenergy.SCsurf_T.out"]
+    assert statistics["parse_workers"] == 3
+
+
+@pytest.mark.parametrize("compress_format", ["gzip", "zstd"])
+def test_parse_compressed_file(
+    generate_calc_job_node, parse_node, example_file, tmp_path, compress_format
+):
+    # files of compress_name_list are not in the retrieved folder but compressed in the retrieved temporary folder,
+    # they are decompressed while they are parsed, a file that is in both is read from the retrieved folder
+    content = example_file("averages.SCsurf_T.out")
+    if compress_format == "gzip":
+        import gzip
+
+        compressed = gzip.compress(content)
+        suffix = ".gz"
+    else:
+        zstandard = pytest.importorskip("zstandard")
+        compressed = zstandard.ZstdCompressor().compress(content)
+        suffix = ".zst"
+    (tmp_path / ("averages.SCsurf_T.out" + suffix)).write_bytes(compressed)
+    (tmp_path / ("restart.SCsurf_T.out" + suffix)).write_bytes(b"corrupt")
+    node = generate_calc_job_node(
+        {"restart.SCsurf_T.out": example_file("restart.SCsurf_T.out")},
+        ["averages*", "restart*"],
+    )
+    results, calcfunction = UppASD_Parsers.parse_from_node(
+        node, store_provenance=False, retrieved_temporary_folder=str(tmp_path)
+    )
+    assert calcfunction.is_finished_ok
+    np.testing.assert_allclose(
+        results["output_array"].get_array("averages"),
+        np.loadtxt(io.BytesIO(content), ndmin=2),
+    )
+    assert results["output_array"].get_array("restart").shape[1] == 7
+    statistics = node.base.extras.get("parser_statistics")
+    assert statistics["files"]["averages.SCsurf_T.out"]["bytes"] == len(content)
+
+
+def test_parser_statistics(generate_calc_job_node, parse_node, example_file):
+    # rows, columns and bytes of every parsed file are stored in the parser_statistics extra
+    files = {
+        name: example_file(name)
+        for name in ["averages.SCsurf_T.out", "coord.SCsurf_T.out"]
+    }
+    node = generate_calc_job_node(
+        files, ["averages*", "coord*"], parser_options={"trace_memory": True}
+    )
+    parse_node(node)
+    statistics = node.base.extras.get("parser_statistics")
+    assert statistics["failed_files"] == []
+    assert statistics["total_time"] >= statistics["set_array_time"] >= 0
+    assert statistics["peak_memory"] > 0
+    for name, content in files.items():
+        expected = np.loadtxt(io.BytesIO(content), ndmin=2)
+        file_statistics = statistics["files"][name]
+        assert file_statistics["rows"] == expected.shape[0]
+        assert file_statistics["columns"] == expected.shape[1]
+        assert file_statistics["bytes"] == len(content)
+        assert file_statistics["parse_time"] >= 0
+        assert file_statistics["peak_memory"] > 0
+
+
+def test_parse_stopped_by_convergence_monitor(
+    generate_calc_job_node, parse_node, example_file
+):
+    # the job was killed by the convergence monitor in the middle of a row, it is a finished run with the complete rows
+    content = example_file("averages.SCsurf_T.out")
+    expected = np.loadtxt(io.BytesIO(content), comments="#", ndmin=2)
+    truncated = content[: content.rstrip(b"\n").rfind(b"\n") + 20]
+    node = generate_calc_job_node(
+        {"averages.SCsurf_T.out": truncated}, ["averages*"], stdout=b""
+    )
+    node.base.extras.set("convergence_monitor", {"converged": True})
+    results, calcfunction = parse_node(node)
+    assert calcfunction.is_finished_ok
+    np.testing.assert_allclose(
+        results["output_array"].get_array("averages"), expected[:-1]
+    )
+    assert set(results["observables"]["averages"]) == {"mean", "std"}
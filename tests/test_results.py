@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of UppASD_Results, the observables are read from the output observables of the calculations.
+"""
+import numpy as np
+from aiida import orm
+from aiida.common.links import LinkType
+from aiida_uppasd2.UppASD_Results import collect_observables, results_to_arrays
+
+
+def store_outputs(node, outputs):
+    # store the outputs of parse_from_node with their links, as the engine does
+    for link_label, output in outputs.items():
+        if isinstance(output, dict):
+            for label, member_output in output.items():
+                member_output.base.links.add_incoming(
+                    node, LinkType.CREATE, f"{link_label}__{label}"
+                )
+                member_output.store()
+        else:
+            output.base.links.add_incoming(node, LinkType.CREATE, link_label)
+            output.store()
+
+
+def test_collect_observables(generate_calc_job_node, example_file, parse_node):
+    averages = example_file("averages.SCsurf_T.out")
+    first = generate_calc_job_node({"averages.SCsurf_T.out": averages}, ["averages*"])
+    last = generate_calc_job_node({"averages.SCsurf_T.out": averages}, ["averages*"])
+    workflow = orm.WorkflowNode().store()
+    calc_observables = None
+    for node in [first, last]:
+        outputs, _ = parse_node(node)
+        calc_observables = outputs["observables"].get_dict()
+        store_outputs(node, outputs)
+        node.backend_entity.add_incoming(
+            workflow.backend_entity, LinkType.CALL_CALC, "call"
+        )
+    # the observables are outputs, the extras are not copied to cached calculations
+    assert "observables" not in last.base.extras.keys()
+    assert set(calc_observables) == {"averages"}
+
+    observables = collect_observables([workflow.pk, first.pk])
+    assert set(observables) == {workflow.pk, first.pk}
+    for pk in observables:
+        for row_name in ["mean", "std"]:
+            np.testing.assert_allclose(
+                observables[pk]["averages"][row_name],
+                calc_observables["averages"][row_name],
+            )
+
+    arrays = results_to_arrays(
+        ["temp"], [("0", ["100"], workflow.pk, None)], observables
+    )
+    np.testing.assert_allclose(
+        arrays["averages_mean"][0], calc_observables["averages"]["mean"]
+    )
+    np.testing.assert_array_equal(arrays["parameter_temp"], [[100.0]])
+
+
+def test_collect_observables_missing(generate_calc_job_node):
+    node = generate_calc_job_node({}, [])
+    assert collect_observables([node.pk]) == {}
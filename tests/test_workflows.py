@@ -0,0 +1,641 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the helpers of the workflows that do not need a running daemon.
+"""
+import io
+from types import SimpleNamespace
+import numpy as np
+import pytest
+from aiida import orm
+from aiida.common import AttributeDict
+from aiida.common.links import LinkType
+from aiida.orm.nodes.caching import NodeCaching
+from aiida.plugins import CalculationFactory
+from aiida_uppasd2.UppASD_BaseWorkflow import UppASD_Baseworkflow
+from aiida_uppasd2.UppASD_GenericLoopWorkflow import GenericLoopWorkflow
+from aiida_uppasd2.UppASD_PackedCalculations import UppASD_PackedCalculations
+
+ASDCalculation = CalculationFactory("asd_calculations")
+
+
+def make_point_inputs(code, **extra_inputs):
+    # the inputs of one point of the loop, as in GenericLoopWorkflow.get_workflow_inputs
+    inputs = {
+        "code": code,
+        "input_dict": {"inpsd": {"simid": ["SCsurf_T"], "temp": ["100"]}},
+        "retrieve_and_parse_name_list": orm.List(["averages*"]),
+        "num_machines": orm.Int(1),
+    }
+    inputs.update(extra_inputs)
+    return inputs
+
+
+def make_file(content):
+    return orm.SinglefileData(io.BytesIO(content), filename="jij")
+
+
+def test_point_key_input_file_content(aiida_code_installed):
+    code = aiida_code_installed(
+        default_calc_job_plugin="asd_calculations", filepath_executable="/bin/true"
+    )
+    key = GenericLoopWorkflow.get_point_key(
+        make_point_inputs(code, input_files={"jij": make_file(b"1 2 0.5\n").store()})
+    )
+    # the same file uploaded again is a new node with the same content
+    assert key == GenericLoopWorkflow.get_point_key(
+        make_point_inputs(code, input_files={"jij": make_file(b"1 2 0.5\n")})
+    )
+    assert key != GenericLoopWorkflow.get_point_key(
+        make_point_inputs(code, input_files={"jij": make_file(b"1 2 0.6\n")})
+    )
+    # walltime and resources are not part of the key
+    assert key == GenericLoopWorkflow.get_point_key(
+        make_point_inputs(
+            code,
+            input_files={"jij": make_file(b"1 2 0.5\n")},
+            num_machines=orm.Int(4),
+        )
+    )
+
+
+def test_point_key_without_caching_api(
+    aiida_code_installed, aiida_localhost, monkeypatch
+):
+    # aiida-core before 2.6 has no public get_objects_to_hash, the key hashes the content itself
+    code = aiida_code_installed(
+        default_calc_job_plugin="asd_calculations", filepath_executable="/bin/true"
+    )
+    monkeypatch.delattr(NodeCaching, "get_objects_to_hash")
+    keys = [
+        GenericLoopWorkflow.get_point_key(
+            make_point_inputs(
+                code,
+                input_files={"jij": make_file(b"1 2 0.5\n")},
+                parent_folder=orm.RemoteData(
+                    remote_path=remote_path, computer=aiida_localhost
+                ),
+            )
+        )
+        for remote_path in ["/scratch/1", "/scratch/1", "/scratch/2"]
+    ]
+    assert keys[0] == keys[1] != keys[2]
+
+
+def test_point_key_convergence_monitor_and_stitch(aiida_code_installed):
+    code = aiida_code_installed(
+        default_calc_job_plugin="asd_calculations", filepath_executable="/bin/true"
+    )
+    key = GenericLoopWorkflow.get_point_key(make_point_inputs(code))
+    monitor_key = GenericLoopWorkflow.get_point_key(
+        make_point_inputs(code, convergence_monitor=orm.Dict({"file_name": "averages"}))
+    )
+    stitch_key = GenericLoopWorkflow.get_point_key(
+        make_point_inputs(code, stitch_name_list=orm.List(["averages*"]))
+    )
+    assert len({key, monitor_key, stitch_key}) == 3
+
+
+def make_base_workflow(input_dict, adaptive_walltime, learned_rate=None):
+    # the inputs and methods of an UppASD_Baseworkflow that inputs_process and get_rate_key use
+    workflow = SimpleNamespace(
+        inputs=AttributeDict(
+            {
+                "code": None,
+                "input_dict": orm.Dict(input_dict),
+                "retrieve_and_parse_name_list": orm.List(["averages*"]),
+                "num_machines": orm.Int(1),
+                "num_mpiprocs_per_machine": orm.Int(4),
+                "init_walltime": orm.Int(3600),
+                "parser_name": orm.Str("asd_parsers"),
+                "mpirun": orm.Bool(True),
+                "label": orm.Str(""),
+                "description": orm.Str(""),
+                "autorestart_mode": orm.Str("Nstep"),
+                "adaptive_walltime": orm.Bool(adaptive_walltime),
+                "walltime_safety_factor": orm.Float(1.0),
+            }
+        ),
+        ctx=AttributeDict(),
+        report=lambda message: None,
+        get_learned_rate=lambda: learned_rate,
+    )
+    workflow.predict_walltime = (
+        lambda steps, rate: UppASD_Baseworkflow.predict_walltime(workflow, steps, rate)
+    )
+    return workflow
+
+
+def test_inputs_process_bare_strings():
+    # tags given as bare strings are read from the canonical input_dict
+    workflow = make_base_workflow(
+        {"inpsd": {"simid": "SCsurf_T", "Nstep": "10000", "ncell": "50 50 1"}},
+        adaptive_walltime=True,
+        learned_rate=100.0,
+    )
+    UppASD_Baseworkflow.inputs_process(workflow)
+    assert workflow.ctx.remaining_steps == 10000
+    assert workflow.ctx.inputs["metadata"]["options"]["max_wallclock_seconds"] == (
+        UppASD_Baseworkflow.predict_walltime(workflow, 10000, 100.0)
+    )
+    assert UppASD_Baseworkflow.get_rate_key(workflow)["system_size"] == 2500
+
+
+def test_inputs_process_without_adaptive_walltime():
+    # without adaptive_walltime the steps are not needed, mcNstep runs have no Nstep
+    workflow = make_base_workflow(
+        {"inpsd": {"simid": ["SCsurf_T"], "mcNstep": ["10000"]}},
+        adaptive_walltime=False,
+    )
+    UppASD_Baseworkflow.inputs_process(workflow)
+    assert workflow.ctx.remaining_steps is None
+    assert workflow.ctx.inputs["metadata"]["options"]["max_wallclock_seconds"] == 3600
+
+
+def generate_segment(generate_calc_job_node, iterations, exit_status, restart=None):
+    # an attempt of the base workflow with the averages at the given iterations, restart is the iteration of the
+    # restart file it started from (restart_iteration.txt of the remote restart)
+    files = {}
+    if restart is not None:
+        files[ASDCalculation._restart_iteration_file_name] = b"%d\n" % restart
+    node = generate_calc_job_node(files, ["averages*"])
+    node.set_exit_status(exit_status)
+    averages = np.column_stack([iterations, np.arange(len(iterations)) * 0.5])
+    output_array = orm.ArrayData()
+    output_array.set_array("averages", averages)
+    output_array.base.links.add_incoming(node, LinkType.CREATE, "output_array")
+    output_array.store()
+    return node
+
+
+def make_stitch_workflow(children):
+    workflow = SimpleNamespace(
+        ctx=AttributeDict({"children": children}),
+        inputs=AttributeDict({"stitch_name_list": orm.List(["averages*"])}),
+        _default_stitch_name_list=UppASD_Baseworkflow._default_stitch_name_list,
+        _process_class=ASDCalculation,
+    )
+    workflow.get_restart_iteration = (
+        lambda segments, index: UppASD_Baseworkflow.get_restart_iteration(
+            workflow, segments, index
+        )
+    )
+    return workflow
+
+
+def test_stitch_segments(generate_calc_job_node, monkeypatch):
+    walltime = ASDCalculation.exit_codes.WallTimeError.status
+    children = [
+        generate_segment(generate_calc_job_node, np.arange(0, 100, 10), walltime),
+        generate_segment(generate_calc_job_node, np.arange(0, 60, 10), 0, restart=50),
+    ]
+    # the segments are read block by block, never as whole arrays
+    monkeypatch.setattr(UppASD_Baseworkflow, "_stitch_block_rows", 3)
+    monkeypatch.setattr(
+        orm.ArrayData, "get_array", lambda *args: pytest.fail("get_array called")
+    )
+    stitched = UppASD_Baseworkflow.stitch_segments(make_stitch_workflow(children))
+    monkeypatch.undo()
+    np.testing.assert_array_equal(
+        stitched.get_array("averages")[:, 0],
+        list(range(0, 50, 10)) + list(range(50, 110, 10)),
+    )
+    # the stitched array is created by the calcfunction stitch_arrays from the output arrays of the segments
+    assert stitched.is_stored
+    creator = stitched.creator
+    assert creator.process_label == "stitch_arrays"
+    assert creator.inputs.segment_0.pk == children[0].outputs.output_array.pk
+    assert creator.inputs.segment_1.pk == children[1].outputs.output_array.pk
+    assert creator.inputs.restart_iterations.get_list() == [50, None]
+
+
+def test_stitch_segments_nothing_to_stitch(generate_calc_job_node):
+    # no segment has one of the arrays in stitch_name_list
+    walltime = ASDCalculation.exit_codes.WallTimeError.status
+    children = [
+        generate_segment(generate_calc_job_node, np.arange(0, 100, 10), walltime),
+        generate_segment(generate_calc_job_node, np.arange(0, 60, 10), 0, restart=50),
+    ]
+    workflow = make_stitch_workflow(children)
+    workflow.inputs = AttributeDict({"stitch_name_list": orm.List(["moment*"])})
+    assert UppASD_Baseworkflow.stitch_segments(workflow) is None
+
+
+def test_stitch_segments_dropped_attempt(generate_calc_job_node):
+    # the attempt in the middle failed and is not stitched, the first attempt still ends at the restart iteration
+    # of the attempt after it
+    walltime = ASDCalculation.exit_codes.WallTimeError.status
+    parsing_error = ASDCalculation.exit_codes.ParsingError.status
+    children = [
+        generate_segment(generate_calc_job_node, np.arange(0, 100, 10), walltime),
+        generate_segment(
+            generate_calc_job_node, np.arange(0, 40, 10), parsing_error, restart=50
+        ),
+        generate_segment(generate_calc_job_node, np.arange(0, 60, 10), 0, restart=30),
+    ]
+    stitched = UppASD_Baseworkflow.stitch_segments(make_stitch_workflow(children))
+    np.testing.assert_array_equal(
+        stitched.get_array("averages")[:, 0],
+        list(range(0, 50, 10)) + list(range(50, 110, 10)),
+    )
+
+
+class FakeNode:
+    # a submitted sub workflow or packed calculation that finished okay, with a remote folder for the warm start
+    def __init__(self, pk, process_class, inputs, computer=None):
+        self.pk = pk
+        self.process_class = process_class
+        self.inputs = inputs
+        self.is_finished_ok = True
+        self.outputs = AttributeDict()
+        if computer is not None:
+            self.outputs.remote_folder = orm.RemoteData(
+                remote_path=f"/scratch/{pk}", computer=computer
+            )
+        self.base = SimpleNamespace(extras=SimpleNamespace(set=lambda *args: None))
+
+
+def make_loop_workflow(loop_dict_input, computer=None, **extra_inputs):
+    # a stand-in of GenericLoopWorkflow with all its methods, submit returns a FakeNode and records the inputs,
+    # the nodes have a remote folder on computer if it is given
+    inputs = AttributeDict(
+        {
+            "code": SimpleNamespace(uuid="code-uuid"),
+            "mpirun": orm.Bool(True),
+            "input_dict": orm.Dict(
+                {"inpsd": {"simid": ["SCsurf_T"], "temp": ["10"], "Initmag": ["3"]}}
+            ),
+            "retrieve_and_parse_name_list": orm.List(["averages*"]),
+            "label": orm.Str("loop"),
+            "description": orm.Str(""),
+            "parser_name": orm.Str("asd_parsers"),
+            "num_mpiprocs_per_machine": orm.Int(4),
+            "num_machines": orm.Int(1),
+            "init_walltime": orm.Int(3600),
+            "calculation_repeat_num": orm.Int(2),
+            "walltime_increase": orm.Int(600),
+            "autorestart_mode": orm.Str("Nstep"),
+            "loop_dict_input": orm.Dict(loop_dict_input),
+            "reuse_finished_points": orm.Bool(False),
+            "share_input_files": orm.Bool(False),
+        }
+    )
+    inputs.update(extra_inputs)
+    # the inputs of a running workchain are stored, get_dict then gives a copy
+    inputs.input_dict.store()
+    workflow = SimpleNamespace(
+        inputs=inputs, ctx=AttributeDict(), reports=[], submitted=[]
+    )
+    workflow.report = workflow.reports.append
+    for name, attribute in vars(GenericLoopWorkflow).items():
+        if isinstance(attribute, staticmethod):
+            setattr(workflow, name, attribute.__func__)
+        elif callable(attribute) and not isinstance(attribute, classmethod):
+            setattr(workflow, name, attribute.__get__(workflow))
+
+    def submit(process_class, **process_inputs):
+        node = FakeNode(
+            len(workflow.submitted) + 1, process_class, process_inputs, computer
+        )
+        workflow.submitted.append(node)
+        return node
+
+    workflow.submit = submit
+    return workflow
+
+
+def run_loop(workflow, finished=lambda node: True):
+    # the outline of the loop without the summary, the engine puts the sub workflows of a batch into the context
+    # when all of them are done. Returns the nodes submitted in every batch.
+    batches = []
+    workflow.setup_loops()
+    while workflow.has_next_combinations():
+        futures = workflow.loops()
+        for tag, node in futures.items():
+            node.is_finished_ok = finished(node)
+            workflow.ctx[tag] = node
+        batches.append(list(futures.values()))
+        workflow.refine()
+    return batches
+
+
+def test_max_concurrent_batches(aiida_profile):
+    # 5 points with max_concurrent 2 are submitted as 2, 2 and 1 sub workflows
+    workflow = make_loop_workflow(
+        {"temp": [["10"], ["20"], ["30"], ["40"], ["50"]]},
+        max_concurrent=orm.Int(2),
+    )
+    batches = run_loop(workflow)
+    assert [len(batch) for batch in batches] == [2, 2, 1]
+    assert all(
+        node.process_class is UppASD_Baseworkflow for batch in batches for node in batch
+    )
+    assert [
+        node.inputs["input_dict"]["inpsd"]["temp"]
+        for batch in batches
+        for node in batch
+    ] == [["10"], ["20"], ["30"], ["40"], ["50"]]
+    assert len(workflow.ctx.loop_dict_combinations) == 5
+
+
+def test_max_concurrent_counts_points_of_packs(aiida_profile):
+    # with pack_size the limit counts points: batches of 3 points are packed into jobs of at most 2 points
+    workflow = make_loop_workflow(
+        {"temp": [["10"], ["20"], ["30"], ["40"], ["50"]]},
+        max_concurrent=orm.Int(3),
+        pack_size=orm.Int(2),
+    )
+    batches = run_loop(workflow)
+    assert [
+        [len(node.inputs["input_dicts"]) for node in batch] for batch in batches
+    ] == [[2, 1], [2]]
+    assert all(
+        node.process_class is UppASD_PackedCalculations
+        for batch in batches
+        for node in batch
+    )
+    assert list(workflow.ctx.pack_members.values()) == [
+        ["pack_0", "member_0"],
+        ["pack_0", "member_1"],
+        ["pack_1", "member_0"],
+        ["pack_2", "member_0"],
+        ["pack_2", "member_1"],
+    ]
+
+
+def test_warm_start_chains(aiida_localhost):
+    # the points along hfield are chained for every temp, in the order of the list in loop_dict_input, every point
+    # starts from the remote folder of the previous one with the tags of warm_start_inpsd
+    workflow = make_loop_workflow(
+        {
+            "temp": [["10"], ["20"]],
+            "hfield": [["0", "0", "1"], ["0", "0", "2"], ["0", "0", "3"]],
+        },
+        computer=aiida_localhost,
+        warm_start_axis=orm.Str("hfield"),
+        warm_start_inpsd=orm.Dict({"ip_mcanneal": ["1", "100 10 1.0e-16 0.3"]}),
+    )
+    batches = run_loop(workflow)
+    # one point of every chain per step
+    assert [
+        [
+            (
+                node.inputs["input_dict"]["inpsd"]["temp"][0],
+                node.inputs["input_dict"]["inpsd"]["hfield"][2],
+            )
+            for node in batch
+        ]
+        for batch in batches
+    ] == [
+        [("10", "1"), ("20", "1")],
+        [("10", "2"), ("20", "2")],
+        [("10", "3"), ("20", "3")],
+    ]
+    for previous_batch, batch in zip(batches[:-1], batches[1:]):
+        for previous, node in zip(previous_batch, batch):
+            assert node.inputs["parent_folder"] is previous.outputs.remote_folder
+            assert node.inputs["input_dict"]["inpsd"]["ip_mcanneal"] == [
+                "1",
+                "100 10 1.0e-16 0.3",
+            ]
+    # the first point of a chain is a cold start
+    for node in batches[0]:
+        assert "parent_folder" not in node.inputs
+        assert "ip_mcanneal" not in node.inputs["input_dict"]["inpsd"]
+
+
+def test_warm_start_failed_link(aiida_localhost):
+    # the second point of the chain failed, the third one starts cold and the chain goes on
+    workflow = make_loop_workflow(
+        {"hfield": [["0", "0", "1"], ["0", "0", "2"], ["0", "0", "3"]]},
+        computer=aiida_localhost,
+        warm_start_axis=orm.Str("hfield"),
+        warm_start_inpsd=orm.Dict({"ip_mcanneal": ["1", "100 10 1.0e-16 0.3"]}),
+    )
+    batches = run_loop(workflow, finished=lambda node: node.pk != 2)
+    nodes = [node for batch in batches for node in batch]
+    assert len(nodes) == 3
+    assert nodes[1].inputs["parent_folder"] is nodes[0].outputs.remote_folder
+    assert "parent_folder" not in nodes[2].inputs
+    assert "ip_mcanneal" not in nodes[2].inputs["input_dict"]["inpsd"]
+    assert any("without warm start" in report for report in workflow.reports)
+
+
+def test_warm_start_initmag(aiida_localhost):
+    # a point with parent_folder starts from the restart file: Initmag 4 and restartfile restart
+    parent_folder = orm.RemoteData(remote_path="/scratch/1", computer=aiida_localhost)
+    workflow = make_base_workflow(
+        {"inpsd": {"simid": ["SCsurf_T"], "Initmag": ["3"], "Nstep": ["1000"]}},
+        adaptive_walltime=False,
+    )
+    workflow.inputs.parent_folder = parent_folder
+    UppASD_Baseworkflow.inputs_process(workflow)
+    inpsd = workflow.ctx.inputs["input_dict"]["inpsd"]
+    assert inpsd["Initmag"] == ["4"]
+    assert inpsd["restartfile"] == ["restart"]
+    assert workflow.ctx.inputs["parent_folder"] is parent_folder
+    # without parent_folder the input_dict is kept
+    workflow = make_base_workflow(
+        {"inpsd": {"simid": ["SCsurf_T"], "Initmag": ["3"], "Nstep": ["1000"]}},
+        adaptive_walltime=False,
+    )
+    UppASD_Baseworkflow.inputs_process(workflow)
+    assert workflow.ctx.inputs["input_dict"]["inpsd"]["Initmag"] == ["3"]
+    assert "parent_folder" not in workflow.ctx.inputs
+
+
+def test_get_midpoint():
+    # integer values (ncell) get integer midpoints, floats keep their precision
+    assert GenericLoopWorkflow.get_midpoint(["50", "50", "1"], ["85", "85", "1"]) == [
+        "67",
+        "67",
+        "1",
+    ]
+    assert GenericLoopWorkflow.get_midpoint(["10"], ["15"]) == ["12"]
+    assert GenericLoopWorkflow.get_midpoint(["10.0"], ["15"]) == ["12.5"]
+    assert GenericLoopWorkflow.get_midpoint(["0", "0", "0.1"], ["0", "0", "0.2"]) == [
+        "0",
+        "0",
+        "0.15",
+    ]
+    assert GenericLoopWorkflow.get_midpoint("1.5", "2") == "1.75"
+
+
+def test_validate_refine_dict(aiida_profile):
+    refine_dict = {"observable": "averages", "column": 4, "threshold": 0.1}
+    assert "axes" in GenericLoopWorkflow._validate_refine_dict(
+        orm.Dict(refine_dict), None
+    )
+    assert "axes" in GenericLoopWorkflow._validate_refine_dict(
+        orm.Dict({**refine_dict, "axes": []}), None
+    )
+    assert (
+        GenericLoopWorkflow._validate_refine_dict(
+            orm.Dict({**refine_dict, "axes": ["temp"]}), None
+        )
+        is None
+    )
+
+
+def test_get_min_spacing(aiida_profile):
+    # smallest spacing of the coarse grid along every axis / 2**max_level, only for the axes in refine_dict
+    loop_dict_input = {
+        "temp": [["10"], ["50"], ["70"]],
+        "hfield": [["0", "0", "0"], ["0", "3", "4"]],
+        "Mensemble": [["1"], ["4"]],
+    }
+    workflow = make_loop_workflow(
+        loop_dict_input,
+        refine_dict=orm.Dict(
+            {
+                "observable": "averages",
+                "column": 4,
+                "threshold": 0.1,
+                "axes": ["temp", "hfield", "unknown"],
+                "max_level": 2,
+            }
+        ),
+    )
+    assert workflow.get_min_spacing(loop_dict_input) == {"temp": 5.0, "hfield": 1.25}
+
+
+def make_refine_workflow(loop_dict_input, **refine_dict):
+    # a loop with a magnetization that drops from 1 to 0 at the temperature 33, for every field
+    workflow = make_loop_workflow(
+        loop_dict_input,
+        refine_dict=orm.Dict(
+            {"observable": "averages", "column": 4, "threshold": 0.5, **refine_dict}
+        ),
+    )
+    workflow.get_observable = lambda tag: (
+        1.0 if float(workflow.ctx.tag_combinations[tag][0][0]) < 33 else 0.0
+    )
+    return workflow
+
+
+def get_temperatures(batch):
+    return [node.inputs["input_dict"]["inpsd"]["temp"][0] for node in batch]
+
+
+def test_refine_max_level(aiida_profile):
+    # the transition is bisected until the spacing is 40 / 2**3, then the refinement stops
+    workflow = make_refine_workflow(
+        {"temp": [["10"], ["50"], ["90"]]}, axes=["temp"], max_level=3
+    )
+    batches = run_loop(workflow)
+    assert [get_temperatures(batch) for batch in batches] == [
+        ["10", "50", "90"],
+        ["30"],
+        ["40"],
+        ["35"],
+    ]
+    assert workflow.ctx.refine_min_spacing == {"temp": 5.0}
+
+
+def test_refine_max_points(aiida_profile):
+    # two lines (one per field) want a new point each, the budget of max_points allows only one in total
+    workflow = make_refine_workflow(
+        {"temp": [["10"], ["50"]], "hfield": [["0", "0", "0"], ["0", "0", "1"]]},
+        axes=["temp"],
+        max_points=5,
+    )
+    batches = run_loop(workflow)
+    assert [len(batch) for batch in batches] == [4, 1]
+    assert len(workflow.ctx.loop_dict_combinations) == 5
+    assert "The refinement is limited by max_points" in workflow.reports
+
+
+def test_refine_only_axes(aiida_profile):
+    # Mensemble is a loop key but not an axis, so the transition along it is not refined
+    workflow = make_loop_workflow(
+        {"temp": [["10"], ["50"]], "Mensemble": [["1"], ["8"]]},
+        refine_dict=orm.Dict(
+            {"observable": "averages", "column": 4, "threshold": 0.5, "axes": ["temp"]}
+        ),
+    )
+    workflow.get_observable = lambda tag: float(
+        workflow.ctx.tag_combinations[tag][1][0]
+    )
+    batches = run_loop(workflow)
+    assert len(batches) == 1
+
+
+@pytest.mark.parametrize(
+    "max_walltime, walltimes", [(None, [10800, 7200]), (9000, [9000, 7200])]
+)
+def test_pack_options(aiida_profile, max_walltime, walltimes):
+    # a pack has the resources of one point and init_walltime times its number of points, at most max_walltime
+    extra_inputs = {"pack_size": orm.Int(3)}
+    if max_walltime is not None:
+        extra_inputs["max_walltime"] = orm.Int(max_walltime)
+    workflow = make_loop_workflow(
+        {"temp": [["10"], ["20"], ["30"], ["40"], ["50"]]}, **extra_inputs
+    )
+    packs = run_loop(workflow)[0]
+    assert [len(node.inputs["input_dicts"]) for node in packs] == [3, 2]
+    for node, walltime in zip(packs, walltimes):
+        assert node.inputs["metadata"]["options"] == {
+            "resources": {"num_machines": 1, "num_mpiprocs_per_machine": 4},
+            "max_wallclock_seconds": walltime,
+            "withmpi": True,
+        }
+    assert any("limited to max_walltime" in report for report in workflow.reports) == (
+        max_walltime is not None
+    )
+
+
+def make_shared_loop_workflow(computer, input_dict):
+    # a loop over temp with share_input_files, the code runs on computer
+    workflow = make_loop_workflow(
+        {"temp": [["10"], ["20"]]},
+        computer=computer,
+        code=SimpleNamespace(uuid="code-uuid", computer=computer),
+        input_dict=orm.Dict(input_dict),
+        share_input_files=orm.Bool(True),
+    )
+    workflow.setup_loops()
+    return workflow
+
+
+def test_stage_input_files(aiida_localhost):
+    # posfile is uploaded once, the points link it and keep the system size of ncell times the atoms in posfile
+    input_dict = {
+        "inpsd": {"simid": ["SCsurf_T"], "temp": ["10"], "ncell": ["2", "2", "1"]},
+        "posfile": ["1 1 0.0 0.0 0.0", "2 2 0.5 0.5 0.0"],
+    }
+    workflow = make_shared_loop_workflow(aiida_localhost, input_dict)
+    assert workflow.stage_input_files() is not None
+    transfer = workflow.submitted[0]
+    assert transfer.inputs["instructions"].get_dict()["local_files"] == [
+        ["shared_input_files", "posfile", "posfile"]
+    ]
+    workflow.ctx.stage_input_files = transfer
+    workflow.inspect_stage_input_files()
+
+    points = list(workflow.loops().values())
+    assert len(points) == 2
+    for node in points:
+        assert "posfile" not in node.inputs["input_dict"]
+        assert node.inputs["shared_input_folder"] == transfer.outputs.remote_folder
+        assert node.inputs["shared_input_names"].get_list() == ["posfile"]
+        assert node.inputs["system_size"].value == 8
+
+    base_workflow = make_base_workflow(points[0].inputs["input_dict"], False)
+    base_workflow.inputs.system_size = points[0].inputs["system_size"]
+    UppASD_Baseworkflow.inputs_process(base_workflow)
+    assert UppASD_Baseworkflow.get_rate_key(base_workflow)["system_size"] == 8
+
+
+def test_stage_input_files_nothing_shared(aiida_localhost):
+    # every file is looped over, nothing is uploaded and the points keep their own files
+    input_dict = {"inpsd": {"simid": ["SCsurf_T"], "temp": ["10"]}}
+    workflow = make_shared_loop_workflow(aiida_localhost, input_dict)
+    assert workflow.stage_input_files() is None
+    assert workflow.submitted == []
+    assert workflow.inspect_stage_input_files() is None
+    assert "shared_input_folder" not in workflow.ctx
+
+    points = list(workflow.loops().values())
+    assert len(points) == 2
+    for node in points:
+        assert "shared_input_folder" not in node.inputs
+        assert "system_size" not in node.inputs